@@ -0,0 +1,140 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compares reading backup table metadata with one get_table call per table against gcp.infoschema.dataset_tables
+(three INFORMATION_SCHEMA queries), on a simulated dataset with fixed API and query latencies
+
+    PYTHONPATH=src/main/python python benchmarks/infoschema_benchmark.py [--tables 2000] [--call-latency 0.05]
+        [--query-latency 2] [--threads 25]
+"""
+
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import bigquery
+
+from gcp.infoschema import dataset_tables
+
+TYPES = {"id": "INT64", "name": "STRING(20)", "amount": "NUMERIC(10, 2)", "tags": "ARRAY<STRING>",
+         "rec": "ARRAY<STRUCT<a TIMESTAMP NOT NULL, b FLOAT64>>", "day": "DATE"}
+
+
+def generate(tables: int):
+    """API resources by table id, and the matching TABLES, TABLE_OPTIONS and COLUMNS rows"""
+    resources, table_rows, option_rows, column_rows = {}, [], [], []
+    for i in range(tables):
+        name = "t{:05d}".format(i)
+        fields = [{"name": "id", "type": "INTEGER", "mode": "REQUIRED", "description": "key"},
+                  {"name": "name", "type": "STRING", "mode": "NULLABLE", "maxLength": "20"},
+                  {"name": "amount", "type": "NUMERIC", "mode": "NULLABLE", "precision": "10", "scale": "2"},
+                  {"name": "tags", "type": "STRING", "mode": "REPEATED"},
+                  {"name": "rec", "type": "RECORD", "mode": "REPEATED", "fields": [
+                      {"name": "a", "type": "TIMESTAMP", "mode": "REQUIRED"},
+                      {"name": "b", "type": "FLOAT", "mode": "NULLABLE", "description": 'b "quoted"'}]},
+                  {"name": "day", "type": "DATE", "mode": "NULLABLE"}]
+        resources[name] = {
+            "kind": "bigquery#table", "id": "p:d." + name,
+            "tableReference": {"projectId": "p", "datasetId": "d", "tableId": name},
+            "type": "TABLE", "location": "US", "creationTime": "1700000000000",
+            "lastModifiedTime": str(1700000000000 + i), "numRows": str(i * 10), "numBytes": str(i * 1000),
+            "schema": {"fields": fields}, "description": 'Table "{}"\nline'.format(i),
+            "labels": {"env": "prod", "n": str(i)},
+            "timePartitioning": {"type": "DAY", "field": "day", "expirationMs": str(30 * 86400000)},
+            "clustering": {"fields": ["id", "name"]}}
+        table_rows.append({"table_name": name, "table_type": "BASE TABLE",
+                           "ddl": "CREATE TABLE `p.d.{}`\n(\n  id INT64 NOT NULL\n)\nPARTITION BY day\n"
+                                  "CLUSTER BY id, name\nOPTIONS(\n  x=1\n);".format(name),
+                           "view_definition": None, "use_standard_sql": None, "row_count": i * 10,
+                           "size_bytes": i * 1000, "creation_time": 1700000000000,
+                           "last_modified_time": 1700000000000 + i})
+        options = {"description": json.dumps(resources[name]["description"]),
+                   "labels": '[STRUCT("env", "prod"), STRUCT("n", "{}")]'.format(i),
+                   "partition_expiration_days": "30.0"}
+        option_rows += [{"table_name": name, "option_name": option, "option_value": value}
+                        for option, value in options.items()]
+        for position, field in enumerate(fields):
+            column = {"table_name": name, "column_name": field["name"], "ordinal_position": position + 1,
+                      "is_nullable": "NO" if field["mode"] == "REQUIRED" else "YES", "data_type": TYPES[field["name"]],
+                      "column_default": "NULL", "clustering_ordinal_position": {"id": 1, "name": 2}.get(field["name"]),
+                      "collation_name": "NULL", "rounding_mode": None, "policy_tags": 0}
+            column_rows.append(dict(column, field_path=field["name"], description=field.get("description")))
+            for sub_field in field.get("fields", []):
+                column_rows.append(dict(column, field_path=field["name"] + "." + sub_field["name"],
+                                        description=sub_field.get("description")))
+    return resources, table_rows, option_rows, column_rows
+
+
+class FakeJob():
+    def __init__(self, rows, latency):
+        self.rows = rows
+        self.latency = latency
+
+    def result(self):
+        time.sleep(self.latency)
+        return [dict(row) for row in self.rows]
+
+
+class FakeClient():
+    """Serves tables.get and the INFORMATION_SCHEMA queries from generated data, sleeping for their latency"""
+
+    def __init__(self, tables, call_latency, query_latency):
+        self.resources, self.table_rows, self.option_rows, self.column_rows = generate(tables)
+        self.call_latency = call_latency
+        self.query_latency = query_latency
+        self.calls = 0
+
+    def get_table(self, table_ref):
+        self.calls += 1
+        time.sleep(self.call_latency)
+        return bigquery.Table.from_api_repr(json.loads(json.dumps(self.resources[table_ref.table_id])))
+
+    def query(self, sql, location=None):
+        self.calls += 1
+        if "TABLE_OPTIONS" in sql:
+            return FakeJob(self.option_rows, self.query_latency)
+        if "COLUMNS" in sql:
+            return FakeJob(self.column_rows, self.query_latency)
+        return FakeJob(self.table_rows, self.query_latency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tables", type=int, default=2000)
+    parser.add_argument("--call-latency", type=float, default=0.05)
+    parser.add_argument("--query-latency", type=float, default=2)
+    parser.add_argument("--threads", type=int, default=25)
+    args = parser.parse_args()
+
+    dataset = bigquery.Dataset("p.d")
+    dataset.location = "US"
+
+    client = FakeClient(args.tables, args.call_latency, args.query_latency)
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        tables = list(executor.map(client.get_table, (dataset.reference.table(name) for name in client.resources)))
+    print("per-call: {} tables, {} calls, {:.1f} s".format(len(tables), client.calls, time.monotonic() - start))
+
+    client = FakeClient(args.tables, args.call_latency, args.query_latency)
+    start = time.monotonic()
+    resources, fallback = dataset_tables(client, dataset)
+    seconds = time.monotonic() - start
+    matching = sum(resource == client.resources[name] for name, resource in resources.items())
+    print("bulk: {} tables, {} queries, {:.1f} s, {} matching the API, {} falling back to get_table".format(
+        len(resources), client.calls, seconds, matching, len(fallback)))
+
+
+if __name__ == "__main__":
+    main()
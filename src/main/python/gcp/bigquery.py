@@ -20,18 +20,60 @@ from importlib_metadata import version
 import argparse
 import json
 import os
+import random
 import sys
+import tempfile
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
 from pandas import DataFrame
+from pyarrow import ArrowInvalid
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Optional
-from .validstruct import valid_object
+from logging import basicConfig, getLogger
+from typing import List, Optional, Tuple
+from .columnar import csv_to_parquet, parquet_compatible
+from . import datasetcopy, schema
+from .jobprofile import format_profile, profile_job
+from .metacache import CACHE
+from .tablereader import BigQueryReadClient, create_session, read_session
+from .template import Template
+from .validation import validate_csv, validate_json
+from .validstruct import delete_keys_from_dict, struct_object, valid_object
 
 try:
     __version__ = version('stanford-wdl-kit')
 except:
     __version__ = "development"
 
+LOG = getLogger(__name__)
+
+
+def get_job_resource(client: bigquery.Client, job) -> dict:
+    """
+    Returns the full REST resource of a job (including statistics)
+    """
+    # Call the Job REST API, as job.to_api_repr() is missing statistics
+    extra_params = {"projection": "full"}
+    path = "/projects/{}/jobs/{}".format(job.project, job.job_id)
+    span_attributes = {
+        "path": path, "job_id": job.job_id, "location": job.location}
+    return client._call_api(retry=DEFAULT_RETRY, span_name="BigQuery.getJob",
+                            span_attributes=span_attributes, method="GET", path=path, query_params=extra_params)
+
+
+def write_job_handles(jobs: List) -> dict:
+    """
+    Writes handles of submitted (still running) jobs to handle.json, for the wait command
+    """
+    handles = {"jobs": [{"projectId": job.project, "jobId": job.job_id, "location": job.location,
+                         "jobType": job.job_type} for job in jobs]}
+    with open('handle.json', 'w') as handle_file:
+        json.dump(handles, handle_file, indent=2, sort_keys=True)
+    return handles
+
+
 @dataclass_json
 @dataclass
 class CreateTableConfig():
@@ -41,6 +83,63 @@ class CreateTableConfig():
     drop: bool = False
     # If table already exists, don't return an error
     existsOk: bool = True
+    # Apply compatible changes (added columns, relaxed modes, descriptions, labels) to an existing table in place,
+    # only dropping and recreating it for incompatible changes
+    evolve: bool = False
+
+
+def evolve_table(client: bigquery.Client, resource: dict,
+                 rebuild: bool = True) -> Tuple[str, bigquery.Table, List[str], List[str]]:
+    """
+    Creates a table, or brings an existing table in line with resource using update_table() where possible.
+    Returns the path taken (created, unchanged, updated or rebuilt), the table, and the compatible and
+    incompatible changes found.
+    """
+    table = bigquery.Table.from_api_repr(resource)
+    try:
+        existing = CACHE.get_table(client, table.reference)
+    except exceptions.NotFound:
+        created = client.create_table(table, timeout=30)
+        CACHE.put(created)
+        return "created", created, [], []
+
+    changes, incompatible = [], []
+    update_fields = []
+    requested_fields = resource.get("schema", {}).get("fields")
+    if requested_fields is not None:
+        existing_fields = existing.to_api_repr().get("schema", {}).get("fields", [])
+        merged, changes, incompatible = schema.diff_fields(requested_fields, existing_fields)
+        if changes:
+            existing.schema = [bigquery.SchemaField.from_api_repr(field) for field in merged]
+            update_fields.append("schema")
+
+    if incompatible:
+        if not rebuild:
+            raise Exception("Incompatible schema changes to {}: {}".format(table.table_id, "; ".join(incompatible)))
+        LOG.warning("Rebuilding %s: %s", table.table_id, "; ".join(incompatible))
+        client.delete_table(table.reference, not_found_ok=True)
+        rebuilt = client.create_table(table, timeout=30)
+        CACHE.put(rebuilt)
+        return "rebuilt", rebuilt, changes, incompatible
+
+    for key, attr in (("description", "description"), ("friendlyName", "friendly_name")):
+        if key in resource and getattr(existing, attr) != getattr(table, attr):
+            setattr(existing, attr, getattr(table, attr))
+            changes.append(key)
+            update_fields.append(attr)
+    if "labels" in resource and existing.labels != table.labels:
+        # Labels missing from the request are removed by setting them to None
+        labels = {key: None for key in existing.labels if key not in table.labels}
+        labels.update(table.labels)
+        existing.labels = labels
+        changes.append("labels")
+        update_fields.append("labels")
+
+    if not update_fields:
+        return "unchanged", existing, changes, incompatible
+    updated = client.update_table(existing, update_fields)
+    CACHE.put(updated)
+    return "updated", updated, changes, incompatible
 
 
 def create_table(config: CreateTableConfig):
@@ -48,10 +147,19 @@ def create_table(config: CreateTableConfig):
     Creates a table -> table.json
     """
     client = bigquery.Client()
-    table = bigquery.Table.from_api_repr(config.table)
-    if config.drop:
-        client.delete_table(table, not_found_ok=True)
-    table = client.create_table(table, exists_ok=config.existsOk, timeout=30)
+    if config.evolve and not config.drop:
+        # WDL passes unset Table fields as nulls, which would otherwise read as changes
+        resource = remap(config.table, visit=lambda p, k, v: v is not None)
+        path, table, changes, incompatible = evolve_table(client, resource)
+        with open('evolve.json', 'w') as evolve_file:
+            json.dump({"path": path, "changes": changes, "incompatible": incompatible},
+                      evolve_file, indent=2, sort_keys=True)
+    else:
+        table = bigquery.Table.from_api_repr(config.table)
+        if config.drop:
+            client.delete_table(table, not_found_ok=True)
+        table = client.create_table(table, exists_ok=config.existsOk, timeout=30)
+        CACHE.put(table)
 
     with open('raw_table.json', 'w') as table_file:
         json.dump(table.to_api_repr(), table_file, indent=2, sort_keys=True)
@@ -61,6 +169,57 @@ def create_table(config: CreateTableConfig):
     with open('table.json', 'w') as modified_file:
         json.dump(modified_json, modified_file, indent=2, sort_keys=True)
 
+@dataclass_json
+@dataclass
+class CreateTablesConfig():
+    # YAML table catalogue ({name: {description, sql, fields}}) or the JSON written by yaml2wdl
+    catalogue: str
+    # https://cloud.google.com/bigquery/docs/reference/rest/v2/datasets#DatasetReference
+    dataset: dict
+    # Only create these tables from the catalogue (default: all)
+    tables: Optional[List[str]] = None
+    # Maximum concurrent requests
+    threads: int = 8
+
+
+def create_tables(config: CreateTablesConfig):
+    """
+    Creates (or updates) every table of a catalogue concurrently -> tables.json (name -> Table)
+    """
+    catalogue = schema.read_catalogue(config.catalogue)
+    names = config.tables if config.tables is not None else list(catalogue)
+    missing = [name for name in names if name not in catalogue]
+    if missing:
+        raise ValueError("Tables not in catalogue: {}".format(", ".join(missing)))
+
+    client = bigquery.Client()
+    dataset_ref = bigquery.DatasetReference.from_api_repr(config.dataset)
+    actions = {}
+    raw_tables = {}
+
+    def create(name: str):
+        resource = schema.catalogue_table(dataset_ref.project, dataset_ref.dataset_id, name, catalogue[name] or {})
+        action, table, _, _ = evolve_table(client, resource, rebuild=False)
+        LOG.info("%s %s", action, table.table_id)
+        actions[name] = action
+        raw_tables[name] = table.to_api_repr()
+
+    with ThreadPoolExecutor(max_workers=max(1, config.threads), thread_name_prefix="CreateTable") as executor:
+        for future in [executor.submit(create, name) for name in names]:
+            future.result()
+
+    with open('raw_tables.json', 'w') as table_file:
+        json.dump(raw_tables, table_file, indent=2, sort_keys=True)
+
+    # filter invalid keys for Json
+    valid_keys = json.loads(struct_object)['Table']
+    with open('tables.json', 'w') as modified_file:
+        json.dump({name: delete_keys_from_dict(table, valid_keys) for name, table in raw_tables.items()},
+                  modified_file, indent=2, sort_keys=True)
+    with open('create_tables.json', 'w') as actions_file:
+        json.dump(actions, actions_file, indent=2, sort_keys=True)
+
+
 @dataclass_json
 @dataclass
 class CopyTableConfig():
@@ -72,6 +231,8 @@ class CopyTableConfig():
     # Extra configuration options for the job.
     createDisposition: str = "CREATE_IF_NEEDED"
     writeDisposition: str = "WRITE_EMPTY"
+    # Return a job handle (handle.json) as soon as the job is submitted, see wait
+    submitOnly: bool = False
 
 
 def copy_table(config: CopyTableConfig):
@@ -86,8 +247,11 @@ def copy_table(config: CopyTableConfig):
     )
 
     job = client.copy_table(source_tables, dest_table, job_config=job_config)
+    if config.submitOnly:
+        write_job_handles([job])
+        return
     job.result()
-    table = client.get_table(dest_table)
+    table = CACHE.get_table(client, dest_table, max_age=0)
 
     with open('raw_table.json', 'w') as table_file:
         json.dump(table.to_api_repr(), table_file, indent=2, sort_keys=True)
@@ -122,14 +286,16 @@ def create_dataset(config: CreateDatasetConfig):
     client = bigquery.Client()
     dataset = bigquery.Dataset.from_api_repr(config.dataset)
     try:
-        existing_dataset = client.get_dataset(dataset.reference)
+        existing_dataset = CACHE.get_dataset(client, dataset.reference)
         if config.fields is not None:
             modified_dataset = client.update_dataset(
                 dataset, fields=config.fields, timeout=30)
+            CACHE.put(modified_dataset)
             return modified_dataset.to_api_repr()
         if config.drop:
             client.delete_dataset(
                 existing_dataset, not_found_ok=True, delete_contents=True)
+            CACHE.invalidate(existing_dataset)
     except exceptions.NotFound:
         pass
     if(config.storageBillingModel is not None):
@@ -142,6 +308,7 @@ def create_dataset(config: CreateDatasetConfig):
 
     dataset = client.create_dataset(
         dataset, exists_ok=config.existsOk, timeout=30)
+    CACHE.put(dataset)
     with open('raw_dataset.json', 'w') as dataset_file:
         json.dump(dataset.to_api_repr(), dataset_file,
                   indent=2, sort_keys=True)
@@ -170,53 +337,312 @@ def delete_dataset(config: DeleteDatasetConfig):
     dataset_ref = bigquery.DatasetReference.from_api_repr(config.datasetRef)
     client.delete_dataset(dataset_ref, timeout=30, not_found_ok=config.notFoundOk,
                           delete_contents=config.deleteContents)
+    CACHE.invalidate(dataset_ref)
+
+
+@dataclass_json
+@dataclass
+class CloneDatasetConfig():
+    # Source dataset and optional table regex, project:dataset[.regex] (as in wbr backup)
+    source: str
+    # Destination dataset, project:dataset (created in the source location if it doesn't exist)
+    destination: str
+    # COPY (copy jobs), CLONE (zero-copy writable clones) or SNAPSHOT (zero-copy read-only snapshots)
+    mode: str = "COPY"
+    # Overwrite tables and views that already exist in the destination
+    replace: bool = False
+    # Recreate views (pointing at the destination dataset)
+    views: bool = True
+    # Maximum concurrent copy jobs
+    threads: int = 8
+    # Optional expiration of CLONE/SNAPSHOT tables, in days
+    expirationDays: Optional[float] = None
+
+
+def clone_dataset(config: CloneDatasetConfig):
+    """
+    Copies the matching tables of a dataset to another dataset concurrently, then recreates views in
+    dependency order -> dataset.json, clone.json
+    """
+    start = time.monotonic()
+    mode = config.mode.upper()
+    if mode not in datasetcopy.COPY_MODES:
+        raise ValueError("Unsupported mode {}, expected one of {}".format(config.mode, sorted(datasetcopy.COPY_MODES)))
+    project, dataset_id, table_expr = datasetcopy.parse_dataset_expr(config.source)
+    dest_project, dest_dataset_id, _ = datasetcopy.parse_dataset_expr(config.destination)
+
+    client = bigquery.Client()
+    source = CACHE.get_dataset(client, bigquery.DatasetReference(project, dataset_id))
+    target = bigquery.Dataset(bigquery.DatasetReference(dest_project, dest_dataset_id))
+    target.location = source.location
+    target.description = source.description
+    target.labels = source.labels
+    target = client.create_dataset(target, exists_ok=True, timeout=30)
+
+    items = datasetcopy.matching_tables(client, source.reference, table_expr)
+    tasks = []
+    skipped = []
+    views = {}
+    for item in items:
+        destination = target.reference.table(item.table_id)
+        if item.table_type in datasetcopy.DATA_TYPES:
+            tasks.append((item.table_id, lambda item=item, destination=destination: datasetcopy.copy_table(
+                client, item.reference, destination, mode, config.replace, source.location, config.expirationDays)))
+        elif item.table_type == "VIEW" and config.views:
+            views[item.table_id] = CACHE.get_table(client, item.reference)
+        else:
+            skipped.append({"table": item.table_id, "type": item.table_type})
+    # Order the views first, so circular references fail before anything is copied
+    view_levels = datasetcopy.view_order({view_id: view.view_query for view_id, view in views.items()},
+                                         source.reference)
+    LOG.info("Copying %d tables from %s to %s (%s)", len(tasks), source.dataset_id, target.dataset_id, mode)
+    tables, failures = datasetcopy.run_all(tasks, config.threads, "CloneTable")
+
+    created_views = []
+    for level in view_levels:
+        results, level_failures = datasetcopy.run_all(
+            [(view_id, lambda view_id=view_id: datasetcopy.create_view(
+                client, views[view_id], target.reference.table(view_id), source.reference, config.replace))
+             for view_id in level], config.threads, "CloneView")
+        created_views.extend(results)
+        failures.extend(level_failures)
+
+    report = {
+        "source": "{}:{}".format(source.project, source.dataset_id),
+        "destination": "{}:{}".format(target.project, target.dataset_id),
+        "tableExpr": table_expr,
+        "mode": mode,
+        "tables": sorted(tables, key=lambda t: t["table"]),
+        "views": created_views,
+        "viewOrder": view_levels,
+        "skipped": skipped,
+        "failures": failures,
+        "seconds": round(time.monotonic() - start, 3),
+    }
+    with open('clone.json', 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+
+    with open('raw_dataset.json', 'w') as dataset_file:
+        json.dump(CACHE.get_dataset(client, target.reference, max_age=0).to_api_repr(), dataset_file, indent=2,
+                  sort_keys=True)
+    modified_json = valid_object('raw_dataset.json', 'Dataset')
+    with open('dataset.json', 'w') as modified_file:
+        json.dump(modified_json, modified_file, indent=2, sort_keys=True)
+
+    if failures:
+        raise Exception("Failed to clone {} table(s): {}".format(
+            len(failures), ", ".join(f["table"] for f in failures)))
+
+
+@dataclass_json
+@dataclass
+class SyncDatasetConfig():
+    # Source dataset and optional table regex, project:dataset[.regex] (as in wbr backup)
+    source: str
+    # Destination dataset, project:dataset (created in the source location if it doesn't exist)
+    destination: str
+    # COPY (copy jobs) or CLONE (zero-copy writable clones)
+    mode: str = "COPY"
+    # Drop matching destination tables that no longer exist in the source
+    dropMissing: bool = False
+    # Only report the differences
+    dryRun: bool = False
+    # Maximum concurrent metadata requests and copy jobs
+    threads: int = 8
+
+
+def sync_dataset(config: SyncDatasetConfig):
+    """
+    Copies only the tables that differ (modified time, rows, bytes or schema) from a source dataset to a
+    destination dataset -> sync.json
+    """
+    start = time.monotonic()
+    mode = config.mode.upper()
+    if mode not in ("COPY", "CLONE"):
+        raise ValueError("Unsupported mode {}, expected COPY or CLONE".format(config.mode))
+    project, dataset_id, table_expr = datasetcopy.parse_dataset_expr(config.source)
+    dest_project, dest_dataset_id, _ = datasetcopy.parse_dataset_expr(config.destination)
+
+    client = bigquery.Client()
+    source = CACHE.get_dataset(client, bigquery.DatasetReference(project, dataset_id))
+    target = bigquery.Dataset(bigquery.DatasetReference(dest_project, dest_dataset_id))
+    target.location = source.location
+    if not config.dryRun:
+        target = client.create_dataset(target, exists_ok=True, timeout=30)
+
+    # Only data tables are compared, views are left to clone_dataset
+    source_items = {item.table_id: item for item in datasetcopy.matching_tables(client, source.reference, table_expr)
+                    if item.table_type in datasetcopy.DATA_TYPES}
+    try:
+        target_items = {item.table_id: item for item in
+                        datasetcopy.matching_tables(client, target.reference, table_expr)
+                        if item.table_type in datasetcopy.DATA_TYPES}
+    except exceptions.NotFound:
+        target_items = {}
+    list_seconds = time.monotonic() - start
+
+    # list_tables() has no row counts, sizes or schemas, so fetch both sides concurrently
+    compare_start = time.monotonic()
+
+    def compare(table_id: str) -> dict:
+        source_table = CACHE.get_table(client, source_items[table_id].reference)
+        target_table = CACHE.get_table(client, target_items[table_id].reference) if table_id in target_items else None
+        return {"table": table_id, "reasons": datasetcopy.table_diff(source_table, target_table)}
+
+    diffs, failures = datasetcopy.run_all([(table_id, lambda table_id=table_id: compare(table_id))
+                                           for table_id in sorted(source_items)], config.threads, "SyncCompare")
+    changed = [diff["table"] for diff in diffs if diff["reasons"]]
+    missing = sorted(set(target_items) - set(source_items)) if config.dropMissing else []
+    compare_seconds = time.monotonic() - compare_start
+
+    copy_start = time.monotonic()
+    copies, dropped = [], []
+    if not config.dryRun:
+        copies, copy_failures = datasetcopy.run_all(
+            [(table_id, lambda table_id=table_id: datasetcopy.copy_table(
+                client, source_items[table_id].reference, target.reference.table(table_id), mode, True,
+                source.location)) for table_id in changed], config.threads, "SyncTable")
+        failures.extend(copy_failures)
+        for table_id in missing:
+            client.delete_table(target_items[table_id].reference, not_found_ok=True)
+            CACHE.invalidate(target_items[table_id].reference)
+            dropped.append(table_id)
+    copy_seconds = time.monotonic() - copy_start
+
+    report = {
+        "source": "{}:{}".format(source.project, source.dataset_id),
+        "destination": "{}:{}".format(target.project, target.dataset_id),
+        "tableExpr": table_expr,
+        "mode": mode,
+        "dryRun": config.dryRun,
+        "changed": {diff["table"]: diff["reasons"] for diff in diffs if diff["reasons"]},
+        "unchanged": sorted(diff["table"] for diff in diffs if not diff["reasons"]),
+        "missingFromSource": missing,
+        "copied": sorted(copies, key=lambda c: c["table"]),
+        "dropped": dropped,
+        "failures": failures,
+        "timings": {
+            "listSeconds": round(list_seconds, 3),
+            "compareSeconds": round(compare_seconds, 3),
+            "copySeconds": round(copy_seconds, 3),
+            "totalSeconds": round(time.monotonic() - start, 3),
+        },
+    }
+    with open('sync.json', 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+
+    if failures:
+        raise Exception("Failed to sync {} table(s): {}".format(
+            len(failures), ", ".join(f["table"] for f in failures)))
 
 
 @dataclass_json
 @dataclass
 class ExtractTableConfig():
     # https://cloud.google.com/bigquery/docs/reference/rest/v2/Job#jobconfigurationextract
-    # table to extract from
-    sourceTable: dict
     # destination bucket to place the extract files
     destinationUri: str
-    # Name of the destination file
-    fileName: str
     # file format that the extract should be
     fileFormat: str
     # location of the source table
     location: str
+    # table to extract from
+    sourceTable: Optional[dict] = None
+    # Name of the destination file (defaults to project.dataset.table.ext)
+    fileName: Optional[str] = None
+    # tables to extract from (each to project.dataset.table.ext), extracted concurrently
+    sourceTables: Optional[List[dict]] = None
+    # Add -* to the default file name of tables too large to extract to a single file (an explicit fileName is
+    # used as given)
+    autoShard: bool = True
+    # Number of extract jobs to run concurrently
+    threads: int = 8
+    # Return job handles (handle.json) as soon as the jobs are submitted, see wait
+    submitOnly: bool = False
+
+
+# File extension for each extract destination format
+EXTRACT_EXTENSIONS = {"CSV": ".csv", "NEWLINE_DELIMITED_JSON": ".json", "AVRO": ".avro", "PARQUET": ".parquet"}
+
+# Tables larger than this (1GB) can only be extracted to a wildcard URI
+EXTRACT_SHARD_BYTES = 1000000000
+
+
+def extract_uri(config: ExtractTableConfig, table: bigquery.Table, file_name: Optional[str] = None) -> str:
+    """
+    Destination URI of a table extract. A default file name is sharded with -* if the table is too large for
+    one file, an explicit file_name is used as given.
+    """
+    if file_name is not None:
+        return config.destinationUri + "/" + file_name
+    file_name = "{}.{}.{}{}".format(table.project, table.dataset_id, table.table_id,
+                                    EXTRACT_EXTENSIONS.get(config.fileFormat.upper(), ""))
+    if config.autoShard and (table.num_bytes or 0) > EXTRACT_SHARD_BYTES:
+        root, extension = os.path.splitext(file_name)
+        file_name = root + "-*" + extension
+    return config.destinationUri + "/" + file_name
 
 
 def extract_table(config: ExtractTableConfig):
+    """
+    Extracts one or more tables to GCS -> job.json (combined if several tables), manifest.json
+    """
+    if config.sourceTable is None and not config.sourceTables:
+        raise Exception("sourceTable or sourceTables is required")
+
     client = bigquery.Client()
 
-    destination_uri = config.destinationUri + "/" + config.fileName
-    table = bigquery.Table.from_api_repr(config.sourceTable)
+    extracts = []
+    if config.sourceTable is not None:
+        extracts.append((bigquery.Table.from_api_repr(config.sourceTable), config.fileName))
+    for source_table in config.sourceTables or []:
+        extracts.append((bigquery.Table.from_api_repr(source_table), None))
 
     job_config = bigquery.ExtractJobConfig(
         destination_format=config.fileFormat)
 
-    extract_job = client.extract_table(
-        table,
-        destination_uri,
-        job_config=job_config,
-        location=config.location,
-    )
-    extract_job.result()
-
-    # Call the Job REST API, as query_job.to_api_repr() is missing statistics
-    extra_params = {"projection": "full"}
-    path = "/projects/{}/jobs/{}".format(extract_job.project,
-                                         extract_job.job_id)
-    span_attributes = {
-        "path": path, "job_id": extract_job.job_id, "location": extract_job.location}
-    job_result = client._call_api(retry=DEFAULT_RETRY, span_name="BigQuery.getJob",
-                                  span_attributes=span_attributes, method="GET", path=path, query_params=extra_params)
+    def extract(table: bigquery.Table, file_name: Optional[str]):
+        if config.autoShard and file_name is None:
+            # The size in a Table struct may be stale, or missing for a TableReference
+            table = CACHE.get_table(client, table)
+        destination_uri = extract_uri(config, table, file_name)
+        extract_job = client.extract_table(
+            table,
+            destination_uri,
+            job_config=job_config,
+            location=config.location,
+        )
+        return table, destination_uri, extract_job if config.submitOnly else extract_job.result()
+
+    with ThreadPoolExecutor(max_workers=config.threads, thread_name_prefix="ExtractJob") as executor:
+        futures = [executor.submit(extract, table, file_name) for table, file_name in extracts]
+        results = [future.result() for future in futures]
+
+    if config.submitOnly:
+        write_job_handles([extract_job for _, _, extract_job in results])
+        with open('manifest.json', 'w') as manifest_file:
+            json.dump([{"table": table.reference.to_api_repr(), "destinationUri": destination_uri,
+                        "jobId": extract_job.job_id} for table, destination_uri, extract_job in results],
+                      manifest_file, indent=2, sort_keys=True)
+        return
+
+    job_results = [get_job_resource(client, extract_job) for _, _, extract_job in results]
+    manifest = []
+    for (table, destination_uri, _), job_result in zip(results, job_results):
+        manifest.append({
+            "table": table.reference.to_api_repr(),
+            "destinationUri": destination_uri,
+            "jobId": job_result["jobReference"]["jobId"],
+            "destinationUriFileCounts": job_result.get("statistics", {}).get("extract", {}).get(
+                "destinationUriFileCounts"),
+        })
 
     # Write job information to job.json
     with open('job.json', 'w') as job_result_file:
-        json.dump(job_result, job_result_file, indent=2, sort_keys=True)
+        json.dump(aggregate_jobs(job_results), job_result_file, indent=2, sort_keys=True)
+
+    with open('manifest.json', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
 
 
 @dataclass_json
@@ -254,33 +680,321 @@ class LoadTableConfig():
     autodetect: Optional[bool] = None
     # Location of where to run the job, must be same as destination table, defaults to US
     location: str = "US"
+    # Maximum number of source URIs per load job, listings larger than this are split across several jobs.
+    # Without a sourceDelimiter the prefix is loaded with a single gs://sourceBucket/sourcePrefix* wildcard URI,
+    # which BigQuery expands itself, so no listing is made and this limit does not apply
+    maxUrisPerJob: int = 10000
+    # Number of load jobs to run concurrently when a listing is split
+    threads: int = 8
+    # Convert a local CSV sourceFile to compressed Parquet (typed using schemaFields) before uploading
+    convertToParquet: bool = False
+    # Parquet compression codec [ SNAPPY | GZIP | ZSTD ]
+    parquetCompression: str = "SNAPPY"
+    # Validate a local sourceFile against schemaFields before uploading (see validate_load)
+    validate: bool = False
+    # Number of bad rows to report when validating
+    maxBadRows: int = 10
+    # gs:// URI of a manifest of objects already loaded from sourceBucket/sourcePrefix, if set only new objects
+    # (by name, generation and crc32c) are appended and the manifest is updated afterwards. If an object that
+    # was already loaded has changed, the whole prefix is reloaded with WRITE_TRUNCATE
+    manifestUri: Optional[str] = None
+    # Return job handles (handle.json) as soon as the load jobs are submitted, see wait
+    submitOnly: bool = False
 
 # get files from bucket/folder
 
 
-def get_bucketfiles(bucketName, sourcePrefix, sourceDelimiter) -> List[str]:
-    importUris: List[str] = []
+def get_bucketblobs(bucketName, sourcePrefix, sourceDelimiter) -> List[storage.Blob]:
     storageClient = storage.Client()
     bucket = storageClient.get_bucket(bucketName)
-    blobs = bucket.list_blobs(prefix=sourcePrefix, delimiter=sourceDelimiter)
+    return list(bucket.list_blobs(prefix=sourcePrefix, delimiter=sourceDelimiter))
+
+
+def get_bucketfiles(bucketName, sourcePrefix, sourceDelimiter) -> List[str]:
+    importUris: List[str] = []
     blob: storage.Blob
-    for blob in blobs:
+    for blob in get_bucketblobs(bucketName, sourcePrefix, sourceDelimiter):
         importUris.append(f"gs://{blob.bucket.name}/{blob.name}")
     return importUris
 
 
+def read_manifest(client: storage.Client, manifest_uri: str):
+    """
+    Reads a load manifest {objects: {name: {generation, crc32c}}}, returning it with the generation of the
+    manifest object (0 if it doesn't exist yet) so it can only be replaced if nobody else has changed it
+    """
+    blob = storage.Blob.from_string(manifest_uri, client)
+    try:
+        blob.reload()
+    except exceptions.NotFound:
+        return {"objects": {}}, 0
+    manifest = json.loads(blob.download_as_bytes(if_generation_match=blob.generation))
+    return manifest, blob.generation
+
+
+def write_manifest(client: storage.Client, manifest_uri: str, manifest: dict, generation: int) -> int:
+    """
+    Replaces the load manifest, failing if it was changed since it was read (generation precondition).
+    Returns the generation of the new manifest.
+    """
+    blob = storage.Blob.from_string(manifest_uri, client)
+    try:
+        blob.upload_from_string(json.dumps(manifest, indent=2, sort_keys=True), content_type="application/json",
+                                if_generation_match=generation)
+    except exceptions.PreconditionFailed:
+        raise Exception("Manifest {} was changed by another load, run again to load what is left".format(
+            manifest_uri))
+    return blob.generation
+
+
+def pending_blobs(manifest: dict, blobs: List[storage.Blob]) -> List[storage.Blob]:
+    """
+    Objects that are new, or have changed, since they were recorded in the manifest
+    """
+    loaded = manifest.get("objects", {})
+    return [blob for blob in blobs
+            if blob.name not in loaded
+            or loaded[blob.name].get("generation") != str(blob.generation)
+            or loaded[blob.name].get("crc32c") != blob.crc32c]
+
+
+def changed_blobs(manifest: dict, blobs: List[storage.Blob]) -> List[storage.Blob]:
+    """
+    Objects recorded in the manifest that have since been replaced (new generation or content)
+    """
+    loaded = manifest.get("objects", {})
+    return [blob for blob in pending_blobs(manifest, blobs) if blob.name in loaded]
+
+
+def load_incremental(client: bigquery.Client, config: "LoadTableConfig", table_ref: bigquery.TableReference,
+                     job_config: bigquery.LoadJobConfig) -> Optional[List[bigquery.LoadJob]]:
+    """
+    Loads the objects of sourceBucket/sourcePrefix that are not yet recorded in the manifest, returns None when
+    there is nothing new to load.
+    New objects are appended. If an object that was already loaded has changed, appending it would keep its old
+    rows as well, so every object is reloaded with WRITE_TRUNCATE instead. The manifest is claimed (rewritten with
+    a generation precondition) before loading, so concurrent runs fail instead of loading the same objects, and
+    a run whose result was never recorded stops the next one rather than letting it load the objects again.
+    """
+    storage_client = storage.Client()
+    manifest, generation = read_manifest(storage_client, config.manifestUri)
+    if manifest.get("loading"):
+        raise Exception("Manifest {} records a load of {} objects started {} that did not complete. It may still be "
+                        "running, or may have loaded them: check {} and remove 'loading' from the manifest to "
+                        "continue".format(config.manifestUri, len(manifest["loading"]["objects"]),
+                                          manifest["loading"]["started"], table_ref))
+
+    blobs = get_bucketblobs(config.sourceBucket, config.sourcePrefix, config.sourceDelimiter)
+    pending = pending_blobs(manifest, blobs)
+    changed = changed_blobs(manifest, blobs)
+    objects = dict(manifest["objects"])
+    if changed:
+        LOG.warning("%s objects changed since they were loaded (eg. %s), reloading all %s objects into %s",
+                    len(changed), changed[0].name, len(blobs), table_ref)
+        pending = blobs
+        objects = {}
+        job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+    elif objects:
+        # Earlier loads are already in the table
+        job_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+    LOG.info("%s new or changed objects to load from gs://%s/%s", len(pending), config.sourceBucket,
+             config.sourcePrefix)
+    if not pending:
+        return None
+
+    manifest["loading"] = {"objects": [blob.name for blob in pending],
+                           "started": datetime.now(timezone.utc).isoformat(timespec='seconds')}
+    claimed = write_manifest(storage_client, config.manifestUri, manifest, generation)
+    del manifest["loading"]
+    try:
+        load_jobs = load_uris(client, [f"gs://{blob.bucket.name}/{blob.name}" for blob in pending], table_ref,
+                              job_config, config.location, config.maxUrisPerJob, config.threads)
+    except Exception:
+        # Nothing was loaded (load jobs and the staged copy are atomic), so the claim can be released
+        try:
+            write_manifest(storage_client, config.manifestUri, manifest, claimed)
+        except Exception as ex:
+            LOG.warning("Could not release manifest %s: %s", config.manifestUri, ex)
+        raise
+
+    # Only record the objects once their load jobs have succeeded
+    for blob in pending:
+        objects[blob.name] = {"generation": str(blob.generation), "crc32c": blob.crc32c, "size": blob.size}
+    manifest["objects"] = objects
+    manifest["source"] = "gs://{}/{}".format(config.sourceBucket, config.sourcePrefix)
+    manifest["destination"] = table_ref.to_api_repr()
+    write_manifest(storage_client, config.manifestUri, manifest, claimed)
+    return load_jobs
+
+
+def load_uris(client: bigquery.Client, uris: List[str], table_ref: bigquery.TableReference,
+              job_config: bigquery.LoadJobConfig, location: str, batch_size: int, threads: int,
+              submit_only: bool = False) -> List[bigquery.LoadJob]:
+    """
+    Loads a list of URIs using as many load jobs as needed to stay under the per-job URI limit.
+    A single batch is loaded straight into the table. Several batches are loaded concurrently into a staging
+    table (partitioned and clustered like an existing destination) that is then copied over the destination with
+    the requested dispositions, so the destination is never left partly loaded (a failed batch leaves it as it was).
+    """
+    batches = [uris[i:i + batch_size] for i in range(0, len(uris), batch_size)]
+    if submit_only and len(batches) > 1:
+        raise ValueError("submitOnly needs a single load job, {} URIs is more than maxUrisPerJob".format(len(uris)))
+    if len(batches) == 1:
+        job = client.load_table_from_uri(batches[0], table_ref, job_config=job_config, location=location)
+        return [job] if submit_only else [job.result()]
+
+    staging_ref = bigquery.TableReference(
+        bigquery.DatasetReference(table_ref.project, table_ref.dataset_id),
+        "_load_{}_{}".format(table_ref.table_id, uuid.uuid4().hex[:12]))
+    LOG.info("Loading %s URIs into %s using %s load jobs, staged in %s", len(uris), table_ref, len(batches),
+             staging_ref.table_id)
+    # The first batch creates the staging table (and its schema when autodetecting), the rest append to it
+    first_config = bigquery.LoadJobConfig.from_api_repr(job_config.to_api_repr())
+    first_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+    first_config.create_disposition = bigquery.CreateDisposition.CREATE_IF_NEEDED
+    try:
+        destination = CACHE.get_table(client, table_ref)
+    except exceptions.NotFound:
+        destination = None
+    if destination is not None:
+        # Copying into an existing table needs the same partitioning and clustering
+        if destination.time_partitioning is not None:
+            first_config.time_partitioning = destination.time_partitioning
+        if destination.range_partitioning is not None:
+            first_config.range_partitioning = destination.range_partitioning
+        if destination.clustering_fields:
+            first_config.clustering_fields = destination.clustering_fields
+    append_config = bigquery.LoadJobConfig.from_api_repr(job_config.to_api_repr())
+    append_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+    append_config.create_disposition = bigquery.CreateDisposition.CREATE_NEVER
+
+    def load_batch(batch: List[str]) -> bigquery.LoadJob:
+        return client.load_table_from_uri(batch, staging_ref, job_config=append_config, location=location).result()
+
+    try:
+        jobs = [client.load_table_from_uri(batches[0], staging_ref, job_config=first_config,
+                                           location=location).result()]
+        staging_table = client.get_table(staging_ref)
+        # In case the load fails part way, the staging table expires on its own
+        staging_table.expires = datetime.now(timezone.utc) + timedelta(days=1)
+        client.update_table(staging_table, ["expires"])
+
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="LoadJob") as executor:
+            futures = [executor.submit(load_batch, batch) for batch in batches[1:]]
+            jobs.extend(future.result() for future in futures)
+
+        # A copy job replaces or appends to the destination atomically
+        copy_config = bigquery.CopyJobConfig(create_disposition=job_config.create_disposition,
+                                             write_disposition=job_config.write_disposition)
+        client.copy_table(staging_ref, table_ref, job_config=copy_config, location=location).result()
+        CACHE.invalidate(table_ref)
+    finally:
+        client.delete_table(staging_ref, not_found_ok=True)
+    return jobs
+
+
+def aggregate_jobs(job_results: List[dict]) -> dict:
+    """
+    Combines several full job resources into one, summing the numeric statistics.
+    A single job is returned as-is, otherwise the individual resources are kept in 'jobs'.
+    """
+    if len(job_results) == 0:
+        return {}
+    if len(job_results) == 1:
+        return job_results[0]
+
+    combined = json.loads(json.dumps(job_results[0]))
+    statistics = combined.setdefault('statistics', {})
+    job_type = next((t for t in ("load", "extract", "copy", "query") if t in statistics), None)
+    for job_result in job_results[1:]:
+        other = job_result.get('statistics', {})
+        statistics['startTime'] = str(min(int(statistics.get('startTime', 0)), int(other.get('startTime', 0))))
+        statistics['endTime'] = str(max(int(statistics.get('endTime', 0)), int(other.get('endTime', 0))))
+        for key in ('totalSlotMs', 'totalBytesProcessed'):
+            if key in other:
+                statistics[key] = str(int(statistics.get(key, 0)) + int(other[key]))
+        if job_type is not None:
+            for key, value in other.get(job_type, {}).items():
+                if isinstance(value, str) and value.isdigit():
+                    statistics[job_type][key] = str(int(statistics[job_type].get(key, 0)) + int(value))
+    combined['jobs'] = job_results
+    return combined
+
+
+def validate_load(config: LoadTableConfig) -> dict:
+    """
+    Validates a local CSV/NDJSON sourceFile against schemaFields -> validation.json
+    """
+    if config.sourceFile is None or config.schemaFields is None:
+        raise Exception("Validation requires a sourceFile and schemaFields")
+
+    # Same null stripping as load_table, as WDL adds 'null' for every unspecified struct member
+    schema_fields = remap(config.schemaFields, visit=lambda p, k, v: v is not None)
+    if config.format.lower() == "csv":
+        report = validate_csv(config.sourceFile, schema_fields, skip_leading_rows=config.skipLeadingRows,
+                              field_delimiter=config.fieldDelimiter, quote_character=config.quoteCharacter,
+                              max_bad_rows=config.maxBadRows)
+    elif config.format.upper() == "NEWLINE_DELIMITED_JSON":
+        report = validate_json(config.sourceFile, schema_fields, max_bad_rows=config.maxBadRows)
+    else:
+        raise Exception("Validation only supports CSV and NEWLINE_DELIMITED_JSON, not {}".format(config.format))
+
+    with open('validation.json', 'w') as validation_file:
+        json.dump(report, validation_file, indent=2, sort_keys=True)
+    return report
+
+
 def load_table(config: LoadTableConfig):
 
     if not config.sourceFile and not config.sourceUris and not config.sourceBucket and not config.sourcePrefix:
         raise Exception("Loading source is required")
+    if config.submitOnly and config.manifestUri is not None:
+        raise ValueError("submitOnly can't be combined with manifestUri, the manifest is updated after the load")
+
+    local_source = config.sourceUris is None and (config.sourceBucket is None or config.sourcePrefix is None)
+    if config.validate and local_source:
+        report = validate_load(config)
+        if not report["valid"]:
+            raise Exception("{} has {} bad rows, see validation.json".format(config.sourceFile, report["badRowCount"]))
 
     client = bigquery.Client()
 
+    schema_fields = None
+    if config.schemaFields is not None:
+        # WDL will force a 'null' value to structs where you didn't even specify a value,
+        # and this breaks from_api_repr() in various ways (eg. expecting [] not None/null)
+        schema_fields = remap(config.schemaFields,
+                              visit=lambda p, k, v: v is not None)
+
+    # Optionally convert a local CSV file to Parquet, which uploads and loads faster than CSV text
+    source_file = config.sourceFile
+    source_format = config.format
+    conversion = None
+    if config.convertToParquet and local_source and source_file is not None and source_format.lower() == "csv":
+        if parquet_compatible(schema_fields):
+            fd, parquet_file = tempfile.mkstemp(suffix=".parquet", dir=".")
+            os.close(fd)
+            try:
+                conversion = csv_to_parquet(config.sourceFile, parquet_file, schema_fields,
+                                            skip_leading_rows=config.skipLeadingRows,
+                                            field_delimiter=config.fieldDelimiter,
+                                            quote_character=config.quoteCharacter,
+                                            compression=config.parquetCompression)
+                source_file = parquet_file
+                source_format = "PARQUET"
+            except ArrowInvalid as ex:
+                # BigQuery may still accept values Arrow can't parse (eg. time zone names)
+                os.remove(parquet_file)
+                LOG.warning("Could not convert %s to Parquet, loading as CSV: %s", source_file, ex)
+        else:
+            LOG.warning("%s has no schemaFields, or types that can't be converted to Parquet, loading as CSV",
+                        source_file)
+
     job_config = bigquery.LoadJobConfig()
-    job_config.source_format = config.format
+    job_config.source_format = source_format
 
     # Only CSV has config for field delimiter, quote character and skip leading row
-    if config.format.lower() == "csv":
+    if source_format.lower() == "csv":
         job_config.field_delimiter = config.fieldDelimiter
         job_config.quote_character = config.quoteCharacter
         job_config.skip_leading_rows = config.skipLeadingRows
@@ -288,13 +1002,9 @@ def load_table(config: LoadTableConfig):
     job_config.write_disposition = config.writeDisposition
     job_config.create_disposition = config.createDisposition
 
-    if config.schemaFields is not None:
+    if schema_fields is not None:
         fields: List[bigquery.SchemaField] = []
-        # WDL will force a 'null' value to structs where you didn't even specify a value,
-        # and this breaks from_api_repr() in various ways (eg. expecting [] not None/null)
-        schemaFields = remap(config.schemaFields,
-                             visit=lambda p, k, v: v is not None)
-        for schema in schemaFields:
+        for schema in schema_fields:
             fields.append(bigquery.SchemaField.from_api_repr(schema))
         job_config.schema = fields
 
@@ -311,39 +1021,69 @@ def load_table(config: LoadTableConfig):
                                               job_config=job_config,
                                               location=config.location,
                                               )
+        load_jobs = [load_job]
     else:
         # get Uris from bucket folder for multiple file loading
         if config.sourceBucket is not None and config.sourcePrefix is not None:
-            importUris = get_bucketfiles(
-                config.sourceBucket, config.sourcePrefix, config.sourceDelimiter)
-
-            # for fileUri in importUris:
-            load_job = client.load_table_from_uri(importUris,
-                                                  table_ref,
-                                                  job_config=job_config,
-                                                  location=config.location,
-                                                  )
+            if config.manifestUri is not None:
+                # Incremental load, only objects not already recorded in the manifest are loaded
+                load_jobs = load_incremental(client, config, table_ref, job_config)
+            else:
+                if config.sourceDelimiter is None:
+                    # Without a delimiter the listing is recursive, which is exactly what a wildcard matches
+                    importUris = ["gs://{}/{}*".format(config.sourceBucket, config.sourcePrefix)]
+                else:
+                    importUris = get_bucketfiles(
+                        config.sourceBucket, config.sourcePrefix, config.sourceDelimiter)
+                load_jobs = None
+                if importUris:
+                    load_jobs = load_uris(client, importUris, table_ref, job_config, config.location,
+                                          config.maxUrisPerJob, config.threads, config.submitOnly)
         else:
             # https://cloud.google.com/bigquery/docs/samples/bigquery-load-table-gcs-csv
             # loading from a local file
-            if config.sourceFile is not None:
-                with open(config.sourceFile, 'rb') as source_file:
-                    load_job = client.load_table_from_file(source_file,
-                                                           table_ref,
-                                                           job_config=job_config, rewind=True,
-                                                           location=config.location,
-                                                           )
-
-    load_job.result()
-
-    # Call the Job REST API, as query_job.to_api_repr() is missing statistics
-    extra_params = {"projection": "full"}
-    path = "/projects/{}/jobs/{}".format(load_job.project,
-                                         load_job.job_id)
-    span_attributes = {
-        "path": path, "job_id": load_job.job_id, "location": load_job.location}
-    job_result = client._call_api(retry=DEFAULT_RETRY, span_name="BigQuery.getJob",
-                                  span_attributes=span_attributes, method="GET", path=path, query_params=extra_params)
+            if source_file is not None:
+                load_start = time.monotonic()
+                try:
+                    with open(source_file, 'rb') as source:
+                        load_job = client.load_table_from_file(source,
+                                                               table_ref,
+                                                               job_config=job_config, rewind=True,
+                                                               location=config.location,
+                                                               )
+                    # The upload itself is synchronous, only the load job is left running with submitOnly
+                    if not config.submitOnly:
+                        load_job.result()
+                finally:
+                    if conversion is not None:
+                        # The temporary Parquet file, also when the upload or load fails
+                        os.remove(source_file)
+                load_jobs = [load_job]
+                if conversion is not None:
+                    # Upload + load time, to compare with loading the CSV directly
+                    conversion["loadSeconds"] = round(time.monotonic() - load_start, 3)
+                    conversion["totalSeconds"] = round(conversion["conversionSeconds"] + conversion["loadSeconds"], 3)
+                    with open('conversion.json', 'w') as conversion_file:
+                        json.dump(conversion, conversion_file, indent=2, sort_keys=True)
+
+    if load_jobs is None:
+        # No load job ran, so there are no statistics and the destination may not even exist yet
+        LOG.info("Nothing to load into %s", table_ref)
+        if config.submitOnly:
+            write_job_handles([])
+            return
+        with open('job.json', 'w') as job_result_file:
+            json.dump({}, job_result_file, indent=2, sort_keys=True)
+        with open('table.json', 'w') as dest_table_file:
+            json.dump({"tableReference": table_ref.to_api_repr()}, dest_table_file, indent=2, sort_keys=True)
+        return
+
+    if config.submitOnly:
+        write_job_handles(load_jobs)
+        return
+    load_jobs = [job.result() for job in load_jobs]
+
+    job_result = aggregate_jobs([get_job_resource(client, job) for job in load_jobs])
 
     # Write job information to job.json
     with open('job.json', 'w') as job_result_file:
@@ -352,7 +1092,7 @@ def load_table(config: LoadTableConfig):
     # Write the destination table to table.json
     with open('raw_table.json', 'w') as dest_table_file:
         # If no destination, this will be a BQ temp table
-        table_info = client.get_table(table_ref)
+        table_info = CACHE.get_table(client, table_ref, max_age=0)
         json.dump(table_info.to_api_repr(),
                   dest_table_file, indent=2, sort_keys=True)
         
@@ -361,6 +1101,42 @@ def load_table(config: LoadTableConfig):
     with open('table.json', 'w') as modified_file:
         json.dump(modified_json, modified_file, indent=2, sort_keys=True)
 
+@dataclass_json
+@dataclass
+class ReadTableConfig():
+    # Table to read (TableReference)
+    table: dict
+    # Columns to read (default: all)
+    columns: Optional[List[str]] = None
+    # SQL boolean expression used to filter rows, eg. "state = 'CA'"
+    rowFilter: Optional[str] = None
+    # Maximum number of streams to read in parallel (the server may create fewer)
+    streams: int = 4
+    # Output format [ PARQUET | CSV | ARROW ]
+    format: str = "PARQUET"
+    # Write a single file instead of one file per stream
+    merge: bool = False
+    # Output files are named <outputPrefix>-00000.parquet, ... (or <outputPrefix>.parquet when merged)
+    outputPrefix: str = "rows"
+
+
+def read_table(config: ReadTableConfig, read_client: Optional[BigQueryReadClient] = None):
+    """
+    Reads a table with the BigQuery Storage Read API into local files -> read_table.json
+    """
+    if read_client is None:
+        read_client = BigQueryReadClient()
+    table_ref = bigquery.TableReference.from_api_repr(config.table)
+    billing_project = os.environ.get('GCP_PROJECT') or bigquery.Client().project
+
+    session = create_session(read_client, billing_project, table_ref, config.columns, config.rowFilter,
+                             config.streams)
+    result = read_session(read_client, session, config.outputPrefix, config.format, config.merge)
+
+    with open('read_table.json', 'w') as result_file:
+        json.dump(result, result_file, indent=2, sort_keys=True)
+
+
 @dataclass_json
 @dataclass
 class QueryConfig():
@@ -388,15 +1164,118 @@ class QueryConfig():
     useQueryCache: bool = True
     delimiter: str = ","
     header: bool = True
+    # Fail if the query contains {placeholders} with no replacement or dependency value
+    strict: bool = False
+    # Write a query plan profile of the job to profile.json and profile.txt
+    profile: bool = False
+    # Export the result straight to GCS files instead of retrieving rows (eg. gs://bucket/path/ or gs://bucket/path/part-*.csv)
+    exportUri: Optional[str] = None
+    # Export file format [ CSV | JSON | AVRO | PARQUET ]
+    exportFormat: str = "CSV"
+    # Export compression, eg. GZIP (CSV, JSON, PARQUET), SNAPPY (AVRO, PARQUET), DEFLATE (AVRO), ZSTD (PARQUET)
+    exportCompression: Optional[str] = None
+    # EXPORT_DATA wraps the query in an EXPORT DATA statement, EXTRACT runs the query then extracts its result
+    # table (use EXTRACT for scripts, or to keep a destination table)
+    exportMethod: str = "EXPORT_DATA"
+    # Rewrite only these partitions of the destination (eg. 20240131), one WRITE_TRUNCATE job per partition.
+    # The query can use {partition} and {partition_date} (2024-01-31) to select the rows of each partition.
+    # The destination must be partitioned (timePartitioning or rangePartitioning, if it is created).
+    partitions: Optional[List[str]] = None
+    # Or daily partitions from partitionStart to partitionEnd inclusive (YYYY-MM-DD)
+    partitionStart: Optional[str] = None
+    partitionEnd: Optional[str] = None
+    # Maximum concurrent partition jobs
+    partitionThreads: int = 8
+    # MERGE: run the query into a temporary table, then MERGE it into the destination on mergeKeys
+    # (matching rows are updated, others inserted)
+    writeMode: Optional[str] = None
+    # Columns that identify a row (NULL keys match each other), MERGE can't be combined with drop
+    mergeKeys: Optional[List[str]] = None
+    # Return a job handle (handle.json) as soon as the query is submitted, see wait
+    submitOnly: bool = False
+
+
+# Export format -> extract job destination format
+EXPORT_FORMATS = {"CSV": "CSV", "JSON": "NEWLINE_DELIMITED_JSON", "AVRO": "AVRO", "PARQUET": "PARQUET"}
+EXPORT_METHODS = {"EXPORT_DATA", "EXTRACT"}
+
+
+def export_destination(config: QueryConfig) -> str:
+    """
+    Wildcard URI for exported files, gs://bucket/path/ becomes gs://bucket/path/*.csv
+    """
+    if "*" in config.exportUri:
+        return config.exportUri
+    extension = EXTRACT_EXTENSIONS[EXPORT_FORMATS[config.exportFormat.upper()]]
+    if config.exportCompression is not None and config.exportCompression.upper() == "GZIP" \
+            and config.exportFormat.upper() in ("CSV", "JSON"):
+        extension += ".gz"
+    return config.exportUri.rstrip("/") + "/*" + extension
 
 
-def query(config: QueryConfig):
+def export_statement(config: QueryConfig, export_uri: str, query: str) -> str:
     """
-    Executes a query, optionally retrieving row data to stdout. 
-    Writes Table to table.json and Job to job.json
+    Wraps a query in an EXPORT DATA statement writing to export_uri
     """
-    client = bigquery.Client()
+    def literal(value: str) -> str:
+        return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+    options = ["uri={}".format(literal(export_uri)),
+               "format={}".format(literal(config.exportFormat.upper())),
+               "overwrite=true"]
+    if config.exportFormat.upper() == "CSV":
+        options.append("header={}".format("true" if config.header else "false"))
+        options.append("field_delimiter={}".format(literal(config.delimiter)))
+    if config.exportCompression is not None:
+        options.append("compression={}".format(literal(config.exportCompression.upper())))
+    # A trailing semicolon would end the statement before the query
+    return "EXPORT DATA OPTIONS({}) AS\n{}".format(", ".join(options), query.strip().rstrip(";"))
+
+
+def exported_uris(export_uri: str, job_result: dict, extract_jobs: List[dict]) -> List[str]:
+    """
+    URIs of the files written by an export, from the file counts in the job statistics (the wildcard is
+    replaced by a 12 digit file number counting from 0)
+    """
+    if extract_jobs:
+        file_count = sum(int(count) for job in extract_jobs
+                         for count in job.get("statistics", {}).get("extract", {}).get("destinationUriFileCounts", []))
+    else:
+        file_count = int(job_result.get("statistics", {}).get("query", {}).get("exportDataStatistics", {})
+                         .get("fileCount", 0))
+    if "*" not in export_uri:
+        return [export_uri] if file_count else []
+    return [export_uri.replace("*", "{:012d}".format(number), 1) for number in range(file_count)]
 
+
+def write_export_manifest(export_uri: str, job_result: dict, extract_jobs: List[dict]):
+    """
+    Lists the files written by the export (not older files under the same prefix) -> export.json
+    """
+    uris = exported_uris(export_uri, job_result, extract_jobs)
+    blob = storage.Blob.from_string(export_uri.partition("*")[0])
+    sizes = {"gs://{}/{}".format(b.bucket.name, b.name): b.size
+             for b in storage.Client().list_blobs(blob.bucket.name, prefix=blob.name)}
+    missing = [uri for uri in uris if uri not in sizes]
+    if missing:
+        LOG.warning("%d exported file(s) not found, eg. %s", len(missing), missing[0])
+    files = [{"uri": uri, "size": sizes[uri]} for uri in uris if uri in sizes]
+    manifest = {
+        "exportUri": export_uri,
+        "jobId": job_result["jobReference"]["jobId"],
+        "extractJobIds": [job["jobReference"]["jobId"] for job in extract_jobs],
+        "fileCount": len(files),
+        "bytes": sum(f["size"] or 0 for f in files),
+        "files": files,
+    }
+    with open('export.json', 'w') as export_file:
+        json.dump(manifest, export_file, indent=2, sort_keys=True)
+
+
+def query_job_config(config: QueryConfig) -> bigquery.QueryJobConfig:
+    """
+    Job configuration for a QueryConfig, apart from the destination
+    """
     job_config = bigquery.QueryJobConfig(
         destination_encryption_configuration=bigquery.EncryptionConfiguration.from_api_repr(
             config.destinationEncryptionConfiguration) if config.destinationEncryptionConfiguration is not None else None,
@@ -414,46 +1293,292 @@ def query(config: QueryConfig):
     if config.labels is not None:
         job_config.labels = config.labels
 
-    if config.destination:
-        destination_table = bigquery.Table.from_api_repr(config.destination)
-        job_config.destination = destination_table
-        job_config.write_disposition = config.writeDisposition
-        job_config.create_disposition = config.createDisposition
-
-        if config.drop:
-            client.delete_table(destination_table, not_found_ok=True)
-            # We create the table ourself, otherwise constraints are seemingly ignored
-            if config.createDisposition == "CREATE_IF_NEEDED":
-                client.create_table(destination_table, exists_ok=True)
-                job_config.write_disposition = "WRITE_APPEND"  # or constraints are lost
-            if config.writeDisposition == "WRITE_APPEND" and config.schemaUpdateOptions:
-                job_config.schema_update_options = config.schemaUpdateOptions
-
     if config.maximumBytesBilled:
         job_config.maximum_bytes_billed = config.maximumBytesBilled
+    return job_config
 
-    # Format the query with replacement values (will NOT error if a replacement found has no value mapped to it)
-    query = config.query
-    if config.replacements is not None:
-        for key, value in config.replacements.items():
-            query = query.replace("{"+key+"}", value)
 
+def query_values(config: QueryConfig) -> dict:
+    """
+    Placeholder values of a query, dependencies (as full table ids) overridden by replacements
+    """
+    values = {}
     if config.dependencies is not None:
         for key, value in config.dependencies.items():
             ref = bigquery.TableReference.from_api_repr(
                 value["tableReference"])
-            query = query.replace(
-                "{"+key+"}", "{}.{}.{}".format(ref.project, ref.dataset_id, ref.table_id))
+            values[key] = "{}.{}.{}".format(ref.project, ref.dataset_id, ref.table_id)
+    if config.replacements is not None:
+        values.update(config.replacements)
+    return values
+
+
+def set_destination(client: bigquery.Client, config: QueryConfig, job_config: bigquery.QueryJobConfig,
+                    destination: dict):
+    """
+    Points a query job at its destination table, dropping and recreating the table first if config.drop is set
+    """
+    destination_table = bigquery.Table.from_api_repr(destination)
+    job_config.destination = destination_table
+    job_config.write_disposition = config.writeDisposition
+    job_config.create_disposition = config.createDisposition
+
+    if config.drop:
+        client.delete_table(destination_table, not_found_ok=True)
+        CACHE.invalidate(destination_table)
+        # We create the table ourself, otherwise constraints are seemingly ignored
+        if config.createDisposition == "CREATE_IF_NEEDED":
+            client.create_table(destination_table, exists_ok=True)
+            job_config.write_disposition = "WRITE_APPEND"  # or constraints are lost
+        if config.writeDisposition == "WRITE_APPEND" and config.schemaUpdateOptions:
+            job_config.schema_update_options = config.schemaUpdateOptions
+
+
+def partition_ids(config: QueryConfig) -> List[str]:
+    """
+    Partition IDs to rewrite, from the partitions list or the partitionStart/partitionEnd date range
+    """
+    if config.partitions:
+        return list(dict.fromkeys(config.partitions))
+    if config.partitionStart is None:
+        return []
+    start = date.fromisoformat(config.partitionStart)
+    end = date.fromisoformat(config.partitionEnd or config.partitionStart)
+    if end < start:
+        raise ValueError("partitionEnd {} is before partitionStart {}".format(end, start))
+    return [(start + timedelta(days=day)).strftime("%Y%m%d") for day in range((end - start).days + 1)]
+
+
+def partition_values(partition_id: str) -> dict:
+    values = {"partition": partition_id}
+    # Daily (YYYYMMDD) and hourly (YYYYMMDDHH) partitions also get the date
+    if len(partition_id) >= 8 and partition_id[:8].isdigit():
+        values["partition_date"] = "{}-{}-{}".format(partition_id[:4], partition_id[4:6], partition_id[6:8])
+    return values
+
+
+def query_partitions(client: bigquery.Client, config: QueryConfig, job_config: bigquery.QueryJobConfig,
+                     template: Template, values: dict, partitions: List[str]):
+    """
+    Runs the query once per partition into the table$partition decorator with WRITE_TRUNCATE, concurrently,
+    so only those partitions are rewritten -> job.json, partitions.json, table.json
+    """
+    destination_table = bigquery.Table.from_api_repr(config.destination)
+    try:
+        existing = CACHE.get_table(client, destination_table.reference, max_age=0)
+    except exceptions.NotFound:
+        if config.createDisposition != "CREATE_IF_NEEDED":
+            raise
+        existing = None
+    partitioned = existing if existing is not None else destination_table
+    if partitioned.time_partitioning is None and partitioned.range_partitioning is None:
+        raise ValueError("Partition rewrites need a partitioned destination, {} is not partitioned{}".format(
+            destination_table.table_id, "" if existing is not None else
+            " (set timePartitioning or rangePartitioning in destination to create it)"))
+    if existing is None:
+        CACHE.put(client.create_table(destination_table, exists_ok=True))
+
+    # Render every variant up front, Template is not shared between threads
+    queries = {}
+    for partition_id in partitions:
+        queries[partition_id] = template.render({**values, **partition_values(partition_id)}, strict=config.strict)
+        if template.unresolved:
+            LOG.warning("Query placeholders with no replacement value: %s", ", ".join(sorted(template.unresolved)))
+
+    def run_partition(partition_id: str) -> dict:
+        start = time.monotonic()
+        partition_config = bigquery.QueryJobConfig.from_api_repr(job_config.to_api_repr())
+        partition_config.destination = bigquery.TableReference(
+            bigquery.DatasetReference(destination_table.project, destination_table.dataset_id),
+            "{}${}".format(destination_table.table_id, partition_id))
+        partition_config.write_disposition = "WRITE_TRUNCATE"
+        partition_config.create_disposition = "CREATE_NEVER"
+        query_job = client.query(queries[partition_id], partition_config)
+        query_job.result()
+        job_result = get_job_resource(client, query_job)
+        statistics = job_result.get("statistics", {})
+        return {
+            "partition": partition_id,
+            "jobId": query_job.job_id,
+            "totalBytesBilled": int(statistics.get("query", {}).get("totalBytesBilled", 0)),
+            "totalSlotMs": int(statistics.get("totalSlotMs", 0)),
+            "seconds": round(time.monotonic() - start, 3),
+            "job": job_result,
+        }
+
+    LOG.info("Rewriting %d partitions of %s", len(partitions), destination_table.table_id)
+    with ThreadPoolExecutor(max_workers=max(1, config.partitionThreads), thread_name_prefix="Partition") as executor:
+        results = list(executor.map(run_partition, partitions))
+
+    job_result = aggregate_jobs([result.pop("job") for result in results])
+    with open('job.json', 'w') as job_result_file:
+        json.dump(job_result, job_result_file, indent=2, sort_keys=True)
+    with open('partitions.json', 'w') as partitions_file:
+        json.dump(results, partitions_file, indent=2, sort_keys=True)
+
+    with open('raw_table.json', 'w') as dest_table_file:
+        json.dump(CACHE.get_table(client, destination_table.reference, max_age=0).to_api_repr(), dest_table_file,
+                  indent=2, sort_keys=True)
+    modified_json = valid_object('raw_table.json', 'Table')
+    with open('table.json', 'w') as modified_file:
+        json.dump(modified_json, modified_file, indent=2, sort_keys=True)
+
+
+def merge_statement(destination: bigquery.TableReference, source: bigquery.TableReference,
+                    columns: List[str], keys: List[str]) -> str:
+    """
+    MERGE of source into destination, updating rows that match on keys and inserting the rest
+    """
+    def column(name: str) -> str:
+        return "`{}`".format(name)
+
+    lowered = {key.lower() for key in keys}
+    # NULL keys match each other, so rows with NULL keys are updated rather than inserted again on every run
+    on = " AND ".join("T.{0} IS NOT DISTINCT FROM S.{0}".format(column(key)) for key in keys)
+    updates = ", ".join("{0} = S.{0}".format(column(name)) for name in columns if name.lower() not in lowered)
+    statement = "MERGE {} T\nUSING {} S\nON {}\n".format(datasetcopy.quote(destination), datasetcopy.quote(source), on)
+    if updates:
+        statement += "WHEN MATCHED THEN\n  UPDATE SET {}\n".format(updates)
+    statement += "WHEN NOT MATCHED THEN\n  INSERT ({}) VALUES ({})".format(
+        ", ".join(column(name) for name in columns), ", ".join("S." + column(name) for name in columns))
+    return statement
+
+
+def query_merge(client: bigquery.Client, config: QueryConfig, job_config: bigquery.QueryJobConfig, query: str):
+    """
+    Runs the query into a temporary table in the destination dataset, then MERGEs it into the destination
+    on mergeKeys -> job.json, merge.json, table.json
+    """
+    start = time.monotonic()
+    destination_table = bigquery.Table.from_api_repr(config.destination)
+    temp_ref = bigquery.TableReference(
+        bigquery.DatasetReference(destination_table.project, destination_table.dataset_id),
+        "_merge_{}_{}".format(destination_table.table_id, uuid.uuid4().hex[:12]))
+    job_config.destination = temp_ref
+    job_config.write_disposition = "WRITE_TRUNCATE"
+    job_config.create_disposition = "CREATE_IF_NEEDED"
+
+    try:
+        query_job = client.query(query, job_config)
+        query_job.result()
+        temp_table = client.get_table(temp_ref)
+        # In case the job fails part way, the temporary table expires on its own
+        temp_table.expires = datetime.now(timezone.utc) + timedelta(days=1)
+        client.update_table(temp_table, ["expires"])
+
+        try:
+            CACHE.get_table(client, destination_table.reference)
+        except exceptions.NotFound:
+            if config.createDisposition != "CREATE_IF_NEEDED":
+                raise
+            # Created from the destination definition (keeping its constraints), or the query result schema
+            if not destination_table.schema:
+                destination_table.schema = temp_table.schema
+            client.create_table(destination_table, exists_ok=True)
+
+        columns = [field.name for field in temp_table.schema]
+        missing = [key for key in config.mergeKeys if key.lower() not in {name.lower() for name in columns}]
+        if missing:
+            raise ValueError("Merge keys not in query result: {}".format(", ".join(missing)))
+        merge_config = bigquery.QueryJobConfig(priority=config.queryPriority, use_legacy_sql=False,
+                                               labels=config.labels or {})
+        merge_job = client.query(merge_statement(destination_table.reference, temp_ref, columns, config.mergeKeys),
+                                 merge_config)
+        merge_job.result()
+    finally:
+        client.delete_table(temp_ref, not_found_ok=True)
+
+    query_result = get_job_resource(client, query_job)
+    merge_result = get_job_resource(client, merge_job)
+    with open('job.json', 'w') as job_result_file:
+        json.dump(aggregate_jobs([query_result, merge_result]), job_result_file, indent=2, sort_keys=True)
+    if config.profile:
+        write_profile(query_result)
+
+    merge_statistics = merge_result.get("statistics", {}).get("query", {})
+    dml_stats = merge_statistics.get("dmlStats", {})
+    report = {
+        "mergeKeys": config.mergeKeys,
+        "queryJobId": query_job.job_id,
+        "mergeJobId": merge_job.job_id,
+        "sourceRows": temp_table.num_rows,
+        "affectedRowCount": int(merge_statistics.get("numDmlAffectedRows", 0)),
+        "insertedRowCount": int(dml_stats.get("insertedRowCount", 0)),
+        "updatedRowCount": int(dml_stats.get("updatedRowCount", 0)),
+        "seconds": round(time.monotonic() - start, 3),
+    }
+    with open('merge.json', 'w') as merge_file:
+        json.dump(report, merge_file, indent=2, sort_keys=True)
+
+    with open('raw_table.json', 'w') as dest_table_file:
+        json.dump(CACHE.get_table(client, destination_table.reference, max_age=0).to_api_repr(), dest_table_file,
+                  indent=2, sort_keys=True)
+    modified_json = valid_object('raw_table.json', 'Table')
+    with open('table.json', 'w') as modified_file:
+        json.dump(modified_json, modified_file, indent=2, sort_keys=True)
+
+
+def query(config: QueryConfig):
+    """
+    Executes a query, optionally retrieving row data to stdout. 
+    Writes Table to table.json and Job to job.json
+    """
+    partitions = partition_ids(config)
+    if partitions and (not config.destination or config.drop or config.exportUri is not None):
+        raise ValueError("Partition rewrites need a destination, and can't be combined with drop or exportUri")
+    merge = (config.writeMode or "").upper() == "MERGE"
+    if merge and (not config.destination or not config.mergeKeys or partitions or config.drop or
+                  config.exportUri is not None):
+        raise ValueError("writeMode MERGE needs a destination and mergeKeys, and can't be combined with "
+                         "partitions, drop or exportUri")
+    if config.submitOnly and (partitions or merge or config.exportUri is not None or config.format is not None):
+        raise ValueError("submitOnly can't be combined with partitions, writeMode MERGE, exportUri or format")
+
+    client = bigquery.Client()
+    job_config = query_job_config(config)
+
+    if config.destination and not partitions and not merge:
+        set_destination(client, config, job_config, config.destination)
+
+    # Format the query with replacement and dependency values in a single pass over the query
+    # (will NOT error if a placeholder found has no value mapped to it, unless strict is set)
+    values = query_values(config)
+    template = Template(config.query)
+    if partitions:
+        return query_partitions(client, config, job_config, template, values, partitions)
+
+    query = template.render(values, strict=config.strict)
+    if template.unresolved:
+        LOG.warning("Query placeholders with no replacement value: %s", ", ".join(sorted(template.unresolved)))
+    if merge:
+        return query_merge(client, config, job_config, query)
+
+    export_uri = None
+    export_method = (config.exportMethod or "EXPORT_DATA").upper()
+    if config.exportUri is not None:
+        if config.exportFormat.upper() not in EXPORT_FORMATS:
+            raise ValueError("Unsupported exportFormat {}".format(config.exportFormat))
+        if export_method not in EXPORT_METHODS:
+            raise ValueError("Unsupported exportMethod {}, expected EXPORT_DATA or EXTRACT".format(
+                config.exportMethod))
+        export_uri = export_destination(config)
+        if export_method == "EXPORT_DATA":
+            if config.destination:
+                raise Exception("EXPORT DATA can't write a destination table, use exportMethod EXTRACT")
+            query = export_statement(config, export_uri, query)
 
     # Start the query
     query_job = client.query(query, job_config)
+    if config.submitOnly:
+        write_job_handles([query_job])
+        return
 
     # Wait for query to complete
     result = query_job.result()
 
     final_result = {}
-    # Optionally print the row data to stdout
-    if config.format is not None:
+    # Optionally print the row data to stdout (not when exporting, the rows never leave BigQuery)
+    if config.format is not None and export_uri is None:
         df: DataFrame = result.to_dataframe()
         if config.format == "csv":
             df.to_csv(sys.stdout, index=False, sep=config.delimiter, header=config.header)
@@ -462,34 +1587,303 @@ def query(config: QueryConfig):
         if config.format == "html":
             df.to_html(sys.stdout)
 
-    # Call the Job REST API, as query_job.to_api_repr() is missing statistics
-    extra_params = {"projection": "full"}
-    path = "/projects/{}/jobs/{}".format(query_job.project, query_job.job_id)
-    span_attributes = {
-        "path": path, "job_id": query_job.job_id, "location": query_job.location}
-    job_result = client._call_api(retry=DEFAULT_RETRY, span_name="BigQuery.getJob",
-                                  span_attributes=span_attributes, method="GET", path=path, query_params=extra_params)
+    job_result = get_job_resource(client, query_job)
 
     # Write job information to job.json
     with open('job.json', 'w') as job_result_file:
         json.dump(job_result, job_result_file, indent=2, sort_keys=True)
 
+    if config.profile:
+        write_profile(job_result)
+
+    table_ref = job_result.get('configuration').get(
+        'query').get('destinationTable')
+
+    if export_uri is not None:
+        extract_jobs = []
+        if export_method == "EXTRACT":
+            if table_ref is None:
+                raise Exception("Query has no result table to extract (scripts need exportMethod EXPORT_DATA)")
+            extract_config = bigquery.ExtractJobConfig(
+                destination_format=EXPORT_FORMATS[config.exportFormat.upper()],
+                compression=config.exportCompression)
+            if config.exportFormat.upper() == "CSV":
+                extract_config.field_delimiter = config.delimiter
+                extract_config.print_header = config.header
+            extract_job = client.extract_table(bigquery.TableReference.from_api_repr(table_ref), export_uri,
+                                               job_config=extract_config, location=query_job.location)
+            extract_jobs.append(get_job_resource(client, extract_job.result()))
+        write_export_manifest(export_uri, job_result, extract_jobs)
+
     # Write the updated destination table to table.json
     with open('raw_table.json', 'w') as dest_table_file:
         # If no destination, this will be a BQ temp table
-        table_ref = job_result.get('configuration').get(
-            'query').get('destinationTable')
         if table_ref is not None:
-            table_info = client.get_table(
-                bigquery.TableReference.from_api_repr(table_ref))
+            table_info = CACHE.get_table(client, bigquery.TableReference.from_api_repr(table_ref), max_age=0)
             json.dump(table_info.to_api_repr(),
                       dest_table_file, indent=2, sort_keys=True)
+        else:
+            # Statements such as EXPORT DATA have no destination table
+            json.dump({}, dest_table_file)
 
     # filter invalid keys for Json
     modified_json = valid_object('raw_table.json', 'Table')
     with open('table.json', 'w') as modified_file:
         json.dump(modified_json, modified_file, indent=2, sort_keys=True)
 
+@dataclass_json
+@dataclass
+class QueryFanoutConfig():
+    # QueryConfig used as a template for every variant, {placeholders} in the query and the destination
+    # tableReference are rendered with each replacement set (over the template's own replacements)
+    query: dict
+    # One map of replacement values per variant (eg. per tenant)
+    replacementSets: List[dict]
+    # Replacement key that names each variant in the manifest (default: its index)
+    nameKey: str = "name"
+    # Maximum concurrent queries across all variants
+    threads: int = 8
+    # Retries of a variant that fails on a rate limit, with exponential backoff
+    maxRetries: int = 5
+
+
+# Error reasons that mean "try again later" rather than a problem with the query
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "jobRateLimitExceeded", "backendError"}
+
+
+def rate_limited(ex: Exception) -> bool:
+    if isinstance(ex, (exceptions.TooManyRequests, exceptions.ServiceUnavailable)):
+        return True
+    errors = getattr(ex, "errors", None) or []
+    return any(isinstance(error, dict) and error.get("reason") in RATE_LIMIT_REASONS for error in errors)
+
+
+def query_fanout(config: QueryFanoutConfig):
+    """
+    Renders and runs one query per replacement set concurrently -> fanout.json (per variant bytes, slot-ms and
+    durations), job.json
+    """
+    start = time.monotonic()
+    template_config = QueryConfig.from_dict(config.query)
+    if template_config.exportUri is not None or template_config.partitions or template_config.writeMode \
+            or template_config.submitOnly or template_config.format is not None:
+        raise ValueError("query_fanout supports plain queries (with or without a destination) only")
+
+    client = bigquery.Client()
+    template = Template(template_config.query)
+    base_values = query_values(template_config)
+    variants = []
+    for index, replacements in enumerate(config.replacementSets):
+        values = {**base_values, **replacements}
+        # Rendered up front, Template is not shared between threads
+        query = template.render(values, strict=template_config.strict)
+        if template.unresolved:
+            LOG.warning("Variant %s has placeholders with no replacement value: %s", index,
+                        ", ".join(sorted(template.unresolved)))
+        destination = None
+        if template_config.destination:
+            destination = json.loads(json.dumps(template_config.destination))
+            destination["tableReference"] = {key: Template(value).render(values, strict=template_config.strict)
+                                             for key, value in destination["tableReference"].items()}
+        variants.append({"name": str(replacements.get(config.nameKey, index)), "query": query,
+                         "destination": destination})
+
+    def run_variant(variant: dict) -> dict:
+        variant_start = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                job_config = query_job_config(template_config)
+                if variant["destination"] is not None:
+                    set_destination(client, template_config, job_config, variant["destination"])
+                query_job = client.query(variant["query"], job_config)
+                query_job.result()
+                break
+            except Exception as ex:
+                if attempt > config.maxRetries or not rate_limited(ex):
+                    raise
+                delay = min(2 ** attempt, 60) * (0.5 + random.random())
+                LOG.warning("Variant %s rate limited (attempt %d), retrying in %.1fs", variant["name"], attempt, delay)
+                time.sleep(delay)
+        job_result = get_job_resource(client, query_job)
+        statistics = job_result.get("statistics", {})
+        return {
+            "name": variant["name"],
+            "jobId": query_job.job_id,
+            "destination": job_result.get("configuration", {}).get("query", {}).get("destinationTable"),
+            "totalBytesProcessed": int(statistics.get("query", {}).get("totalBytesProcessed", 0)),
+            "totalBytesBilled": int(statistics.get("query", {}).get("totalBytesBilled", 0)),
+            "totalSlotMs": int(statistics.get("totalSlotMs", 0)),
+            "jobMs": int(statistics.get("endTime", 0)) - int(statistics.get("startTime", 0)),
+            "seconds": round(time.monotonic() - variant_start, 3),
+            "attempts": attempt,
+            "job": job_result,
+        }
+
+    results, failures = [], []
+    with ThreadPoolExecutor(max_workers=max(1, config.threads), thread_name_prefix="Fanout") as executor:
+        futures = [(variant["name"], executor.submit(run_variant, variant)) for variant in variants]
+        for name, future in futures:
+            try:
+                results.append(future.result())
+            except Exception as ex:
+                failures.append({"name": name, "error": str(ex)})
+
+    with open('job.json', 'w') as job_result_file:
+        json.dump(aggregate_jobs([result.pop("job") for result in results]), job_result_file,
+                  indent=2, sort_keys=True)
+    manifest = {
+        "variants": results,
+        "failures": failures,
+        "totalBytesProcessed": sum(result["totalBytesProcessed"] for result in results),
+        "totalBytesBilled": sum(result["totalBytesBilled"] for result in results),
+        "totalSlotMs": sum(result["totalSlotMs"] for result in results),
+        "seconds": round(time.monotonic() - start, 3),
+    }
+    with open('fanout.json', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+    if failures:
+        raise Exception("{} of {} queries failed: {}".format(
+            len(failures), len(variants), ", ".join(failure["name"] for failure in failures)))
+
+
+@dataclass_json
+@dataclass
+class RenderConfig():
+    # Template string containing {placeholder} values
+    template: str
+    # Map of replacement values for the template
+    replacements: Optional[dict] = None
+    # JSON file containing a map of replacement values (merged with replacements, which take priority)
+    replacementsFile: Optional[str] = None
+    # Fail if the template contains {placeholders} with no replacement value
+    strict: bool = False
+
+
+def render_template(config: RenderConfig):
+    """
+    Renders a {placeholder} template to stdout, reporting any unresolved placeholders to stderr
+    """
+    values = {}
+    if config.replacementsFile:
+        values.update(json.loads(Path(config.replacementsFile).read_text()))
+    if config.replacements is not None:
+        values.update(config.replacements)
+
+    template = Template(config.template)
+    print(template.render(values, strict=config.strict))
+    if template.unresolved:
+        LOG.warning("Template placeholders with no replacement value: %s", ", ".join(sorted(template.unresolved)))
+
+@dataclass_json
+@dataclass
+class ProfileConfig():
+    # job.json written by query, load_table or extract_table
+    jobFile: str
+    # Number of stages (by slot-ms) to flag as the slowest
+    top: int = 3
+
+
+def write_profile(job_result: dict, top: int = 3) -> str:
+    """
+    Writes a profile of a full job resource to profile.json and profile.txt, returning the text report
+    """
+    report = profile_job(job_result, top=top)
+    with open('profile.json', 'w') as profile_file:
+        json.dump(report, profile_file, indent=2, sort_keys=True)
+    text = format_profile(report)
+    with open('profile.txt', 'w') as profile_file:
+        profile_file.write(text + "\n")
+    return text
+
+
+def profile(config: ProfileConfig):
+    """
+    Profiles the statistics of a job.json -> profile.json, profile.txt (also printed to stdout)
+    """
+    job_result = json.loads(Path(config.jobFile).read_text())
+    print(write_profile(job_result, top=config.top))
+
+@dataclass_json
+@dataclass
+class WaitConfig():
+    # handle.json files written by query, load_table, copy_table or extract_table with submitOnly
+    handleFiles: List[str]
+    # Give up after this many seconds (default: wait forever)
+    timeout: Optional[float] = None
+    # Polling starts at initialDelay seconds, doubling up to maxDelay
+    initialDelay: float = 1.0
+    maxDelay: float = 30.0
+    # Number of concurrent job status requests
+    threads: int = 8
+
+
+def wait_jobs(config: WaitConfig):
+    """
+    Polls submitted jobs together with exponential backoff until they are all done -> job.json, jobs.json,
+    table.json (if the jobs wrote a single destination table)
+    """
+    handles = []
+    for handle_file in config.handleFiles:
+        handle = json.loads(Path(handle_file).read_text())
+        handles.extend(handle.get("jobs", [handle]))
+
+    client = bigquery.Client()
+    start = time.monotonic()
+    delay = config.initialDelay
+    pending = {handle["jobId"]: handle for handle in handles}
+    done = {}
+
+    def poll(handle: dict):
+        return client.get_job(handle["jobId"], project=handle["projectId"], location=handle.get("location"))
+
+    with ThreadPoolExecutor(max_workers=max(1, config.threads), thread_name_prefix="WaitJob") as executor:
+        while pending:
+            for job in executor.map(poll, list(pending.values())):
+                if job.state == "DONE":
+                    done[job.job_id] = job
+                    del pending[job.job_id]
+            if not pending:
+                break
+            if config.timeout is not None and time.monotonic() - start + delay > config.timeout:
+                raise TimeoutError("{} job(s) still running after {}s: {}".format(
+                    len(pending), config.timeout, ", ".join(pending)))
+            LOG.info("%d of %d jobs done, polling again in %ss", len(done), len(handles), delay)
+            time.sleep(delay)
+            delay = min(delay * 2, config.maxDelay)
+
+    # Keep the order of the handles
+    job_results = [get_job_resource(client, done[handle["jobId"]]) for handle in handles]
+    with open('job.json', 'w') as job_result_file:
+        json.dump(aggregate_jobs(job_results), job_result_file, indent=2, sort_keys=True)
+    with open('jobs.json', 'w') as jobs_file:
+        json.dump(job_results, jobs_file, indent=2, sort_keys=True)
+
+    destinations = []
+    for job_result in job_results:
+        for job_type in ("query", "load", "copy"):
+            table_ref = job_result.get("configuration", {}).get(job_type, {}).get("destinationTable")
+            if table_ref is not None and table_ref not in destinations:
+                destinations.append(table_ref)
+    with open('raw_table.json', 'w') as dest_table_file:
+        if len(destinations) == 1:
+            table_info = CACHE.get_table(client, bigquery.TableReference.from_api_repr(destinations[0]), max_age=0)
+            json.dump(table_info.to_api_repr(), dest_table_file, indent=2, sort_keys=True)
+        else:
+            json.dump({}, dest_table_file)
+    modified_json = valid_object('raw_table.json', 'Table')
+    with open('table.json', 'w') as modified_file:
+        json.dump(modified_json, modified_file, indent=2, sort_keys=True)
+
+    failed = [job_result for job_result in job_results if job_result.get("status", {}).get("errorResult")]
+    if failed:
+        raise Exception("{} job(s) failed: {}".format(len(failed), "; ".join(
+            "{}: {}".format(job["jobReference"]["jobId"], job["status"]["errorResult"].get("message"))
+            for job in failed)))
+
+
 @dataclass_json
 @dataclass
 class AccessEntryConfig():
@@ -541,6 +1935,126 @@ def update_ACL(config: AccessEntryConfig):
         dataset.access_entries = entries
 
     dataset = client.update_dataset(dataset, ["access_entries"])
+    CACHE.put(dataset)
+
+
+@dataclass_json
+@dataclass
+class BulkACLConfig():
+    # Datasets to update, project.dataset (or dataset in the default project)
+    datasets: List[str]
+    # Desired access entries, https://cloud.google.com/bigquery/docs/reference/rest/v2/datasets#Dataset.FIELDS.access
+    acls: List[dict]
+    # Add the entries to each dataset's current ACL, instead of replacing it
+    append: bool = False
+    # Number of datasets updated concurrently
+    threads: int = 8
+    # Retries of an update that lost a race with another update (etag mismatch)
+    maxRetries: int = 5
+
+
+# Predefined IAM roles are reported back by the API under their basic role names
+BASIC_ROLES = {
+    "roles/bigquery.dataOwner": "OWNER",
+    "roles/bigquery.dataEditor": "WRITER",
+    "roles/bigquery.dataViewer": "READER",
+}
+
+
+def access_key(entry: dict) -> str:
+    """
+    Canonical form of an access entry, so the same grant written two ways compares equal
+    """
+    entry = dict(entry)
+    if entry.get("role") is not None:
+        entry["role"] = BASIC_ROLES.get(entry["role"], entry["role"])
+    for key in ("userByEmail", "groupByEmail"):
+        if key in entry:
+            entry[key] = entry[key].lower()
+    return json.dumps(entry, sort_keys=True)
+
+
+def dedupe_access(entries: List[dict]) -> List[dict]:
+    # WDL AccessEntry structs carry every field, unset ones as null or ""
+    cleaned = remap(entries, visit=lambda p, k, v: v is not None and v != "")
+    unique = {}
+    for entry in cleaned:
+        unique.setdefault(access_key(entry), entry)
+    return list(unique.values())
+
+
+def bulk_ACL(config: BulkACLConfig):
+    """
+    Applies one ACL to many datasets concurrently -> acl.json
+    Entries are deduplicated, datasets that already match are skipped and updates are conditional on the
+    dataset etag, so a concurrent change is re-read and merged instead of overwritten.
+    """
+    start = time.monotonic()
+    client = bigquery.Client()
+    desired = dedupe_access(config.acls)
+
+    def apply(dataset_id: str) -> dict:
+        dataset_start = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            dataset = CACHE.get_dataset(client, dataset_id)
+            current = [entry.to_api_repr() for entry in dataset.access_entries]
+            target = dedupe_access(current + desired) if config.append else desired
+            current_keys = {access_key(entry) for entry in current}
+            target_keys = {access_key(entry) for entry in target}
+            result = {
+                "dataset": dataset_id,
+                "added": len(target_keys - current_keys),
+                "removed": len(current_keys - target_keys),
+                "attempts": attempt,
+            }
+            if current_keys == target_keys:
+                result["action"] = "unchanged"
+                break
+            dataset.access_entries = [AccessEntry.from_api_repr(entry) for entry in target]
+            try:
+                # update_dataset() sends If-Match with the etag read above
+                CACHE.put(client.update_dataset(dataset, ["access_entries"]))
+                result["action"] = "updated"
+                break
+            except exceptions.PreconditionFailed:
+                # The cached etag is stale, read the dataset again
+                CACHE.invalidate(dataset)
+                if attempt > config.maxRetries:
+                    raise
+                LOG.warning("ACL of %s changed during update, retrying", dataset_id)
+                time.sleep(min(2 ** attempt, 30) * random.random())
+        result["seconds"] = round(time.monotonic() - dataset_start, 3)
+        return result
+
+    results, failures = [], []
+    with ThreadPoolExecutor(max_workers=max(1, config.threads), thread_name_prefix="ACL") as executor:
+        futures = [(dataset_id, executor.submit(apply, dataset_id)) for dataset_id in dict.fromkeys(config.datasets)]
+        for dataset_id, future in futures:
+            try:
+                results.append(future.result())
+            except Exception as ex:
+                failures.append({"dataset": dataset_id, "error": str(ex)})
+
+    report = {
+        "entries": desired,
+        "datasets": results,
+        "updated": sum(1 for result in results if result["action"] == "updated"),
+        "unchanged": sum(1 for result in results if result["action"] == "unchanged"),
+        "failures": failures,
+        "seconds": round(time.monotonic() - start, 3),
+    }
+    with open('acl.json', 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+    if failures:
+        raise Exception("Failed to update the ACL of {} dataset(s): {}".format(
+            len(failures), ", ".join(failure["dataset"] for failure in failures)))
+
+
+# Commands that can return a job handle instead of waiting for their job (--submit_only)
+SUBMIT_COMMANDS = {"query", "load_table", "copy_table", "extract_table"}
+
 
 def main(args=None):
     parser = argparse.ArgumentParser(description="jGCP BigQuery utility")
@@ -552,12 +2066,36 @@ def main(args=None):
                         help='JSON credentials file (default: infer from environment)')
 
     parser.add_argument('command', choices=['query', 'create_table', 'copy_table', 'load_table', 'extract_table', 'create_dataset',
-                                            'delete_dataset', 'update_acl'], type=str.lower, help='command to execute')
+                                            'delete_dataset', 'update_acl', 'render', 'profile', 'validate_load',
+                                            'read_table', 'clone_dataset', 'sync_dataset',
+                                            'create_tables', 'wait', 'query_fanout', 'bulk_acl'], type=str.lower, help='command to execute')
 
     parser.add_argument('--version', action='version', version=__version__)
 
+    parser.add_argument('--metadata_ttl', metavar='SECONDS', type=float, default=CACHE.ttl,
+                        help='Seconds table and dataset metadata is reused before being revalidated (default: %(default)s)')
+
+    parser.add_argument('--log_level', metavar='LEVEL', type=str.upper, default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='Level of the log messages written to stderr (default: %(default)s)')
+
+    parser.add_argument('--submit_only', action='store_true',
+                        help='Return a job handle (handle.json) as soon as the job is submitted, see wait '
+                             '(query, load_table, copy_table and extract_table)')
+
     parser.add_argument('config', help='JSON configuration file for command')
-    args = parser.parse_args()
+    args = parser.parse_args(args)
+    if args.submit_only and args.command not in SUBMIT_COMMANDS:
+        parser.error("--submit_only only applies to {}".format(", ".join(sorted(SUBMIT_COMMANDS))))
+
+    def submitted(command_config):
+        if args.submit_only:
+            command_config.submitOnly = True
+        return command_config
+
+    # Log messages go to stderr, stdout is left to command output (eg. query rows)
+    basicConfig(format='%(asctime)s %(threadName)-13s %(levelname)-8s %(message)s', level=args.log_level,
+                stream=sys.stderr)
 
     config = Path(args.config).read_text()
 
@@ -565,6 +2103,7 @@ def main(args=None):
         os.environ['GCP_PROJECT'] = args.project_id
     if args.credentials is not None:
         os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = args.credentials
+    CACHE.ttl = args.metadata_ttl
 
     if args.command == "create_dataset":
         create_dataset(config=CreateDatasetConfig.from_json(config))
@@ -575,21 +2114,53 @@ def main(args=None):
     if args.command == "create_table":
         create_table(config=CreateTableConfig.from_json(config))
 
+    if args.command == "create_tables":
+        create_tables(config=CreateTablesConfig.from_json(config))
+
     if args.command == "copy_table":
-        copy_table(config=CopyTableConfig.from_json(config))
+        copy_table(config=submitted(CopyTableConfig.from_json(config)))
+
+    if args.command == "clone_dataset":
+        clone_dataset(config=CloneDatasetConfig.from_json(config))
+
+    if args.command == "sync_dataset":
+        sync_dataset(config=SyncDatasetConfig.from_json(config))
 
     if args.command == "extract_table":
-        extract_table(config=ExtractTableConfig.from_json(config))
+        extract_table(config=submitted(ExtractTableConfig.from_json(config)))
 
     if args.command == "load_table":
-        load_table(config=LoadTableConfig.from_json(config))
+        load_table(config=submitted(LoadTableConfig.from_json(config)))
+
+    if args.command == "validate_load":
+        print(json.dumps(validate_load(config=LoadTableConfig.from_json(config)), indent=2, sort_keys=True))
 
     if args.command == "query":
-        query(config=QueryConfig.from_json(config))
+        query(config=submitted(QueryConfig.from_json(config)))
+
+    if args.command == "query_fanout":
+        query_fanout(config=QueryFanoutConfig.from_json(config))
+
+    if args.command == "read_table":
+        read_table(config=ReadTableConfig.from_json(config))
     
+    if args.command == "wait":
+        wait_jobs(config=WaitConfig.from_json(config))
+
     if args.command == "update_acl":
         update_ACL(config=AccessEntryConfig.from_json(config))
 
+    if args.command == "bulk_acl":
+        bulk_ACL(config=BulkACLConfig.from_json(config))
+
+    if args.command == "render":
+        render_template(config=RenderConfig.from_json(config))
+
+    if args.command == "profile":
+        profile(config=ProfileConfig.from_json(config))
+
+    LOG.info("Metadata cache: %s", ", ".join("{} {}".format(key, value) for key, value in CACHE.stats().items()))
+
 
 if __name__ == '__main__':
     sys.exit(main())
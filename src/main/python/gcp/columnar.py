@@ -0,0 +1,135 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+from typing import Dict, List, Optional
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+# BigQuery column type -> Arrow type used when parsing CSV values (types not listed are kept as strings)
+ARROW_TYPES = {
+    "STRING": pa.string(),
+    "INTEGER": pa.int64(),
+    "INT64": pa.int64(),
+    "FLOAT": pa.float64(),
+    "FLOAT64": pa.float64(),
+    "NUMERIC": pa.decimal128(38, 9),
+    "BOOLEAN": pa.bool_(),
+    "BOOL": pa.bool_(),
+    "DATE": pa.date32(),
+    "TIME": pa.time64("us"),
+    "DATETIME": pa.timestamp("us"),
+    # Read as text and converted by parse_timestamps, as Arrow needs a zone offset that BigQuery doesn't
+    "TIMESTAMP": pa.string(),
+}
+
+# Arrow type of converted TIMESTAMP columns
+TIMESTAMP_TYPE = pa.timestamp("us", tz="UTC")
+
+# BigQuery types that can't be carried through Parquet with the same meaning as their CSV text
+UNSUPPORTED_TYPES = {"BYTES", "BIGNUMERIC", "BIGDECIMAL", "RECORD", "STRUCT"}
+
+# Size of each block of CSV text handed to the (multi-threaded) parser
+BLOCK_SIZE = 16 << 20
+
+
+def parse_timestamps(values: pa.Array) -> pa.Array:
+    """
+    Converts BigQuery TIMESTAMP text to UTC timestamps. Values without a zone offset, or with a UTC/Z suffix, are
+    UTC as they are for BigQuery, and dates alone are midnight. Raises pyarrow.ArrowInvalid for anything else
+    Arrow can't parse (eg. time zone names).
+    """
+    values = pc.replace_substring_regex(values, r"(?i)\s*(UTC|Z)$", "")
+    values = pc.if_else(pc.match_substring_regex(values, r"^\d{4}-\d{1,2}-\d{1,2}$"),
+                        pc.binary_join_element_wise(values, " 00:00:00", ""), values)
+    values = pc.if_else(pc.match_substring_regex(values, r"[+-]\d\d:?\d\d$"),
+                        values, pc.binary_join_element_wise(values, "+00:00", ""))
+    return pc.cast(values, TIMESTAMP_TYPE)
+
+
+def column_types(schema_fields: List[dict]) -> Dict[str, pa.DataType]:
+    """
+    Maps BigQuery TableFieldSchema dicts to Arrow types for the CSV reader
+    """
+    return {field["name"]: ARROW_TYPES.get(field.get("type", "STRING").upper(), pa.string())
+            for field in schema_fields}
+
+
+def parquet_compatible(schema_fields: Optional[List[dict]]) -> bool:
+    """
+    True if every field can be converted to Parquet without changing how BigQuery interprets it. Without a schema
+    Arrow would guess column types (eg. zip codes and ids as integers), so nothing is converted.
+    """
+    return bool(schema_fields) and not any(
+        field.get("type", "STRING").upper() in UNSUPPORTED_TYPES or field.get("mode") == "REPEATED"
+        for field in schema_fields)
+
+
+def open_csv(source_file: str, schema_fields: List[dict], skip_leading_rows: int = 0,
+             field_delimiter: str = ",", quote_character: str = '"') -> pa_csv.CSVStreamingReader:
+    """
+    Opens a streaming, multi-threaded CSV reader, typed using the BigQuery schema.
+    Batches are read one block at a time so memory use does not grow with the file size.
+    """
+    # Names come from the schema, so all leading rows (eg. headers) are skipped
+    read_options = pa_csv.ReadOptions(column_names=[field["name"] for field in schema_fields],
+                                      skip_rows=skip_leading_rows, use_threads=True, block_size=BLOCK_SIZE)
+    convert_options = pa_csv.ConvertOptions(column_types=column_types(schema_fields),
+                                            null_values=[""], strings_can_be_null=True)
+
+    parse_options = pa_csv.ParseOptions(delimiter=field_delimiter, quote_char=quote_character or False)
+    return pa_csv.open_csv(source_file, read_options=read_options, parse_options=parse_options,
+                           convert_options=convert_options)
+
+
+def csv_to_parquet(source_file: str, destination_file: str, schema_fields: List[dict],
+                   skip_leading_rows: int = 0, field_delimiter: str = ",", quote_character: str = '"',
+                   compression: str = "SNAPPY") -> dict:
+    """
+    Streams a local CSV file into a compressed Parquet file, returning conversion statistics.
+    Raises pyarrow.ArrowInvalid if a value can't be converted to its column type.
+    """
+    if not schema_fields:
+        raise ValueError("Converting CSV to Parquet requires schemaFields")
+    start = time.monotonic()
+    reader = open_csv(source_file, schema_fields, skip_leading_rows, field_delimiter, quote_character)
+    timestamps = [i for i, field in enumerate(schema_fields) if field.get("type", "STRING").upper() == "TIMESTAMP"]
+    schema = reader.schema
+    for i in timestamps:
+        schema = schema.set(i, schema.field(i).with_type(TIMESTAMP_TYPE))
+    rows = 0
+    with pq.ParquetWriter(destination_file, schema, compression=compression.lower()) as writer:
+        for batch in reader:
+            columns = batch.columns
+            for i in timestamps:
+                columns[i] = parse_timestamps(columns[i])
+            writer.write_table(pa.Table.from_batches([pa.RecordBatch.from_arrays(columns, schema=schema)]))
+            rows += batch.num_rows
+
+    source_bytes = os.path.getsize(source_file)
+    parquet_bytes = os.path.getsize(destination_file)
+    return {
+        "sourceFile": source_file,
+        "sourceBytes": source_bytes,
+        "parquetBytes": parquet_bytes,
+        "bytesSaved": source_bytes - parquet_bytes,
+        "compressionRatio": round(source_bytes / parquet_bytes, 2) if parquet_bytes else None,
+        "compression": compression.upper(),
+        "rows": rows,
+        "conversionSeconds": round(time.monotonic() - start, 3),
+    }
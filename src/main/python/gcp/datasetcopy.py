@@ -0,0 +1,235 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from google.cloud import bigquery
+
+from .metacache import CACHE
+
+# Table types that are copied as data, everything else is recreated from its definition or skipped
+DATA_TYPES = {"TABLE", "SNAPSHOT", "CLONE"}
+# Ways of copying a table: a copy job, or zero-copy DDL (a clone is writable, a snapshot is read-only)
+COPY_MODES = {"COPY", "CLONE", "SNAPSHOT"}
+
+# String literals (triple quoted first) and comments, which can't hold table references
+NON_CODE = re.compile(r"'''.*?'''|\"\"\".*?\"\"\"|'(?:\\.|[^'\\\n])*'|\"(?:\\.|[^\"\\\n])*\"|--[^\n]*|#[^\n]*|/\*.*?\*/",
+                      re.DOTALL)
+# A quoted or plain identifier (project ids may contain dashes)
+IDENTIFIER = re.compile(r"`[^`]+`|[A-Za-z_][\w-]*")
+# A dotted path of identifiers after FROM or JOIN
+TABLE_REFERENCE = re.compile(r"\b(?:FROM|JOIN)\s+((?:`[^`]+`|[A-Za-z_][\w-]*)(?:\s*\.\s*(?:`[^`]+`|[A-Za-z_][\w-]*))*)",
+                             re.IGNORECASE)
+# Uses of FROM that are not followed by a table
+NOT_TABLE_FROM = re.compile(r"(?:\bEXTRACT\s*\(\s*\w+|\bDISTINCT)\s*$", re.IGNORECASE)
+
+
+def parse_dataset_expr(dataset_expr: str) -> Tuple[str, str, str]:
+    """
+    Splits 'project:dataset.regex' (the utils.backup syntax) into project, dataset and table regex (default .*)
+    """
+    search = re.search('^(.*?):(.*?)(?:\\.(.*))?$', dataset_expr)
+    if search is None:
+        raise ValueError("Expected project:dataset[.table_regex], got {}".format(dataset_expr))
+    return search.group(1), search.group(2), search.group(3) or ".*"
+
+
+def matching_tables(client: bigquery.Client, dataset: bigquery.DatasetReference,
+                    table_expr: str) -> List[bigquery.table.TableListItem]:
+    """
+    Lists the tables (and views) in a dataset whose id matches table_expr (case-insensitive, whole id)
+    """
+    pattern = re.compile("^" + table_expr + "$", re.IGNORECASE)
+    return [item for item in client.list_tables(dataset, page_size=1000) if pattern.match(item.table_id)]
+
+
+def quote(table: bigquery.TableReference) -> str:
+    return "`{}.{}.{}`".format(table.project, table.dataset_id, table.table_id)
+
+
+def code_mask(sql: str) -> str:
+    """
+    The SQL with string literals and comments blanked out (same length, so positions still match the SQL)
+    """
+    return NON_CODE.sub(lambda match: re.sub(r"[^\n]", " ", match.group(0)), sql)
+
+
+def table_references(sql: str) -> List[Tuple[int, int, List[str]]]:
+    """
+    Table references in table positions (after FROM or JOIN, outside string literals and comments) as
+    (start, end, [project,] dataset, table) path parts. Single part names (eg. WITH aliases, UNNEST) are left out.
+    """
+    masked = code_mask(sql)
+    references = []
+    for match in TABLE_REFERENCE.finditer(masked):
+        # EXTRACT(DAY FROM d.column) and IS [NOT] DISTINCT FROM t.column are column references
+        if NOT_TABLE_FROM.search(masked, 0, match.start()):
+            continue
+        parts = [part for identifier in IDENTIFIER.findall(match.group(1))
+                 for part in identifier.strip("`").split(".")]
+        if 2 <= len(parts) <= 3:
+            references.append((match.start(1), match.end(1), parts))
+    return references
+
+
+def retarget_query(sql: str, source: bigquery.DatasetReference, target: bigquery.DatasetReference) -> str:
+    """
+    Points references to the source dataset in a view at the target dataset. Qualified project.dataset. names
+    are replaced anywhere outside string literals and comments, unqualified dataset.table names only where a
+    table is expected (after FROM or JOIN).
+    """
+    # Unqualified dataset.table references (only when the project does not change meaning)
+    if source.project == target.project:
+        for start, end, parts in reversed(table_references(sql)):
+            if len(parts) == 2 and parts[0] == source.dataset_id:
+                reference = "{}.{}".format(target.dataset_id, parts[1])
+                sql = sql[:start] + ("`{}`".format(reference) if "`" in sql[start:end] else reference) + sql[end:]
+
+    segments = []
+    position = 0
+    for match in NON_CODE.finditer(sql):
+        segments.append((sql[position:match.start()], True))
+        segments.append((match.group(0), False))
+        position = match.end()
+    segments.append((sql[position:], True))
+
+    retargeted = []
+    for text, code in segments:
+        if code:
+            for old, new in (("{}.{}.".format(source.project, source.dataset_id),
+                              "{}.{}.".format(target.project, target.dataset_id)),
+                             ("{}:{}.".format(source.project, source.dataset_id),
+                              "{}:{}.".format(target.project, target.dataset_id))):
+                text = text.replace(old, new)
+        retargeted.append(text)
+    return "".join(retargeted)
+
+
+def view_order(views: Dict[str, str], dataset: Optional[bigquery.DatasetReference] = None) -> List[List[str]]:
+    """
+    Orders views (id -> SQL) so that every view comes after the views in the same dataset it selects from.
+    Returns levels of views that can be created concurrently, or raises ValueError for circular references.
+    """
+    depends = {}
+    for view_id, sql in views.items():
+        depends[view_id] = set()
+        for _, _, parts in table_references(sql):
+            if dataset is not None and (parts[-2] != dataset.dataset_id or
+                                        (len(parts) == 3 and parts[0] != dataset.project)):
+                continue
+            if parts[-1] in views and parts[-1] != view_id:
+                depends[view_id].add(parts[-1])
+    levels = []
+    done = set()
+    while len(done) < len(views):
+        level = sorted(v for v in views if v not in done and depends[v] <= done)
+        if not level:
+            raise ValueError("Circular view references: {}".format(", ".join(sorted(set(views) - done))))
+        levels.append(level)
+        done.update(level)
+    return levels
+
+
+def copy_table(client: bigquery.Client, source: bigquery.TableReference, destination: bigquery.TableReference,
+               mode: str = "COPY", replace: bool = False, location: Optional[str] = None,
+               expiration_days: Optional[float] = None) -> dict:
+    """
+    Copies one table with a copy job, or CREATE TABLE ... CLONE / CREATE SNAPSHOT TABLE for zero-copy modes
+    """
+    start = time.monotonic()
+    if mode == "COPY":
+        job_config = bigquery.CopyJobConfig(
+            create_disposition="CREATE_IF_NEEDED",
+            write_disposition="WRITE_TRUNCATE" if replace else "WRITE_EMPTY")
+        job = client.copy_table(source, destination, job_config=job_config, location=location)
+    else:
+        options = ""
+        if expiration_days is not None:
+            options = " OPTIONS(expiration_timestamp=TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL {} HOUR))".format(
+                int(expiration_days * 24))
+        if mode == "CLONE":
+            ddl = "CREATE {}TABLE {} CLONE {}{}".format("OR REPLACE " if replace else "", quote(destination),
+                                                        quote(source), options)
+        else:
+            # Snapshots can't be replaced in place
+            if replace:
+                client.delete_table(destination, not_found_ok=True)
+            ddl = "CREATE SNAPSHOT TABLE {} CLONE {}{}".format(quote(destination), quote(source), options)
+        job = client.query(ddl, location=location)
+    job.result()
+    CACHE.invalidate(destination)
+    return {
+        "table": source.table_id,
+        "method": mode,
+        "jobId": job.job_id,
+        "seconds": round(time.monotonic() - start, 3),
+    }
+
+
+def create_view(client: bigquery.Client, view: bigquery.Table, destination: bigquery.TableReference,
+                source_dataset: bigquery.DatasetReference, replace: bool = False) -> dict:
+    """
+    Recreates a view in the destination, pointing any references to the source dataset at the destination
+    """
+    start = time.monotonic()
+    new_view = bigquery.Table(destination)
+    target_dataset = bigquery.DatasetReference(destination.project, destination.dataset_id)
+    new_view.view_query = retarget_query(view.view_query, source_dataset, target_dataset)
+    new_view.view_use_legacy_sql = view.view_use_legacy_sql
+    new_view.description = view.description
+    new_view.labels = view.labels
+    if replace:
+        client.delete_table(destination, not_found_ok=True)
+    CACHE.put(client.create_table(new_view, exists_ok=not replace))
+    return {"table": view.table_id, "method": "VIEW", "seconds": round(time.monotonic() - start, 3)}
+
+
+def run_all(tasks: List, threads: int, thread_name_prefix: str) -> Tuple[List[dict], List[dict]]:
+    """
+    Runs (name, callable) tasks with a bounded pool, returning (results, failures) without stopping on errors
+    """
+    results, failures = [], []
+    with ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix=thread_name_prefix) as executor:
+        futures = [(name, executor.submit(task)) for name, task in tasks]
+        for name, future in futures:
+            try:
+                results.append(future.result())
+            except Exception as ex:
+                failures.append({"table": name, "error": str(ex)})
+    return results, failures
+
+
+def schema_repr(table: bigquery.Table) -> List[dict]:
+    return [field.to_api_repr() for field in table.schema]
+
+
+def table_diff(source: bigquery.Table, target: Optional[bigquery.Table]) -> List[str]:
+    """
+    Reasons a target table is out of date with its source (empty if they match)
+    """
+    if target is None:
+        return ["missing"]
+    reasons = []
+    if source.modified is not None and target.modified is not None and source.modified > target.modified:
+        reasons.append("modified")
+    if source.num_rows != target.num_rows:
+        reasons.append("numRows")
+    if source.num_bytes != target.num_bytes:
+        reasons.append("numBytes")
+    if schema_repr(source) != schema_repr(target):
+        reasons.append("schema")
+    return reasons
@@ -0,0 +1,327 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from google.cloud import bigquery
+
+from .schema import TYPE_ALIASES
+
+# INFORMATION_SCHEMA.TABLES types that can be rebuilt from query results, everything else uses get_table()
+TABLE_TYPES = {"BASE TABLE": "TABLE", "VIEW": "VIEW"}
+
+TABLES_SQL = """
+SELECT t.table_name, t.table_type, t.ddl, v.view_definition, v.use_standard_sql,
+       m.row_count, m.size_bytes, m.creation_time, m.last_modified_time
+FROM `{project}.{dataset}`.INFORMATION_SCHEMA.TABLES t
+LEFT JOIN `{project}.{dataset}`.INFORMATION_SCHEMA.VIEWS v USING (table_name)
+LEFT JOIN `{project}.{dataset}.__TABLES__` m ON m.table_id = t.table_name
+"""
+
+OPTIONS_SQL = """
+SELECT table_name, option_name, option_value
+FROM `{project}.{dataset}`.INFORMATION_SCHEMA.TABLE_OPTIONS
+"""
+
+COLUMNS_SQL = """
+SELECT c.table_name, c.column_name, c.ordinal_position, c.is_nullable, c.data_type, c.column_default,
+       c.clustering_ordinal_position, f.field_path, f.description, f.collation_name, f.rounding_mode,
+       ARRAY_LENGTH(f.policy_tags) AS policy_tags
+FROM `{project}.{dataset}`.INFORMATION_SCHEMA.COLUMNS c
+JOIN `{project}.{dataset}`.INFORMATION_SCHEMA.COLUMN_FIELD_PATHS f USING (table_name, column_name)
+WHERE c.is_hidden = 'NO' AND c.is_system_defined = 'NO'
+"""
+
+_TOKEN = re.compile(r"\s*(`[^`]+`|[A-Za-z_][A-Za-z0-9_]*|\d+|[<>(),])")
+_PARTITION_BY = re.compile(r"\bPARTITION BY (.+?)(?:\n|\bCLUSTER BY\b|\bOPTIONS\b|$)", re.IGNORECASE)
+_LABEL = re.compile(r'STRUCT\(("(?:[^"\\]|\\.)*"), ("(?:[^"\\]|\\.)*")\)')
+_CONSTRAINT = re.compile(r"\b(?:PRIMARY|FOREIGN)\s+KEY\b", re.IGNORECASE)
+_TIMESTAMP = re.compile(r'^TIMESTAMP "(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})(\.\d+)?(Z|[+-]00(:?00)?)?"$')
+
+
+class TypeParser():
+    """
+    Parses a GoogleSQL column type (INT64, STRING(10), ARRAY<STRUCT<a INT64 NOT NULL>>...) into a TableFieldSchema
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.tokens = []
+        pos = 0
+        while pos < len(text.rstrip()):
+            match = _TOKEN.match(text, pos)
+            if match is None:
+                raise ValueError("Unexpected text in type {}".format(text))
+            self.tokens.append(match.group(1))
+            pos = match.end()
+        self.pos = 0
+
+    def peek(self) -> Optional[str]:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def next(self, expected: Optional[str] = None) -> str:
+        token = self.peek()
+        if token is None or (expected is not None and token.upper() != expected):
+            raise ValueError("Expected {} in type {}".format(expected or "a token", self.text))
+        self.pos += 1
+        return token
+
+    def field(self, name: str) -> dict:
+        """
+        The schema of a (possibly repeated) field named name
+        """
+        field = {"name": name, "mode": "NULLABLE"}
+        if (self.peek() or "").upper() == "ARRAY":
+            self.next()
+            self.next("<")
+            field.update(self.element())
+            self.next(">")
+            field["mode"] = "REPEATED"
+        else:
+            field.update(self.element())
+        return field
+
+    def element(self) -> dict:
+        type_name = self.next().upper()
+        if type_name == "STRUCT":
+            self.next("<")
+            fields = []
+            while True:
+                sub_name = self.next().strip("`")
+                sub_field = self.field(sub_name)
+                if (self.peek() or "").upper() == "NOT":
+                    self.next()
+                    self.next("NULL")
+                    sub_field["mode"] = "REQUIRED"
+                fields.append(sub_field)
+                if self.peek() != ",":
+                    break
+                self.next()
+            self.next(">")
+            return {"type": "RECORD", "fields": fields}
+        if self.peek() == "<":
+            # RANGE<DATE> and other parameterised types are left to get_table()
+            raise ValueError("Unsupported type {}".format(self.text))
+        element = {"type": TYPE_ALIASES.get(type_name, type_name)}
+        if self.peek() == "(":
+            self.next()
+            params = [self.next()]
+            while self.peek() == ",":
+                self.next()
+                params.append(self.next())
+            self.next(")")
+            if element["type"] in ("STRING", "BYTES"):
+                element["maxLength"] = params[0]
+            else:
+                element["precision"] = params[0]
+                if len(params) > 1:
+                    element["scale"] = params[1]
+        return element
+
+    def parse(self, name: str) -> dict:
+        field = self.field(name)
+        if self.peek() is not None:
+            raise ValueError("Unexpected {} in type {}".format(self.peek(), self.text))
+        return field
+
+
+def sql_string(literal: str) -> str:
+    """
+    Value of a double quoted string literal as written in TABLE_OPTIONS
+    """
+    if not (literal.startswith('"') and literal.endswith('"')) or literal.startswith('"""'):
+        raise ValueError("Unsupported string literal {}".format(literal))
+    # GoogleSQL and JSON share the escapes BigQuery uses in option values
+    return json.loads(literal)
+
+
+def epoch_millis(literal: str) -> str:
+    match = _TIMESTAMP.match(literal)
+    if match is None:
+        raise ValueError("Unsupported timestamp {}".format(literal))
+    moment = datetime.strptime("{} {}".format(match.group(1), match.group(2)), "%Y-%m-%d %H:%M:%S")
+    millis = int(moment.replace(tzinfo=timezone.utc).timestamp() * 1000)
+    if match.group(3):
+        millis += int(float(match.group(3)) * 1000)
+    return str(millis)
+
+
+def apply_options(resource: dict, options: List[Tuple[str, str]]):
+    """
+    Sets the table resource keys for TABLE_OPTIONS rows, raising ValueError for options that aren't handled
+    """
+    for name, value in options:
+        if name == "description":
+            resource["description"] = sql_string(value)
+        elif name == "friendly_name":
+            resource["friendlyName"] = sql_string(value)
+        elif name == "labels":
+            resource["labels"] = {sql_string(key): sql_string(label) for key, label in _LABEL.findall(value)}
+        elif name == "expiration_timestamp":
+            resource["expirationTime"] = epoch_millis(value)
+        elif name == "partition_expiration_days":
+            resource.setdefault("timePartitioning", {})["expirationMs"] = str(int(float(value) * 86400000))
+        elif name == "require_partition_filter":
+            resource["requirePartitionFilter"] = value.lower() == "true"
+        else:
+            raise ValueError("Unsupported option {}".format(name))
+
+
+def partitioning(ddl: str) -> dict:
+    """
+    timePartitioning or rangePartitioning for the PARTITION BY clause of a table's DDL
+    """
+    match = _PARTITION_BY.search(ddl or "")
+    if match is None:
+        return {}
+    clause = re.sub(r"\s+", "", match.group(1)).strip("`")
+    if clause.upper() == "_PARTITIONDATE":
+        return {"timePartitioning": {"type": "DAY"}}
+    search = re.match(r"^(?:TIMESTAMP|DATETIME|DATE)_TRUNC\(`?(\w+)`?,(HOUR|DAY|MONTH|YEAR)\)$", clause, re.IGNORECASE)
+    if search:
+        unit = search.group(2).upper()
+        if search.group(1).upper() == "_PARTITIONTIME":
+            return {"timePartitioning": {"type": unit}}
+        return {"timePartitioning": {"type": unit, "field": search.group(1)}}
+    search = re.match(r"^DATE\(`?(\w+)`?\)$", clause, re.IGNORECASE)
+    if search:
+        if search.group(1).upper() == "_PARTITIONTIME":
+            return {"timePartitioning": {"type": "DAY"}}
+        return {"timePartitioning": {"type": "DAY", "field": search.group(1)}}
+    search = re.match(r"^RANGE_BUCKET\(`?(\w+)`?,GENERATE_ARRAY\((-?\d+),(-?\d+),(\d+)\)\)$", clause, re.IGNORECASE)
+    if search:
+        return {"rangePartitioning": {"field": search.group(1), "range": {
+            "start": search.group(2), "end": search.group(3), "interval": search.group(4)}}}
+    if re.match(r"^\w+$", clause):
+        return {"timePartitioning": {"type": "DAY", "field": clause}}
+    raise ValueError("Unsupported partitioning {}".format(match.group(1)))
+
+
+def build_schema(columns: List[dict]) -> Tuple[List[dict], List[str]]:
+    """
+    Schema fields and clustering columns for the COLUMNS x COLUMN_FIELD_PATHS rows of one table
+    """
+    fields = []
+    clustering = {}
+    paths = {}
+    for row in columns:
+        paths[row["field_path"].lower()] = row
+    for row in sorted((row for row in columns if row["field_path"] == row["column_name"]),
+                      key=lambda row: row["ordinal_position"]):
+        field = TypeParser(row["data_type"]).parse(row["column_name"])
+        if row["is_nullable"] == "NO" and field["mode"] != "REPEATED":
+            field["mode"] = "REQUIRED"
+        if row["column_default"] not in (None, "NULL"):
+            field["defaultValueExpression"] = row["column_default"]
+        if row["clustering_ordinal_position"] is not None:
+            clustering[row["clustering_ordinal_position"]] = row["column_name"]
+        describe(field, row["column_name"], paths)
+        fields.append(field)
+    return fields, [clustering[position] for position in sorted(clustering)]
+
+
+def describe(field: dict, path: str, paths: Dict[str, dict]):
+    """
+    Adds the description, collation and rounding mode from COLUMN_FIELD_PATHS to a field and its sub-fields
+    """
+    row = paths.get(path.lower())
+    if row is None:
+        raise ValueError("No field path {}".format(path))
+    if row["policy_tags"]:
+        # Policy tag resource names are only returned by the tables API
+        raise ValueError("{} has policy tags".format(path))
+    if row["description"] is not None:
+        field["description"] = row["description"]
+    if row["collation_name"] not in (None, "NULL"):
+        field["collation"] = row["collation_name"]
+    if row["rounding_mode"] is not None:
+        field["roundingMode"] = row["rounding_mode"]
+    for sub_field in field.get("fields", []):
+        describe(sub_field, path + "." + sub_field["name"], paths)
+
+
+def table_resource(dataset: bigquery.Dataset, table: dict, options: List[Tuple[str, str]],
+                   columns: List[dict]) -> dict:
+    """
+    Rebuilds the tables.get representation of a table or view from INFORMATION_SCHEMA rows.
+    Raises ValueError when something can't be rebuilt, for the caller to fall back to get_table().
+    """
+    table_type = TABLE_TYPES.get(table["table_type"])
+    if table_type is None:
+        raise ValueError("Unsupported table type {}".format(table["table_type"]))
+    if table["last_modified_time"] is None:
+        raise ValueError("No __TABLES__ entry")
+    resource = {
+        "kind": "bigquery#table",
+        "id": "{}:{}.{}".format(dataset.project, dataset.dataset_id, table["table_name"]),
+        "tableReference": {"projectId": dataset.project, "datasetId": dataset.dataset_id,
+                           "tableId": table["table_name"]},
+        "type": table_type,
+        "location": dataset.location,
+        "creationTime": str(table["creation_time"]),
+        "lastModifiedTime": str(table["last_modified_time"]),
+        "numRows": str(table["row_count"] or 0),
+        "numBytes": str(table["size_bytes"] or 0),
+    }
+    fields, clustering = build_schema(columns)
+    resource["schema"] = {"fields": fields}
+    if table_type == "VIEW":
+        resource["view"] = {"query": table["view_definition"], "useLegacySql": table["use_standard_sql"] == "NO"}
+        resource["numRows"] = resource["numBytes"] = "0"
+    else:
+        if _CONSTRAINT.search(table["ddl"] or ""):
+            # tableConstraints (primary and foreign keys) are left to get_table()
+            raise ValueError("Table constraints")
+        resource.update(partitioning(table["ddl"]))
+        if clustering:
+            resource["clustering"] = {"fields": clustering}
+    apply_options(resource, options)
+    if "timePartitioning" in resource and "type" not in resource["timePartitioning"]:
+        raise ValueError("partition_expiration_days without PARTITION BY")
+    return resource
+
+
+def dataset_tables(client: bigquery.Client, dataset: bigquery.Dataset,
+                   threads: int = 3) -> Tuple[Dict[str, dict], List[str]]:
+    """
+    Table resources for every table and view in a dataset from three INFORMATION_SCHEMA queries.
+    Returns the resources by table id, and the ids of tables that have to be read with get_table() instead.
+    """
+    names = {"project": dataset.project, "dataset": dataset.dataset_id}
+
+    def rows(sql: str) -> List[dict]:
+        return [dict(row.items()) for row in client.query(sql.format(**names), location=dataset.location).result()]
+
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="InfoSchema") as executor:
+        tables, options, columns = executor.map(rows, (TABLES_SQL, OPTIONS_SQL, COLUMNS_SQL))
+
+    table_options: Dict[str, List[Tuple[str, str]]] = {}
+    for row in options:
+        table_options.setdefault(row["table_name"], []).append((row["option_name"], row["option_value"]))
+    table_columns: Dict[str, List[dict]] = {}
+    for row in columns:
+        table_columns.setdefault(row["table_name"], []).append(row)
+
+    resources, fallback = {}, []
+    for table in tables:
+        try:
+            resources[table["table_name"]] = table_resource(dataset, table, table_options.get(table["table_name"], []),
+                                                            table_columns.get(table["table_name"], []))
+        except ValueError:
+            fallback.append(table["table_name"])
+    return resources, fallback
@@ -0,0 +1,142 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List, Optional
+
+# A stage whose slowest worker takes this many times longer than the average worker is reported as skewed
+SKEW_THRESHOLD = 5.0
+
+
+def _int(value, default=0) -> int:
+    # The REST API returns int64 values as strings
+    return int(value) if value is not None else default
+
+
+def _float(value) -> Optional[float]:
+    return round(float(value), 3) if value is not None else None
+
+
+def _skew(stage: dict, metric: str) -> Optional[float]:
+    avg = _int(stage.get(metric + "MsAvg"))
+    peak = _int(stage.get(metric + "MsMax"))
+    if avg <= 0:
+        return None
+    return round(peak / avg, 2)
+
+
+def profile_stage(stage: dict) -> dict:
+    """
+    Summarizes a single ExplainQueryStage from a job's queryPlan
+    """
+    compute_skew = _skew(stage, "compute")
+    wait_skew = _skew(stage, "wait")
+    return {
+        "id": stage.get("id"),
+        "name": stage.get("name"),
+        "status": stage.get("status"),
+        "durationMs": _int(stage.get("endMs")) - _int(stage.get("startMs")) if stage.get("startMs") else None,
+        "slotMs": _int(stage.get("slotMs")),
+        "waitRatio": _float(stage.get("waitRatioAvg")),
+        "readRatio": _float(stage.get("readRatioAvg")),
+        "computeRatio": _float(stage.get("computeRatioAvg")),
+        "writeRatio": _float(stage.get("writeRatioAvg")),
+        "recordsRead": _int(stage.get("recordsRead")),
+        "recordsWritten": _int(stage.get("recordsWritten")),
+        "shuffleOutputBytes": _int(stage.get("shuffleOutputBytes")),
+        "shuffleOutputBytesSpilled": _int(stage.get("shuffleOutputBytesSpilled")),
+        "parallelInputs": _int(stage.get("parallelInputs")),
+        "computeSkew": compute_skew,
+        "waitSkew": wait_skew,
+        "skewed": any(s is not None and s >= SKEW_THRESHOLD for s in (compute_skew, wait_skew)),
+        "slowest": False,
+    }
+
+
+def profile_job(job: dict, top: int = 3) -> dict:
+    """
+    Turns a full job resource (as written to job.json) into a compact profile report
+    """
+    statistics = job.get("statistics", {})
+    job_type = next((t for t in ("query", "load", "extract", "copy") if t in statistics), None)
+    details = statistics.get(job_type, {}) if job_type else {}
+
+    stages = [profile_stage(stage) for stage in details.get("queryPlan", [])]
+    total_slot_ms = _int(statistics.get("totalSlotMs"), sum(s["slotMs"] for s in stages))
+    for stage in stages:
+        stage["slotShare"] = round(stage["slotMs"] / total_slot_ms, 3) if total_slot_ms else None
+
+    slowest = sorted(stages, key=lambda s: s["slotMs"], reverse=True)[:top]
+    for stage in slowest:
+        stage["slowest"] = True
+
+    start_ms = _int(statistics.get("startTime"))
+    end_ms = _int(statistics.get("endTime"))
+    elapsed_ms = end_ms - start_ms if start_ms and end_ms else None
+
+    return {
+        "jobId": job.get("jobReference", {}).get("jobId"),
+        "jobType": job_type,
+        "state": job.get("status", {}).get("state"),
+        "elapsedMs": elapsed_ms,
+        "totalSlotMs": total_slot_ms,
+        "averageSlots": round(total_slot_ms / elapsed_ms, 2) if elapsed_ms else None,
+        "totalBytesProcessed": _int(details.get("totalBytesProcessed", statistics.get("totalBytesProcessed"))),
+        "totalBytesBilled": _int(details.get("totalBytesBilled")),
+        "cacheHit": details.get("cacheHit"),
+        "shuffleOutputBytes": sum(s["shuffleOutputBytes"] for s in stages),
+        "shuffleOutputBytesSpilled": sum(s["shuffleOutputBytesSpilled"] for s in stages),
+        "slowestStages": [s["name"] for s in slowest],
+        "skewedStages": [s["name"] for s in stages if s["skewed"]],
+        "stages": stages,
+    }
+
+
+def _bytes(num: int) -> str:
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if abs(num) < 1024 or unit == "TB":
+            return "{:.0f}{}".format(num, unit) if unit == "B" else "{:.1f}{}".format(num, unit)
+        num /= 1024
+
+
+def _ratio(value: Optional[float]) -> str:
+    return "-" if value is None else "{:.2f}".format(value)
+
+
+def format_profile(report: dict) -> str:
+    """
+    Formats a profile report as a plain text table
+    """
+    lines: List[str] = [
+        "Job {} ({}, {}): {} ms elapsed, {} slot-ms, {} avg slots, {} processed, {} billed, {} shuffled, "
+        "{} spilled".format(
+            report["jobId"], report["jobType"], report["state"], report["elapsedMs"], report["totalSlotMs"],
+            report["averageSlots"], _bytes(report["totalBytesProcessed"]), _bytes(report["totalBytesBilled"]),
+            _bytes(report["shuffleOutputBytes"]), _bytes(report["shuffleOutputBytesSpilled"]))
+    ]
+    if not report["stages"]:
+        return lines[0]
+
+    header = "{:<2} {:<28} {:>12} {:>6} {:>5} {:>5} {:>5} {:>5} {:>12} {:>10} {:>10} {:>6}".format(
+        "", "stage", "slot-ms", "share", "wait", "read", "comp", "write", "records in", "shuffle", "spilled", "skew")
+    lines.append(header)
+    lines.append("-" * len(header))
+    for stage in report["stages"]:
+        flags = ("*" if stage["slowest"] else "") + ("!" if stage["skewed"] else "")
+        lines.append("{:<2} {:<28} {:>12} {:>6} {:>5} {:>5} {:>5} {:>5} {:>12} {:>10} {:>10} {:>6}".format(
+            flags, (stage["name"] or "")[:28], stage["slotMs"], _ratio(stage["slotShare"]),
+            _ratio(stage["waitRatio"]), _ratio(stage["readRatio"]), _ratio(stage["computeRatio"]),
+            _ratio(stage["writeRatio"]), stage["recordsRead"], _bytes(stage["shuffleOutputBytes"]),
+            _bytes(stage["shuffleOutputBytesSpilled"]), _ratio(stage["computeSkew"])))
+    lines.append("* slowest stages by slot-ms, ! compute or wait skew >= {}x".format(SKEW_THRESHOLD))
+    return "\n".join(lines)
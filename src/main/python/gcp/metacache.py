@@ -0,0 +1,122 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import threading
+import time
+from typing import Dict, Optional, Tuple, Union
+
+from google.api_core import exceptions
+from google.cloud import bigquery
+from google.cloud.bigquery import DEFAULT_RETRY
+
+# Seconds a table or dataset is served from the cache before it is revalidated with its etag
+DEFAULT_TTL = 60.0
+
+
+class MetadataCache():
+    """
+    Process-wide cache of table and dataset resources.
+    Entries younger than ttl are returned without an API call. Older entries are revalidated with a conditional
+    GET (If-None-Match: etag), so unchanged metadata is not downloaded again. Code that changes a table or
+    dataset must invalidate() it (or put() the updated resource).
+    """
+
+    def __init__(self, ttl: float = DEFAULT_TTL):
+        self.ttl = ttl
+        self._entries: Dict[str, Tuple[dict, float]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.invalidations = 0
+
+    def _fetch(self, client: bigquery.Client, path: str, span_name: str, etag: Optional[str]) -> Optional[dict]:
+        headers = {"If-None-Match": etag} if etag else None
+        try:
+            return client._call_api(DEFAULT_RETRY, span_name=span_name, span_attributes={"path": path},
+                                    method="GET", path=path, headers=headers)
+        except exceptions.NotModified:
+            return None
+
+    def _get(self, client: bigquery.Client, path: str, span_name: str, max_age: Optional[float]) -> dict:
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and time.monotonic() - entry[1] < (self.ttl if max_age is None else max_age):
+                self.hits += 1
+                return copy.deepcopy(entry[0])
+
+        resource = self._fetch(client, path, span_name, entry[0].get("etag") if entry is not None else None)
+        with self._lock:
+            if resource is None:
+                # 304 Not Modified, the cached copy is still current
+                self.revalidated += 1
+                resource = entry[0]
+            else:
+                self.misses += 1
+            self._entries[path] = (resource, time.monotonic())
+        return copy.deepcopy(resource)
+
+    def get_table(self, client: bigquery.Client, table: Union[bigquery.Table, bigquery.TableReference, str],
+                  max_age: Optional[float] = None) -> bigquery.Table:
+        """
+        Returns a table, fetched when it is not cached or older than max_age (default ttl). Pass max_age=0 after
+        a job has written the table to always revalidate it.
+        """
+        if isinstance(table, str):
+            table = bigquery.TableReference.from_string(table, default_project=client.project)
+        return bigquery.Table.from_api_repr(self._get(client, table.path, "BigQuery.getTable", max_age))
+
+    def get_dataset(self, client: bigquery.Client, dataset: Union[bigquery.Dataset, bigquery.DatasetReference, str],
+                    max_age: Optional[float] = None) -> bigquery.Dataset:
+        if isinstance(dataset, str):
+            dataset = bigquery.DatasetReference.from_string(dataset, default_project=client.project)
+        return bigquery.Dataset.from_api_repr(self._get(client, dataset.path, "BigQuery.getDataset", max_age))
+
+    def put(self, resource: Union[bigquery.Table, bigquery.Dataset]):
+        """
+        Caches a table or dataset returned by a create or update call
+        """
+        with self._lock:
+            self._entries[resource.path] = (resource.to_api_repr(), time.monotonic())
+
+    def invalidate(self, resource: Union[bigquery.Table, bigquery.TableReference, bigquery.Dataset,
+                                         bigquery.DatasetReference]):
+        """
+        Drops a table, or a dataset and all of its tables, from the cache
+        """
+        path = resource.path
+        with self._lock:
+            for key in [key for key in self._entries if key == path or key.startswith(path + "/tables/")]:
+                del self._entries[key]
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidated": self.revalidated,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "ttl": self.ttl,
+            }
+
+
+# Shared by every command in the process
+CACHE = MetadataCache()
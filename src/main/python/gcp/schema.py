@@ -0,0 +1,133 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import yaml
+
+# Standard SQL type names -> the legacy names returned by the tables API
+TYPE_ALIASES = {
+    "INT64": "INTEGER",
+    "FLOAT64": "FLOAT",
+    "BOOL": "BOOLEAN",
+    "STRUCT": "RECORD",
+    "BIGDECIMAL": "BIGNUMERIC",
+    "DECIMAL": "NUMERIC",
+}
+
+# Catalogue keys copied onto the table resource as is
+TABLE_KEYS = ("description", "labels", "timePartitioning", "rangePartitioning", "clustering", "friendlyName")
+
+
+def normalize_field(field: dict) -> dict:
+    """
+    A TableFieldSchema reduced to what defines it (name, type, mode, description, sub-fields) for comparison
+    """
+    field_type = field.get("type", "STRING").upper()
+    normalized = {
+        "name": field["name"].lower(),
+        "type": TYPE_ALIASES.get(field_type, field_type),
+        "mode": (field.get("mode") or "NULLABLE").upper(),
+    }
+    if field.get("fields"):
+        normalized["fields"] = [normalize_field(f) for f in field["fields"]]
+    return normalized
+
+
+def normalize_fields(fields: Optional[List[dict]]) -> List[dict]:
+    return [normalize_field(field) for field in fields or []]
+
+
+def read_catalogue(path: str) -> Dict[str, dict]:
+    """
+    Reads a table catalogue ({name: {description, sql, fields}}) from YAML, or the JSON that yaml2wdl writes
+    """
+    text = Path(path).read_text()
+    try:
+        catalogue = json.loads(text)
+        # yaml2wdl's GetYaml output is the catalogue JSON encoded as a string
+        if isinstance(catalogue, str):
+            catalogue = json.loads(catalogue)
+    except ValueError:
+        catalogue = yaml.safe_load(text)
+    if not isinstance(catalogue, dict):
+        raise ValueError("Table catalogue {} is not a mapping of table name to definition".format(path))
+    return catalogue
+
+
+def catalogue_table(project: str, dataset_id: str, name: str, definition: dict) -> dict:
+    """
+    Table resource for a catalogue entry
+    """
+    table = {
+        "tableReference": {"projectId": project, "datasetId": dataset_id, "tableId": name},
+    }
+    if definition.get("fields") is not None:
+        table["schema"] = {"fields": definition["fields"]}
+    for key in TABLE_KEYS:
+        if definition.get(key) is not None:
+            table[key] = definition[key]
+    return table
+
+
+def diff_fields(requested: List[dict], existing: List[dict],
+                prefix: str = "") -> Tuple[List[dict], List[str], List[str]]:
+    """
+    Compares a requested schema with an existing one, returning the merged schema (existing column order,
+    new columns appended), the changes update_table can apply in place and the changes that need a rebuild
+    """
+    merged, changes, incompatible = [], [], []
+    requested_by_name = {field["name"].lower(): field for field in requested}
+    existing_names = set()
+    for old in existing:
+        name = old["name"].lower()
+        existing_names.add(name)
+        path = prefix + old["name"]
+        new = requested_by_name.get(name)
+        if new is None:
+            incompatible.append("{}: removed".format(path))
+            merged.append(old)
+            continue
+        old_norm, new_norm = normalize_field(old), normalize_field(new)
+        field = dict(old)
+        if old_norm["type"] != new_norm["type"]:
+            incompatible.append("{}: type {} -> {}".format(path, old_norm["type"], new_norm["type"]))
+        if old_norm["mode"] != new_norm["mode"]:
+            if old_norm["mode"] == "REQUIRED" and new_norm["mode"] == "NULLABLE":
+                changes.append("{}: mode REQUIRED -> NULLABLE".format(path))
+                field["mode"] = "NULLABLE"
+            else:
+                incompatible.append("{}: mode {} -> {}".format(path, old_norm["mode"], new_norm["mode"]))
+        if "description" in new and new["description"] != old.get("description"):
+            changes.append("{}: description".format(path))
+            field["description"] = new["description"]
+        if old_norm["type"] == "RECORD" and new_norm["type"] == "RECORD":
+            field["fields"], sub_changes, sub_incompatible = diff_fields(new.get("fields") or [],
+                                                                         old.get("fields") or [], path + ".")
+            changes.extend(sub_changes)
+            incompatible.extend(sub_incompatible)
+        merged.append(field)
+
+    for new in requested:
+        if new["name"].lower() in existing_names:
+            continue
+        path = prefix + new["name"]
+        if (new.get("mode") or "NULLABLE").upper() == "REQUIRED":
+            incompatible.append("{}: added REQUIRED column".format(path))
+        else:
+            changes.append("{}: added".format(path))
+        merged.append(new)
+    return merged, changes, incompatible
@@ -0,0 +1,119 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+from google.cloud.bigquery_storage import BigQueryReadClient, types
+
+# File extension for each output format
+EXTENSIONS = {"PARQUET": ".parquet", "CSV": ".csv", "ARROW": ".arrow"}
+
+
+class ArrowFileWriter():
+    """
+    Writes record batches to a Parquet, CSV or Arrow IPC file, optionally shared between threads
+    """
+
+    def __init__(self, path: str, schema: pa.Schema, file_format: str):
+        self.path = path
+        self.rows = 0
+        self.lock = threading.Lock()
+        if file_format == "PARQUET":
+            self.writer = pq.ParquetWriter(path, schema, compression="snappy")
+        elif file_format == "CSV":
+            self.writer = pa_csv.CSVWriter(path, schema)
+        elif file_format == "ARROW":
+            self.writer = pa.ipc.new_file(path, schema)
+        else:
+            raise ValueError("Unsupported output format {}".format(file_format))
+
+    def write(self, batch: pa.RecordBatch):
+        with self.lock:
+            self.writer.write_table(pa.Table.from_batches([batch]))
+            self.rows += batch.num_rows
+
+    def close(self):
+        self.writer.close()
+
+
+def create_session(read_client: BigQueryReadClient, billing_project: str, table: bigquery.TableReference,
+                   columns: Optional[List[str]], row_filter: Optional[str], streams: int) -> types.ReadSession:
+    """
+    Opens a Storage Read API session on a table (Arrow format) with up to 'streams' streams
+    """
+    requested = types.ReadSession(
+        table="projects/{}/datasets/{}/tables/{}".format(table.project, table.dataset_id, table.table_id),
+        data_format=types.DataFormat.ARROW,
+        read_options=types.ReadSession.TableReadOptions(selected_fields=columns or [],
+                                                        row_restriction=row_filter or ""))
+    return read_client.create_read_session(parent="projects/{}".format(billing_project),
+                                           read_session=requested, max_stream_count=streams)
+
+
+def session_schema(session: types.ReadSession) -> pa.Schema:
+    return pa.ipc.read_schema(pa.py_buffer(session.arrow_schema.serialized_schema))
+
+
+def read_session(read_client: BigQueryReadClient, session: types.ReadSession, output_prefix: str,
+                 file_format: str = "PARQUET", merge: bool = False) -> dict:
+    """
+    Reads every stream of a session in parallel, writing one file per stream (or a single merged file).
+    Pages are written as they arrive, so memory use is bounded by the page size times the number of streams.
+    """
+    start = time.monotonic()
+    file_format = file_format.upper()
+    schema = session_schema(session)
+    extension = EXTENSIONS[file_format]
+
+    if merge or not session.streams:
+        merged = ArrowFileWriter(output_prefix + extension, schema, file_format)
+        writers = [merged] * len(session.streams)
+        files = [merged]
+    else:
+        writers = [ArrowFileWriter("{}-{:05d}{}".format(output_prefix, i, extension), schema, file_format)
+                   for i in range(len(session.streams))]
+        files = writers
+
+    def read_stream(stream: types.ReadStream, writer: ArrowFileWriter):
+        for page in read_client.read_rows(stream.name).rows(session).pages:
+            writer.write(page.to_arrow())
+
+    try:
+        if session.streams:
+            with ThreadPoolExecutor(max_workers=len(session.streams), thread_name_prefix="ReadStream") as executor:
+                futures = [executor.submit(read_stream, stream, writer)
+                           for stream, writer in zip(session.streams, writers)]
+                for future in futures:
+                    future.result()
+    finally:
+        for writer in files:
+            writer.close()
+
+    return {
+        "session": session.name,
+        "streams": len(session.streams),
+        "format": file_format,
+        "files": [{"path": writer.path, "rows": writer.rows, "bytes": os.path.getsize(writer.path)}
+                  for writer in files],
+        "rows": sum(writer.rows for writer in files),
+        "seconds": round(time.monotonic() - start, 3),
+    }
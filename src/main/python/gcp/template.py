@@ -0,0 +1,67 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+from typing import Dict, List, Optional, Set
+
+# Anything between a pair of braces is a candidate placeholder, eg. {dataset} or {my-table}
+PLACEHOLDER = re.compile(r"\{([^{}]+)\}")
+
+# Only placeholders that look like names are reported as unresolved, so SQL such as
+# REGEXP_CONTAINS(x, r'[0-9]{2,4}') or JSON '{"a": 1}' literals are not flagged
+NAMED_PLACEHOLDER = re.compile(r"^[A-Za-z_][A-Za-z0-9_.\-]*$")
+
+
+class TemplateException(Exception):
+    """Raised when a template cannot be fully rendered in strict mode"""
+
+
+class Template():
+    """
+    A {placeholder} template, parsed once so it can be rendered in a single pass.
+    Placeholders without a value are left untouched (as str.replace() did) and recorded in 'unresolved'.
+    """
+
+    def __init__(self, text: str):
+        # re.split() with one capturing group alternates literal text and placeholder names
+        self.parts: List[str] = PLACEHOLDER.split(text)
+        self.unresolved: Set[str] = set()
+
+    @property
+    def placeholders(self) -> Set[str]:
+        return set(self.parts[1::2])
+
+    def render(self, values: Dict[str, str], strict: bool = False) -> str:
+        out: List[str] = []
+        self.unresolved = set()
+        for i, part in enumerate(self.parts):
+            if i % 2 == 0:
+                out.append(part)
+            elif part in values:
+                out.append(str(values[part]))
+            else:
+                if NAMED_PLACEHOLDER.match(part):
+                    self.unresolved.add(part)
+                out.append("{" + part + "}")
+        if strict and self.unresolved:
+            raise TemplateException("No value for placeholder(s): {}".format(
+                ", ".join(sorted(self.unresolved))))
+        return "".join(out)
+
+
+def render(text: str, values: Optional[Dict[str, str]], strict: bool = False) -> str:
+    """
+    Renders {key} placeholders in text with values in a single pass
+    """
+    return Template(text).render(values or {}, strict=strict)
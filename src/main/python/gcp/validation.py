@@ -0,0 +1,305 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import heapq
+import io
+import json
+import os
+import re
+import sys
+import time
+from bisect import bisect_right, insort
+from typing import Dict, List, Optional
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.json as pa_json
+
+from .columnar import BLOCK_SIZE
+
+# Text accepted by BigQuery for each column type when loading CSV/JSON (types not listed are not checked)
+_DATE = r"\d{4}[-/]\d{1,2}[-/]\d{1,2}"
+_TIME = r"\d{1,2}:\d{1,2}(:\d{1,2}(\.\d{1,9})?)?"
+_NUMBER = r"[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?"
+PATTERNS = {
+    "INTEGER": r"^\s*[+-]?\d+\s*$",
+    "INT64": r"^\s*[+-]?\d+\s*$",
+    "FLOAT": r"^\s*(" + _NUMBER + r"|[+-]?(inf|infinity|nan))\s*$",
+    "FLOAT64": r"^\s*(" + _NUMBER + r"|[+-]?(inf|infinity|nan))\s*$",
+    "NUMERIC": r"^\s*" + _NUMBER + r"\s*$",
+    "BIGNUMERIC": r"^\s*" + _NUMBER + r"\s*$",
+    "BOOLEAN": r"^\s*(true|false|t|f|yes|no|y|n|1|0)\s*$",
+    "BOOL": r"^\s*(true|false|t|f|yes|no|y|n|1|0)\s*$",
+    "DATE": r"^\s*" + _DATE + r"\s*$",
+    "TIME": r"^\s*" + _TIME + r"\s*$",
+    "DATETIME": r"^\s*" + _DATE + r"([ T]" + _TIME + r")?\s*$",
+    "TIMESTAMP": r"^\s*(" + _DATE + r"([ T]" + _TIME + r")?\s*(Z|UTC|[+-]\d{1,2}(:?\d{2})?|[A-Za-z_]+/[A-Za-z_/]+)?|"
+                 + _NUMBER + r")\s*$",
+}
+# Types that JSON carries as strings
+TEXT_TYPES = {"STRING", "BYTES", "DATE", "TIME", "DATETIME", "TIMESTAMP", "GEOGRAPHY", "JSON"}
+_COMPILED = {name: re.compile(pattern, re.IGNORECASE) for name, pattern in PATTERNS.items()}
+
+
+class ValidationReport():
+    """
+    Collects bad rows while a file is streamed, keeping at most max_bad_rows of them
+    """
+
+    def __init__(self, source_file: str, max_bad_rows: int):
+        self.source_file = source_file
+        self.max_bad_rows = max_bad_rows
+        self.rows = 0
+        self.bad_row_count = 0
+        self._heap: List[tuple] = []
+        self.warnings: List[str] = []
+        self.complete = True
+        self.start = time.monotonic()
+
+    def add(self, row: Optional[int], errors: List[str], text: Optional[str] = None):
+        self.bad_row_count += 1
+        bad_row = {"row": row, "errors": errors}
+        if text is not None:
+            bad_row["text"] = text[:1000]
+        # Batches may be checked out of order, so keep the lowest numbered rows (a max-heap on row number)
+        key = -(row if row is not None else sys.maxsize)
+        if len(self._heap) < self.max_bad_rows:
+            heapq.heappush(self._heap, (key, self.bad_row_count, bad_row))
+        elif self.max_bad_rows > 0 and key > self._heap[0][0]:
+            heapq.heapreplace(self._heap, (key, self.bad_row_count, bad_row))
+
+    def to_dict(self) -> dict:
+        seconds = time.monotonic() - self.start
+        source_bytes = os.path.getsize(self.source_file)
+        return {
+            "sourceFile": self.source_file,
+            "valid": self.bad_row_count == 0 and self.complete,
+            "complete": self.complete,
+            "rows": self.rows,
+            "badRowCount": self.bad_row_count,
+            "badRows": [bad_row for _, _, bad_row in sorted(self._heap, reverse=True)],
+            "warnings": self.warnings,
+            "sourceBytes": source_bytes,
+            "seconds": round(seconds, 3),
+            "megabytesPerSecond": round(source_bytes / seconds / 1e6, 1) if seconds else None,
+        }
+
+
+def _check_columns(columns: Dict[str, pa.Array], schema_fields: List[dict], num_rows: int) -> Dict[int, List[str]]:
+    """
+    Vectorised check of string columns against the schema, returning {batch row index: [errors]}
+    """
+    errors: Dict[int, List[str]] = {}
+    for field in schema_fields:
+        name = field["name"]
+        field_type = field.get("type", "STRING").upper()
+        column = columns.get(name)
+        if column is None:
+            if field.get("mode") == "REQUIRED":
+                for i in range(num_rows):
+                    errors.setdefault(i, []).append("{}: missing REQUIRED value".format(name))
+            continue
+
+        if field.get("mode") == "REQUIRED" and column.null_count > 0:
+            for i in pc.indices_nonzero(pc.is_null(column)).to_pylist():
+                errors.setdefault(i, []).append("{}: missing REQUIRED value".format(name))
+
+        pattern = PATTERNS.get(field_type)
+        if pattern is None or not pa.types.is_string(column.type):
+            continue
+        # Nulls are never a type error, fill_null makes them count as a match
+        matches = pc.fill_null(pc.match_substring_regex(column, pattern, ignore_case=True), True)
+        if not pc.all(matches).as_py():
+            bad = pc.indices_nonzero(pc.invert(matches))
+            for i, value in zip(bad.to_pylist(), column.take(bad).to_pylist()):
+                errors.setdefault(i, []).append("{}: invalid {} value {!r}".format(name, field_type, value[:100]))
+    return errors
+
+
+def _line_number(data_row: int, skip_leading_rows: int, invalid_rows: List[int]) -> int:
+    """
+    Line number in the file of a parsed data row, allowing for skipped leading rows and invalid rows
+    """
+    line = skip_leading_rows + data_row + 1
+    skipped = 0
+    while True:
+        preceding = bisect_right(invalid_rows, line)
+        if preceding == skipped:
+            return line
+        line += preceding - skipped
+        skipped = preceding
+
+
+def validate_csv(source_file: str, schema_fields: List[dict], skip_leading_rows: int = 0,
+                 field_delimiter: str = ",", quote_character: str = '"', max_bad_rows: int = 10) -> dict:
+    """
+    Streams a CSV file in batches, checking column count, types and REQUIRED modes against the schema
+    """
+    report = ValidationReport(source_file, max_bad_rows)
+    names = [field["name"] for field in schema_fields]
+    invalid_rows: List[int] = []
+
+    def invalid_row(row) -> str:
+        insort(invalid_rows, row.number)
+        report.add(row.number, ["expected {} columns, found {}".format(row.expected_columns, row.actual_columns)],
+                   row.text)
+        return "skip"
+
+    # Every column is read as a string so that one bad value doesn't abort the whole batch
+    read_options = pa_csv.ReadOptions(column_names=names, skip_rows=skip_leading_rows, use_threads=True,
+                                      block_size=BLOCK_SIZE)
+    convert_options = pa_csv.ConvertOptions(column_types={name: pa.string() for name in names},
+                                            null_values=[""], strings_can_be_null=True)
+    try:
+        parse_options = pa_csv.ParseOptions(delimiter=field_delimiter, quote_char=quote_character or False,
+                                            invalid_row_handler=invalid_row)
+    except TypeError:
+        # pyarrow before 7.0 has no invalid row handler and stops at the first row with the wrong number of
+        # columns, so check the file row by row instead
+        _check_csv_rows(report, schema_fields, skip_leading_rows, field_delimiter, quote_character)
+        return report.to_dict()
+
+    try:
+        reader = pa_csv.open_csv(source_file, read_options=read_options, parse_options=parse_options,
+                                 convert_options=convert_options)
+        for batch in reader:
+            columns = {name: batch.column(i) for i, name in enumerate(batch.schema.names)}
+            for i, errors in _check_columns(columns, schema_fields, batch.num_rows).items():
+                report.add(_line_number(report.rows + i, skip_leading_rows, invalid_rows), errors)
+            report.rows += batch.num_rows
+    except pa.ArrowInvalid as ex:
+        report.complete = False
+        report.add(None, [str(ex)])
+    report.rows += len(invalid_rows)
+    return report.to_dict()
+
+
+def _check_csv_rows(report: ValidationReport, schema_fields: List[dict], skip_leading_rows: int,
+                    field_delimiter: str, quote_character: str):
+    """
+    Row by row check of a CSV file with the csv module, for pyarrow versions without an invalid row handler
+    """
+    names = [field["name"] for field in schema_fields]
+    with open(report.source_file, newline='', encoding='utf-8', errors='replace') as source:
+        reader = csv.reader(source, delimiter=field_delimiter, quotechar=quote_character or None,
+                            quoting=csv.QUOTE_MINIMAL if quote_character else csv.QUOTE_NONE)
+        for _ in range(skip_leading_rows):
+            next(reader, None)
+        while True:
+            # Rows are reported by the line they start on (quoted values can span lines)
+            line = reader.line_num + 1
+            row = next(reader, None)
+            if row is None:
+                break
+            if not row:
+                # Blank lines are skipped, as Arrow and BigQuery do
+                continue
+            report.rows += 1
+            if len(row) != len(names):
+                report.add(line, ["expected {} columns, found {}".format(len(names), len(row))],
+                           field_delimiter.join(row))
+                continue
+            errors = _check_record({name: value if value != "" else None for name, value in zip(names, row)},
+                                   schema_fields)
+            if errors:
+                report.add(line, errors)
+
+
+def _as_text(value) -> Optional[str]:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float, str)):
+        return str(value)
+    return None
+
+
+def _check_record(record, schema_fields: List[dict]) -> List[str]:
+    """
+    Row by row check of a parsed JSON record, used for blocks that Arrow can't parse as a whole
+    """
+    if not isinstance(record, dict):
+        return ["not a JSON object"]
+    errors = []
+    for field in schema_fields:
+        name = field["name"]
+        field_type = field.get("type", "STRING").upper()
+        value = record.get(name)
+        if value is None:
+            if field.get("mode") == "REQUIRED":
+                errors.append("{}: missing REQUIRED value".format(name))
+            continue
+        text = _as_text(value)
+        pattern = _COMPILED.get(field_type)
+        if pattern is not None and text is not None and not pattern.match(text):
+            errors.append("{}: invalid {} value {!r}".format(name, field_type, text[:100]))
+    return errors
+
+
+def validate_json(source_file: str, schema_fields: List[dict], max_bad_rows: int = 10) -> dict:
+    """
+    Streams a newline delimited JSON file in blocks of whole lines, checking types and REQUIRED modes
+    """
+    report = ValidationReport(source_file, max_bad_rows)
+    known = {field["name"] for field in schema_fields}
+    unknown = set()
+    # Keep date/time strings as text, otherwise Arrow infers timestamps that no longer match the schema type
+    parse_options = pa_json.ParseOptions(explicit_schema=pa.schema(
+        [(field["name"], pa.string()) for field in schema_fields
+         if field.get("type", "STRING").upper() in TEXT_TYPES and field.get("mode") != "REPEATED"]))
+    with open(source_file, 'rb') as source:
+        while True:
+            block = source.read(BLOCK_SIZE)
+            if not block:
+                break
+            # Extend the block to the end of the current line
+            block += source.readline()
+            lines = block.count(b"\n") + (0 if block.endswith(b"\n") else 1)
+            try:
+                table = pa_json.read_json(io.BytesIO(block), parse_options=parse_options)
+            except pa.ArrowInvalid:
+                table = None
+
+            if table is not None and table.num_rows == lines:
+                unknown.update(set(table.column_names) - known)
+                columns = {}
+                for name in table.column_names:
+                    column = table.column(name).combine_chunks()
+                    if pa.types.is_primitive(column.type) or pa.types.is_string(column.type):
+                        column = pc.cast(column, pa.string())
+                    columns[name] = column
+                for i, errors in _check_columns(columns, schema_fields, table.num_rows).items():
+                    report.add(report.rows + i + 1, errors)
+            else:
+                # Mixed types or malformed lines, fall back to checking each line
+                for i, line in enumerate(block.splitlines()):
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError as ex:
+                        report.add(report.rows + i + 1, ["invalid JSON: {}".format(ex)], line.decode(errors="replace"))
+                        continue
+                    if isinstance(record, dict):
+                        unknown.update(set(record) - known)
+                    errors = _check_record(record, schema_fields)
+                    if errors:
+                        report.add(report.rows + i + 1, errors)
+            report.rows += lines
+
+    if unknown:
+        report.warnings.append("Fields not in schema (rejected unless ignoreUnknownValues): {}".format(
+            ", ".join(sorted(unknown))))
+    return report.to_dict()
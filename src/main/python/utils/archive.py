@@ -0,0 +1,214 @@
+#
+# Copyright (c) 2020 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Backup archive formats
+
+Version 1 is a single JSON object (optionally gzipped) holding the dataset and every table record.
+Version 2 splits it in two: the table records are streamed to an NDJSON object as tables complete, and the archive
+URI holds a small index with the dataset, the totals and each table's byte range in the records object. When the
+archive is gzipped every record is its own gzip member, so a byte range can be decompressed on its own and the
+records object as a whole is still a valid gzip file.
+
+Backups write version 1 unless archiveFormat is 2, as restores with earlier releases only read version 1.
+"""
+
+import gzip
+import json
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import List
+
+from google.cloud.exceptions import GoogleCloudError, NotFound
+from google.cloud.storage import Client
+from google.cloud.storage.blob import Blob
+
+FORMAT_VERSION = 2
+
+logger = logging.getLogger(__name__)
+
+
+def records_uri(index_uri: str) -> str:
+    """gs://bucket/project.dataset.json[.gz] -> gs://bucket/project.dataset.tables.ndjson[.gz]"""
+    compressed = index_uri.endswith(".gz")
+    base = index_uri[:-3] if compressed else index_uri
+    if base.endswith(".json"):
+        base = base[:-5]
+    return base + ".tables.ndjson" + (".gz" if compressed else "")
+
+
+def checkpoint_uri(index_uri: str, name: str = "checkpoint") -> str:
+    """gs://bucket/project.dataset.json[.gz] -> gs://bucket/project.dataset.<name>.json"""
+    base = index_uri[:-3] if index_uri.endswith(".gz") else index_uri
+    if base.endswith(".json"):
+        base = base[:-5]
+    return "{}.{}.json".format(base, name)
+
+
+def write_json(client: Client, uri: str, value: dict):
+    data = json.dumps(value, indent=2)
+    if uri.endswith(".gz"):
+        Blob.from_string(uri, client).upload_from_string(gzip.compress(data.encode()))
+    else:
+        Blob.from_string(uri, client).upload_from_string(data)
+
+
+def read_json(client: Client, uri: str) -> dict:
+    if uri.endswith(".gz"):
+        return json.loads(gzip.decompress(Blob.from_string(uri, client).download_as_bytes()))
+    return json.loads(Blob.from_string(uri, client).download_as_text())
+
+
+class ArchiveWriter:
+    """
+    Streams table records to the records object of a version 2 archive, then writes the index
+    """
+
+    def __init__(self, client: Client, index_uri: str):
+        self.client = client
+        self.index_uri = index_uri
+        self.uri = records_uri(index_uri)
+        self.compress = index_uri.endswith(".gz")
+        self.entries = []
+        self.offset = 0
+        self.lock = threading.Lock()
+        self.file = Blob.from_string(self.uri, client).open("wb")
+
+    def write(self, record: dict):
+        data = (json.dumps(record, sort_keys=True) + "\n").encode()
+        if self.compress:
+            data = gzip.compress(data)
+        with self.lock:
+            self.file.write(data)
+            self.entries.append({
+                "tableId": record['table']['tableReference']['tableId'],
+                "offset": self.offset,
+                "length": len(data)
+            })
+            self.offset += len(data)
+
+    def close(self, archive: dict) -> dict:
+        """Finishes the records object and writes the index (archive without its tables, plus the byte ranges)"""
+        self.file.close()
+        index = dict(archive)
+        index.pop('tables', None)
+        index.update({
+            "format": FORMAT_VERSION,
+            "records": self.uri,
+            "tables": self.entries
+        })
+        write_json(self.client, self.index_uri, index)
+        return index
+
+
+def byte_ranges(entries: List[dict]) -> List[tuple]:
+    """Merges the byte ranges of adjacent records, returning (start, end) pairs with end exclusive"""
+    ranges = []
+    for entry in sorted(entries, key=lambda e: e['offset']):
+        if ranges and ranges[-1][1] == entry['offset']:
+            ranges[-1] = (ranges[-1][0], entry['offset'] + entry['length'])
+        else:
+            ranges.append((entry['offset'], entry['offset'] + entry['length']))
+    return ranges
+
+
+def read_tables(client: Client, archive: dict, table_expr: str = ".*", threads: int = 8) -> List[dict]:
+    """
+    Table records of an archive whose table id matches table_expr. Version 1 archives already hold every record,
+    version 2 records are fetched with one ranged read per run of adjacent matching records.
+    """
+    if archive.get('format', 1) < 2:
+        return archive['tables']
+
+    pattern = re.compile("^" + table_expr + "$", re.IGNORECASE)
+    entries = [entry for entry in archive['tables'] if pattern.match(entry['tableId'])]
+    blob = Blob.from_string(archive['records'], client)
+    compressed = archive['records'].endswith(".gz")
+
+    def fetch(byte_range: tuple) -> List[dict]:
+        # Checksums cover the whole object so they can't be checked for a range
+        data = blob.download_as_bytes(start=byte_range[0], end=byte_range[1] - 1, checksum=None)
+        if compressed:
+            data = gzip.decompress(data)
+        return [json.loads(line) for line in data.splitlines() if line.strip()]
+
+    tables = []
+    with ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="ReadArchive") as executor:
+        for records in executor.map(fetch, byte_ranges(entries)):
+            tables.extend(records)
+    return tables
+
+
+class Checkpoint:
+    """
+    Tables completed by a backup or restore, kept in a JSON object next to the archive so that a failed run can be
+    resumed. The object is rewritten at most every interval seconds as tables complete, and by flush().
+    """
+
+    def __init__(self, client: Client, uri: str, interval: float = 30.0):
+        self.client = client
+        self.uri = uri
+        self.interval = interval
+        self.records = {}
+        self.lock = threading.Lock()
+        self.written = time.monotonic()
+        self.dirty = False
+        self.closed = False
+
+    def load(self) -> dict:
+        """Records of the previous run by table id, which are kept unless replaced"""
+        try:
+            previous = read_json(self.client, self.uri).get('tables', {})
+        except NotFound:
+            previous = {}
+        with self.lock:
+            self.records.update(previous)
+        return previous
+
+    def add(self, table_id: str, record: dict):
+        with self.lock:
+            self.records[table_id] = record
+            self.dirty = True
+            due = time.monotonic() - self.written >= self.interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        # Written under the lock so that an older checkpoint never replaces a newer one
+        with self.lock:
+            if not self.dirty or self.closed:
+                return
+            try:
+                write_json(self.client, self.uri, {
+                    "updated": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                    "tables": self.records
+                })
+                self.dirty = False
+            except GoogleCloudError as ex:
+                logger.warning("Could not write checkpoint %s: %s", self.uri, ex)
+            self.written = time.monotonic()
+
+    def delete(self):
+        """Removes the checkpoint once the run has completed"""
+        with self.lock:
+            self.closed = True
+        try:
+            Blob.from_string(self.uri, self.client).delete()
+        except NotFound:
+            pass
@@ -16,14 +16,13 @@
 #
 #
 import array as arr
-import gzip
-import io
 import json
 import logging
 import os
 import re
 import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
 from datetime import datetime
 from datetime import timezone
 from urllib import parse
@@ -41,6 +40,10 @@ from google.oauth2 import service_account
 from google.cloud.exceptions import NotFound, Conflict
 import uuid
 
+from gcp import datasetcopy, infoschema
+from gcp.metacache import CACHE
+from utils.archive import ArchiveWriter, Checkpoint, checkpoint_uri, read_json, read_tables, write_json
+
 """
 BigQuery backup / restore utility
 """
@@ -62,6 +65,10 @@ class Table:
         if type(table) is bigquery.TableReference:
             self.table = bigquery.Table(table)
 
+        # A table read in bulk (INFORMATION_SCHEMA) is used as is
+        if type(table) is bigquery.Table:
+            self.table = table
+
         self.client = client
 
     def scrub(self, d: dict):
@@ -75,7 +82,7 @@ class Table:
 
     def get(self):
         """Retrieves table from BigQuery"""
-        self.table = self.client.get_table(self.table)
+        self.table = CACHE.get_table(self.client, self.table)
 
     def create(self, drop=False):
         """Creates table in BigQuery, dropping it if it already exists (option)"""
@@ -86,6 +93,7 @@ class Table:
         except Conflict as ex:
             if drop:
                 self.client.delete_table(self.table)
+                CACHE.invalidate(self.table)
                 logger.warning("Dropped %s %s:%s.%s", self.table.table_type, self.table.project,
                                self.table.dataset_id,
                                self.table.table_id)
@@ -95,6 +103,7 @@ class Table:
                              self.table.project, self.table.dataset_id, self.table.table_id,
                              self.table.full_table_id)
                 raise ex
+        CACHE.put(self.table)
         logger.info("Created %s %s", self.table.table_type, self.table.full_table_id)
 
     def load(self, extract_job: dict, drop=False):
@@ -104,6 +113,20 @@ class Table:
         """
 
         self.create(drop)
+        self.load_data(extract_job)
+
+    def load_data(self, extract_job: dict, partition=None):
+        """Loads the output of an extract job into the (already created) table, or one partition of it
+        :param extract_job: BigQuery extract job to use for loading information
+        :param partition: Partition id the job extracted, loaded through the table$partition decorator
+        """
+
+        # __NULL__ and __UNPARTITIONED__ rows are appended to the table, which puts them back in the same partition
+        if partition is None or partition.startswith("__"):
+            destination = self.table
+        else:
+            destination = bigquery.TableReference(bigquery.DatasetReference(self.table.project, self.table.dataset_id),
+                                                  "{}${}".format(self.table.table_id, partition))
 
         # Check if this table needs string to datetime conversion fixes, if so load into a temporary staging table
         if extract_job['configuration']['extract']['destinationFormat'] == "AVRO" \
@@ -112,9 +135,9 @@ class Table:
                 "{}.{}.{}_{}".format(self.table.project, self.table.dataset_id, self.table.table_id,
                                      uuid.uuid4().hex[0:6]))
         else:
-            load_table = self.table
+            load_table = destination
 
-        logger.debug("%s %s:%s.%s", "Staging" if load_table is not self.table else "Loading",
+        logger.debug("%s %s:%s.%s", "Staging" if load_table is not destination else "Loading",
                      load_table.project, load_table.dataset_id, load_table.table_id)
 
         job_config = bigquery.job.LoadJobConfig()
@@ -127,21 +150,21 @@ class Table:
         self.client.load_table_from_uri(
             source_uris=extract_job['configuration']['extract']['destinationUris'],
             destination=load_table,
-            location=load_table.location,
+            location=self.table.location,
             job_config=job_config
         ).result()
 
         # If the table was loaded into a staging table, use SQL query to cast STRINGS back to DATETIME
-        if load_table is not self.table:
+        if load_table is not destination:
 
             logger.debug("Casting %s:%s.%s to %s:%s.%s",
                          load_table.project, load_table.dataset_id, load_table.table_id,
-                         self.table.project, self.table.dataset_id, self.table.table_id
+                         destination.project, destination.dataset_id, destination.table_id
                          )
 
             # Cast STRING datetime fields in staging table to DATETIME fields in destination table
             query_job_config = bigquery.job.QueryJobConfig()
-            query_job_config.destination = self.table
+            query_job_config.destination = destination
             query_job_config.use_legacy_sql = False
             query_job_config.use_query_cache = False
 
@@ -163,15 +186,28 @@ class Table:
                          load_table.table_id)
             self.client.delete_table(load_table)
 
-        logger.info("Loaded %s", self.table.full_table_id)
+        CACHE.invalidate(self.table)
+        logger.info("Loaded %s%s", self.table.full_table_id, "" if partition is None else "$" + partition)
 
     def extract_metadata(self):
         """Convenience function that returns a table and a None job definition"""
-        self.get()
+        if not self.table.full_table_id:
+            self.get()
         return self.table, None
 
-    def extract(self, destination_uri, compression, dest_format, print_header, merge_csv):
-        """Extract a BigQuery table to a GCS storage bucket path """
+    def partitions(self, threshold) -> list:
+        """Ids of the partitions of a time or range partitioned table bigger than threshold bytes, otherwise empty.
+        A threshold of None or less than zero never splits a table."""
+        if not self.table.full_table_id:
+            self.get()
+        if threshold is None or threshold < 0 or self.table.table_type != "TABLE" or not self.table.schema or \
+                (self.table.time_partitioning is None and self.table.range_partitioning is None) or \
+                (self.table.num_bytes or 0) <= threshold:
+            return []
+        return sorted(self.client.list_partitions(self.table))
+
+    def extract(self, destination_uri, compression, dest_format, print_header, merge_csv, partition=None):
+        """Extract a BigQuery table (or one partition of it) to a GCS storage bucket path """
         if not self.table.full_table_id:
             self.get()
 
@@ -180,7 +216,8 @@ class Table:
 
         job_config = bigquery.job.ExtractJobConfig()
 
-        split_required = self.table.num_bytes > 1000000000
+        # The size of a single partition isn't known, so partitions are always extracted to wildcard URIs
+        split_required = partition is not None or self.table.num_bytes > 1000000000
 
         if dest_format == bigquery.DestinationFormat.CSV:
             if print_header:
@@ -197,9 +234,10 @@ class Table:
             job_config.use_avro_logical_types = True
         job_config.destination_format = dest_format
 
-        final_uri = "{}/{}.{}.{}{}".format(destination_uri,
-                                           self.table.project, self.table.dataset_id, self.table.table_id,
-                                           "-*" if split_required else "")
+        final_uri = "{}/{}.{}.{}{}{}".format(destination_uri,
+                                             self.table.project, self.table.dataset_id, self.table.table_id,
+                                             "" if partition is None else "." + partition,
+                                             "-*" if split_required else "")
 
         if dest_format == bigquery.DestinationFormat.AVRO:
             final_uri += ".avro"
@@ -210,14 +248,67 @@ class Table:
         if compression == bigquery.Compression.GZIP:
             final_uri += ".gz"
 
-        logger.info("Extracting %s to %s", self.table.full_table_id, final_uri)
+        source = self.table.reference
+        if partition is not None:
+            source = bigquery.TableReference(bigquery.DatasetReference(source.project, source.dataset_id),
+                                             "{}${}".format(source.table_id, partition))
+        logger.info("Extracting %s%s to %s", self.table.full_table_id, "" if partition is None else "$" + partition,
+                    final_uri)
 
-        return self.table, self.client.extract_table(source=self.table, destination_uris=final_uri,
+        return self.table, self.client.extract_table(source=source, destination_uris=final_uri,
                                                      location=self.table.location,
                                                      job_config=job_config).result()
 
+    def snapshot(self, snapshot_dataset: bigquery.DatasetReference, suffix: str, expiration_days=None):
+        """Creates a table snapshot (zero-copy, read-only) of the table in snapshot_dataset"""
+        if not self.table.full_table_id:
+            self.get()
+        if self.table.table_type != "TABLE":
+            return self.table, None
+        destination = snapshot_dataset.table("{}__{}__{}".format(self.table.dataset_id, self.table.table_id, suffix))
+        logger.info("Creating snapshot of %s as %s", self.table.full_table_id, destination.table_id)
+        result = datasetcopy.copy_table(self.client, self.table.reference, destination, "SNAPSHOT", True,
+                                        self.table.location, expiration_days)
+        return self.table, {
+            "tableReference": destination.to_api_repr(),
+            "jobId": result['jobId'],
+            "expirationDays": expiration_days
+        }
+
+    def restore_snapshot(self, snapshot: dict, method="CLONE", drop=False):
+        """Recreates the table from a table snapshot, with a zero-copy clone or a (full) restore copy job
+        :param snapshot: Snapshot recorded in the archive by snapshot()
+        :param method: CLONE or COPY
+        :param drop: Replace the table if it exists
+        """
+        source = bigquery.TableReference.from_api_repr(snapshot['tableReference'])
+        destination = self.table.reference
+        if method == "COPY":
+            job_config = bigquery.CopyJobConfig()
+            job_config.operation_type = "RESTORE"
+            job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE if drop \
+                else bigquery.WriteDisposition.WRITE_EMPTY
+            job = self.client.copy_table(source, destination, job_config=job_config, location=self.table.location)
+        else:
+            job = self.client.query("CREATE {}TABLE {} CLONE {}".format("OR REPLACE " if drop else "",
+                                                                        datasetcopy.quote(destination),
+                                                                        datasetcopy.quote(source)),
+                                    location=self.table.location)
+        job.result()
+        CACHE.invalidate(destination)
+
+        # The restored table takes the expiration of the archived table, not that of the snapshot
+        restored = CACHE.get_table(self.client, destination, max_age=0)
+        if restored.expires != self.table.expires:
+            restored.expires = self.table.expires
+            restored = self.client.update_table(restored, ["expires"])
+        CACHE.put(restored)
+        logger.info("Restored %s from snapshot %s (%s)", self.table.full_table_id or destination.table_id,
+                    source.table_id, method)
+
     def delete(self):
         self.client.delete_table(table=self.table)
+        CACHE.invalidate(self.table)
 
 
 class Dataset:
@@ -240,11 +331,11 @@ class Dataset:
                     d.pop(k, None)
 
     def get(self, project, dataset_id):
-        self.dataset = self.client.get_dataset(bigquery.DatasetReference(project, dataset_id))
+        self.dataset = CACHE.get_dataset(self.client, bigquery.DatasetReference(project, dataset_id))
 
     def create(self, drop=False):
         try:
-            existing = self.client.get_dataset(self.dataset)
+            existing = CACHE.get_dataset(self.client, self.dataset)
             if not drop:
                 # Update mandatory fields
                 logger.warning("Dataset %s already exists, metadata will not be updated", existing.dataset_id)
@@ -254,12 +345,21 @@ class Dataset:
                 logger.warning("Deleting dataset %s and all contents", existing.dataset_id)
                 self.client.delete_dataset(self.dataset, delete_contents=True)
                 self.client.create_dataset(dataset=self.dataset, exists_ok=False)
+            CACHE.invalidate(self.dataset)
         except NotFound:
             self.client.create_dataset(dataset=self.dataset, exists_ok=False)
+            CACHE.invalidate(self.dataset)
             logger.info("Created dataset %s", self.dataset.dataset_id)
 
     def delete(self):
         self.client.delete_dataset(self.dataset, delete_contents=True)
+        CACHE.invalidate(self.dataset)
+
+
+# Partitioned tables bigger than this (bytes) are extracted with one job per partition
+PARTITION_THRESHOLD = 10 * 1000000000
+# Days table snapshots are kept for in snapshot mode
+SNAPSHOT_EXPIRATION_DAYS = 7
 
 
 class BackupException(Exception):
@@ -268,7 +368,12 @@ class BackupException(Exception):
 
 def backup(credentials, quota_project, dataset_expr, backup_uri, compression=bigquery.Compression.SNAPPY,
            destination_format=bigquery.DestinationFormat.AVRO, threads=25, print_header=False,
-           metadata_only=False, merge_csv=False) -> str:
+           metadata_only=False, merge_csv=False, bulk_metadata=True, archive_format=1, resume=False,
+           checkpoint_interval=30.0, partition_threshold=PARTITION_THRESHOLD, mode="EXTRACT", snapshot_dataset=None,
+           snapshot_expiration_days=SNAPSHOT_EXPIRATION_DAYS, bq_client=None, gcs_client=None, executor=None) -> str:
+    """
+    Backs up one dataset. backup_datasets passes its clients and worker pool, otherwise backup creates its own.
+    """
     project, dataset_id, table_expr = __parse_dataset_expr(dataset_expr)
 
     # Defaults from None
@@ -277,13 +382,8 @@ def backup(credentials, quota_project, dataset_expr, backup_uri, compression=big
     if destination_format is None:
         destination_format = bigquery.DestinationFormat.AVRO
 
-    # Default pool size is too small so we create a custom HTTP adapter with a bigger pool
-    bq_client = bigquery.Client(project=quota_project, credentials=credentials)
-    adapter = requests.adapters.HTTPAdapter(pool_connections=128, pool_maxsize=128, max_retries=5)
-    bq_client._http.mount("https://", adapter)
-    bq_client._http._auth_request.session.mount("https://", adapter)
-
-    gcs_client = Client(project=quota_project, credentials=credentials)
+    if bq_client is None or gcs_client is None:
+        bq_client, gcs_client = __clients(credentials, quota_project)
 
     # Backup
     dataset = Dataset(bq_client)
@@ -292,75 +392,257 @@ def backup(credentials, quota_project, dataset_expr, backup_uri, compression=big
     archive = {
         'dataset': dataset.dataset.to_api_repr()
     }
+
+    # Snapshot mode creates table snapshots in a backup dataset instead of extracting tables to GCS
+    snapshot = None
+    mode = (mode or "EXTRACT").upper()
+    if mode not in ("EXTRACT", "SNAPSHOT"):
+        raise ValueError("Unsupported backup mode {}, expected EXTRACT or SNAPSHOT".format(mode))
+    if mode == "SNAPSHOT" and not metadata_only:
+        snapshot_ref = bigquery.DatasetReference.from_string(snapshot_dataset or dataset_id + "_snapshots",
+                                                            default_project=project)
+        snapshots = bigquery.Dataset(snapshot_ref)
+        snapshots.location = dataset.dataset.location
+        bq_client.create_dataset(snapshots, exists_ok=True)
+        snapshot = {
+            "dataset": snapshot_ref,
+            "suffix": start_time.strftime("%Y%m%d%H%M%S"),
+            "expirationDays": snapshot_expiration_days
+        }
+        archive['mode'] = mode
+    if not backup_uri.endswith(".json") and not backup_uri.endswith(".json.gz"):
+        # Create backup URI in format gs://backup_uri/project.dataset_id.json
+        uri = "{}{}.{}.json".format(backup_uri, dataset.dataset.project, dataset.dataset.dataset_id)
+    else:
+        # Otherwise use URI exactly as provided
+        uri = backup_uri
+    # Extracts that completed are checkpointed, so that a failed backup can be resumed
+    checkpoint = Checkpoint(gcs_client, checkpoint_uri(uri), checkpoint_interval)
+    previous = checkpoint.load() if resume and not metadata_only else {}
+    if previous:
+        logger.info("Resuming backup, %s tables in checkpoint %s", len(previous), checkpoint.uri)
     try:
+        # Version 2 archives stream each table record as soon as its extract completes
+        writer = ArchiveWriter(gcs_client, uri) if archive_format >= 2 else None
+        totals = {'table_bytes': 0, 'gcs_bytes': 0}
+
+        def complete(table_job: dict):
+            # If the final output is to be merged CSV, merge the jobs that resulted in multiple output files
+            if merge_csv and "job" in table_job and "merge" not in table_job:
+                dest_uri = table_job['job']['configuration']['extract']['destinationUri']
+                if "-*" in dest_uri:
+                    fields = [field['name'] for field in
+                              table_job['table']['schema']['fields']] if print_header else None
+                    bucket_name = parse.urlparse(dest_uri).netloc
+                    prefix = parse.urlparse(dest_uri).path[1:].partition("*")[0]
+                    merged = __merge_csv(gcs_client, bucket_name, prefix, fields)
+                    merged_uri = "gs://{}/{}".format(merged.bucket.name, merged.name)
+                    table_job.update({
+                        'merge': {
+                            'destinationUri': merged_uri
+                        }
+                    })
+                    logger.info("Merged %s to %s", dest_uri, merged_uri)
+
+            totals['table_bytes'] += int(table_job['table']['numBytes'])
+            for job in [] if metadata_only else __extract_jobs(table_job):
+                job_uri = job['configuration']['extract']['destinationUri']
+                blobs = gcs_client.list_blobs(bucket_or_name=parse.urlparse(job_uri).hostname,
+                                              prefix=parse.urlparse(job_uri).path[1:].partition("*")[0])
+                for blob in blobs:
+                    totals['gcs_bytes'] += blob.size
+
+            if writer is not None:
+                writer.write(table_job)
+            if __job_succeeded(table_job):
+                checkpoint.add(table_job['table']['tableReference']['tableId'], table_job)
+
         archive['tables'] = __extract_dataset(bq_client, dataset.dataset, backup_uri, table_expr, compression,
                                               destination_format, print_header, merge_csv, metadata_only,
-                                              threads)
-
-        # If the final output is to be merged CSV, enumerate all of the jobs that resulted in multiple output files
-        if merge_csv:
-            for table_job in archive['tables']:
-                if "job" in table_job:
-                    dest_uri = table_job['job']['configuration']['extract']['destinationUri']
-                    if "-*" in dest_uri:
-                        fields = [field['name'] for field in
-                                  table_job['table']['schema']['fields']] if print_header else None
-                        bucket_name = parse.urlparse(dest_uri).netloc
-                        prefix = parse.urlparse(dest_uri).path[1:].partition("*")[0]
-                        merged = __merge_csv(gcs_client, bucket_name, prefix, fields)
-                        merged_uri = "gs://{}/{}".format(merged.bucket.name, merged.name)
-                        table_job.update({
-                            'merge': {
-                                'destinationUri': merged_uri
-                            }
-                        })
-                        logger.info("Merged %s to %s", dest_uri, merged_uri)
+                                              threads, bulk_metadata, complete, previous, partition_threshold,
+                                              snapshot, executor)
 
         complete_time = datetime.now(timezone.utc)
         archive['start_date'] = start_time.isoformat(timespec='seconds')
         archive['finish_date'] = complete_time.isoformat(timespec='seconds')
         archive['seconds_elapsed'] = (complete_time - start_time).seconds
+        archive['table_count'] = len(archive['tables'])
 
-        table_bytes = 0
-        for table in archive['tables']:
-            table_bytes += int(table['table']['numBytes'])
+        table_bytes = totals['table_bytes']
         archive['table_bytes'] = table_bytes
 
-        if not metadata_only:
-            gcs_bytes = 0
-            for table in archive['tables']:
-                if 'job' not in table:
-                    continue
-                job_uri = table['job']['configuration']['extract']['destinationUri']
-                blobs = gcs_client.list_blobs(bucket_or_name=parse.urlparse(job_uri).hostname,
-                                              prefix=parse.urlparse(job_uri).path[1:].partition("*")[0])
-                for blob in blobs:
-                    gcs_bytes += blob.size
+        if not metadata_only and snapshot is None:
+            gcs_bytes = totals['gcs_bytes']
             archive['gcs_bytes'] = gcs_bytes
             if table_bytes > 0 and gcs_bytes > 0:
                 archive['compression_ratio'] = round(table_bytes / gcs_bytes, 2)
 
-        if not backup_uri.endswith(".json") and not backup_uri.endswith(".json.gz"):
-            # Create backup URI in format gs://backup_uri/project.dataset_id.json
-            uri = "{}{}.{}.json".format(backup_uri, dataset.dataset.project, dataset.dataset.dataset_id)
+        if writer is not None:
+            writer.close(archive)
         else:
-            # Otherwise use URI exactly as provided
-            uri = backup_uri
-        if uri.endswith(".gz"):
-            Blob.from_string(uri, gcs_client).upload_from_string(__gzip_str(json.dumps(archive, indent=2)))
-        else:
-            Blob.from_string(uri, gcs_client).upload_from_string(json.dumps(archive, indent=2))
+            write_json(gcs_client, uri, archive)
+        checkpoint.delete()
         logger.info("Backup complete, wrote %s %s", uri, "(metadata only)" if metadata_only else "")
-        return json.dumps({
+        logger.debug("Metadata cache: %s", CACHE.stats())
+        result = {
             "dataset": dataset.dataset.to_api_repr()['datasetReference'],
             "backup_uri": uri
-        })
+        }
+        for key in ('start_date', 'finish_date', 'seconds_elapsed', 'table_count', 'table_bytes', 'gcs_bytes',
+                    'compression_ratio'):
+            if key in archive:
+                result[key] = archive[key]
+        return json.dumps(result)
     except GoogleCloudError as error:
         logger.error(error.message)
         raise BackupException
     except TimeoutError:
         logger.error("Connection timeout error!")
         raise BackupException
+    finally:
+        checkpoint.flush()
+
+
+def backup_datasets(credentials, quota_project, datasets, backup_uri, threads=25, dataset_threads=4,
+                    **options) -> str:
+    """
+    Backs up several datasets of quota_project, one archive per dataset, then writes a summary of the run to
+    gs://backup_uri/project.backup-summary.json. Every dataset shares one pair of clients and one pool of threads
+    workers, dataset_threads datasets are backed up at a time.
+    :param datasets: List of dataset names, or a regular expression matched against the datasets of the project
+    :param options: Other backup() arguments, applied to every dataset
+    """
+    bq_client, gcs_client = __clients(credentials, quota_project)
+    dataset_exprs = __match_datasets(bq_client, quota_project, datasets)
+    logger.info("Backing up %s datasets: %s", len(dataset_exprs), ", ".join(dataset_exprs))
+
+    def backup_one(dataset_expr: str) -> dict:
+        return json.loads(backup(credentials, quota_project, dataset_expr, backup_uri, threads=threads,
+                                 bq_client=bq_client, gcs_client=gcs_client, executor=workers, **options))
+
+    start_time = datetime.now(timezone.utc)
+    # Datasets only wait on their tables, all extract, snapshot and metadata jobs run in the one worker pool
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="Worker") as workers, \
+            ThreadPoolExecutor(max_workers=max(1, dataset_threads), thread_name_prefix="Dataset") as drivers:
+        results = __dataset_results({drivers.submit(backup_one, dataset_expr): dataset_expr
+                                     for dataset_expr in dataset_exprs})
+    complete_time = datetime.now(timezone.utc)
+
+    summary = {
+        "project": quota_project,
+        "start_date": start_time.isoformat(timespec='seconds'),
+        "finish_date": complete_time.isoformat(timespec='seconds'),
+        "seconds_elapsed": (complete_time - start_time).seconds,
+        "table_bytes": sum(result.get('table_bytes', 0) for result in results),
+        "datasets": results
+    }
+    gcs_bytes = sum(result.get('gcs_bytes', 0) for result in results)
+    if gcs_bytes > 0:
+        summary['gcs_bytes'] = gcs_bytes
+        summary['compression_ratio'] = round(summary['table_bytes'] / gcs_bytes, 2)
+    summary_uri = "{}{}.backup-summary.json".format(backup_uri, quota_project)
+    write_json(gcs_client, summary_uri, summary)
+
+    failed = [result['dataset']['datasetId'] for result in results if 'error' in result]
+    logger.info("Backed up %s of %s datasets in %s seconds, wrote %s", len(results) - len(failed), len(results),
+                summary['seconds_elapsed'], summary_uri)
+    if failed:
+        logger.error("Backup failed for %s", ", ".join(failed))
+        raise BackupException
+    return json.dumps({"summary_uri": summary_uri, **summary})
+
+
+def restore_datasets(credentials, quota_project, summary_uri, datasets=None, threads=25, dataset_threads=4,
+                     **options) -> str:
+    """
+    Restores the datasets of a backup_datasets summary to datasets of the same name in quota_project
+    :param datasets: List of dataset names or a regular expression to restore only some of them (default all)
+    :param options: Other restore() arguments, applied to every dataset
+    """
+    bq_client, gcs_client = __clients(credentials, quota_project)
+    try:
+        summary = read_json(gcs_client, summary_uri)
+    except NotFound:
+        logger.error("Could not find %s!", summary_uri)
+        raise BackupException
+    backups = [result for result in summary['datasets'] if 'error' not in result]
+    if datasets:
+        names = {dataset_expr.partition(":")[2] for dataset_expr in
+                 __match_datasets(None, quota_project, datasets,
+                                  [result['dataset']['datasetId'] for result in backups])}
+        backups = [result for result in backups if result['dataset']['datasetId'] in names]
+    logger.info("Restoring %s datasets from %s", len(backups), summary_uri)
+
+    def restore_one(result: dict) -> dict:
+        start = datetime.now(timezone.utc)
+        restored = restore(credentials, quota_project, "{}:{}".format(quota_project, result['dataset']['datasetId']),
+                           result['backup_uri'], threads, bq_client=bq_client, gcs_client=gcs_client,
+                           executor=workers, **options)
+        return {
+            "dataset": json.loads(restored),
+            "backup_uri": result['backup_uri'],
+            "seconds_elapsed": (datetime.now(timezone.utc) - start).seconds
+        }
+
+    start_time = datetime.now(timezone.utc)
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="Worker") as workers, \
+            ThreadPoolExecutor(max_workers=max(1, dataset_threads), thread_name_prefix="Dataset") as drivers:
+        results = __dataset_results({drivers.submit(restore_one, result): "{}:{}".format(
+            quota_project, result['dataset']['datasetId']) for result in backups})
+    seconds = (datetime.now(timezone.utc) - start_time).seconds
+
+    failed = [result['dataset']['datasetId'] for result in results if 'error' in result]
+    logger.info("Restored %s of %s datasets in %s seconds", len(results) - len(failed), len(results), seconds)
+    if failed:
+        logger.error("Restore failed for %s", ", ".join(failed))
+        raise BackupException
+    return json.dumps({"summary_uri": summary_uri, "seconds_elapsed": seconds, "datasets": results})
+
+
+def __clients(credentials, quota_project):
+    """BigQuery and GCS clients with a connection pool big enough for many concurrent jobs"""
+    # Default pool size is too small so we create a custom HTTP adapter with a bigger pool
+    bq_client = bigquery.Client(project=quota_project, credentials=credentials)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=128, pool_maxsize=128, max_retries=5)
+    bq_client._http.mount("https://", adapter)
+    bq_client._http._auth_request.session.mount("https://", adapter)
+
+    gcs_client = Client(project=quota_project, credentials=credentials)
+    gcs_client._http.mount("https://", requests.adapters.HTTPAdapter(pool_connections=128, pool_maxsize=128))
+    return bq_client, gcs_client
+
+
+def __match_datasets(client: bigquery.Client, project: str, datasets, dataset_ids: list = None) -> list:
+    """
+    project:dataset expressions for a list of dataset names, or for the datasets (of the project, or dataset_ids)
+    matching a regular expression
+    """
+    if not isinstance(datasets, str):
+        return ["{}:{}".format(project, dataset) for dataset in datasets]
+    if dataset_ids is None:
+        dataset_ids = [item.dataset_id for item in client.list_datasets(project)]
+    try:
+        pattern = re.compile("^" + datasets + "$", re.IGNORECASE)
+    except re.error as ex:
+        logger.error("Dataset regular expression parsing error: %s at position %s of \"%s\"", ex.msg, ex.pos,
+                     ex.pattern)
+        raise BackupException
+    return ["{}:{}".format(project, dataset_id) for dataset_id in sorted(dataset_ids) if pattern.match(dataset_id)]
+
+
+def __dataset_results(futures: dict) -> list:
+    """Results of per dataset futures in submission order, a failed dataset is recorded with its error"""
+    results = []
+    for future, dataset_expr in futures.items():
+        try:
+            results.append(future.result())
+        except (BackupException, GoogleCloudError, ValueError) as ex:
+            project, dataset_id, _ = __parse_dataset_expr(dataset_expr)
+            results.append({
+                "dataset": {"projectId": project, "datasetId": dataset_id},
+                "error": str(ex) or type(ex).__name__
+            })
+    return results
 
 
 def __parse_dataset_expr(dataset_expr):
@@ -456,25 +738,23 @@ def __merge_csv(client: Client, bucket_name: str, prefix: str, fields = None) ->
 
 def restore(credentials, quota_project, dataset_expr, backup_uri, threads, keep_expiration=False, metadata_only=False,
             drop_dataset=False, drop_tables=False, default_table_expiration=None,
-            default_partition_expiration=None) -> str:
+            default_partition_expiration=None, resume=False, checkpoint_interval=30.0, snapshot_method="CLONE",
+            bq_client=None, gcs_client=None, executor=None) -> str:
     # Get the destination (new) dataset project, dataset_id, table regex
     project, dataset_id, table_expr = __parse_dataset_expr(dataset_expr)
 
-    # Default pool size is too small so we create a custom HTTP adapter with a bigger pool
-    bq_client = bigquery.Client(project=quota_project, credentials=credentials)
-    adapter = requests.adapters.HTTPAdapter(pool_connections=128, pool_maxsize=128, max_retries=5)
-    bq_client._http.mount("https://", adapter)
-    bq_client._http._auth_request.session.mount("https://", adapter)
-
-    gcs_client = Client(project=quota_project, credentials=credentials)
+    if bq_client is None or gcs_client is None:
+        bq_client, gcs_client = __clients(credentials, quota_project)
 
     start_time = datetime.now(timezone.utc)
     try:
-        if str(backup_uri).endswith(".gz"):
-            archive = json.loads(
-                gzip.decompress(Blob.from_string(backup_uri, gcs_client).download_as_bytes()))
-        else:
-            archive = json.loads(Blob.from_string(str(backup_uri), gcs_client).download_as_text())
+        archive = read_json(gcs_client, str(backup_uri))
+        # Only the records of matching tables are read from a version 2 archive
+        archive['tables'] = read_tables(gcs_client, archive, table_expr, threads)
+    except re.error as ex:
+        logger.error("Table regular expression parsing error: %s at position %s of \"%s\"", ex.msg, ex.pos,
+                     ex.pattern)
+        raise BackupException
     except NotFound:
         logger.error("Could not find %s!", backup_uri)
         raise BackupException
@@ -492,98 +772,247 @@ def restore(credentials, quota_project, dataset_expr, backup_uri, threads, keep_
     logger.info("Restoring backup of %s:%s to %s:%s for all tables matching %s %s", source_project, source_dataset,
                 project, dataset_id, table_expr, "(metadata only)" if metadata_only else "")
 
+    # Restored tables are checkpointed next to the archive, so that a failed restore can be resumed
+    checkpoint = Checkpoint(gcs_client, checkpoint_uri(str(backup_uri), "restore.{}.{}".format(project, dataset_id)),
+                            checkpoint_interval)
+    restored = checkpoint.load() if resume else {}
+    if restored:
+        logger.info("Resuming restore, %s tables in checkpoint %s", len(restored), checkpoint.uri)
+
     dataset = Dataset(bq_client, archive['dataset'])
     try:
-        dataset.create(drop=drop_dataset)
+        # Never drop a dataset that is part way through being restored
+        dataset.create(drop=drop_dataset and not restored)
         __load_dataset(bq_client, dataset, archive['tables'], table_expr, keep_expiration, metadata_only, threads,
-                       drop_tables)
+                       drop_tables, checkpoint, restored, resume, (snapshot_method or "CLONE").upper(), executor)
+        checkpoint.delete()
     except GoogleCloudError as ex:
         logger.error("Error during restore: %s", ex.message)
         raise BackupException
     except TimeoutError:
         logger.error("Connection timeout error!")
         raise BackupException
+    finally:
+        checkpoint.flush()
 
     complete_time = datetime.now(timezone.utc)
 
     logger.info("Restore of dataset %s%s:%s completed in %s seconds", "metadata " if metadata_only else "",
                 dataset.dataset.project, dataset.dataset.dataset_id, (complete_time - start_time).seconds)
+    logger.debug("Metadata cache: %s", CACHE.stats())
 
     return json.dumps(dataset.dataset.to_api_repr()['datasetReference'])
 
 
 def __load_dataset(client: bigquery.Client, dataset, tables: dict, table_expr: str,
-                   keep_expiration, metadata_only, threads, drop_tables):
-    futures = []
-    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="LoadJob") as executor:
+                   keep_expiration, metadata_only, threads, drop_tables, checkpoint: Checkpoint = None,
+                   restored: dict = None, resume=False, snapshot_method="CLONE", executor=None):
+    # Future -> (table id, partitions still to load for tables extracted partition by partition)
+    pending = {}
+    # A shared executor (restore_datasets) is left running for the other datasets
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="LoadJob") if executor is None \
+            else nullcontext(executor) as executor:
         # Submit jobs to load in parallel
         for table in tables:
             # Replace project and dataset in backup with new destination project and dataset
             table['table']['tableReference']['projectId'] = dataset.dataset.project
             table['table']['tableReference']['datasetId'] = dataset.dataset.dataset_id
+            # Only an expiration that is still in the future is kept (milliseconds since the epoch)
             if 'expirationTime' in table['table'] and (not keep_expiration or
-                                                       int(table['table']['expirationTime']) >=
-                                                       datetime.now(timezone.utc).microsecond * 1000):
+                                                       int(table['table']['expirationTime']) <=
+                                                       datetime.now(timezone.utc).timestamp() * 1000):
                 del table['table']['expirationTime']
 
             dest_table = Table(client, table['table'])
+            table_id = dest_table.table.table_id
             try:
                 # Only restore tables that match the given regex
-                if re.match("^" + table_expr + "$", dest_table.table.table_id, re.IGNORECASE):
-                    if metadata_only or 'job' not in table:
-                        futures.append(executor.submit(dest_table.create, drop_tables))
+                if re.match("^" + table_expr + "$", table_id, re.IGNORECASE):
+                    # A resumed restore replaces tables an earlier run may have left part way
+                    if restored and table_id in restored:
+                        logger.info("Skipping %s, it was restored by an earlier run", table_id)
+                    elif not metadata_only and table.get('partitions'):
+                        # Partitions are loaded once the table has been created
+                        group = {"table": dest_table, "partitions": table['partitions'], "remaining": None}
+                        pending[executor.submit(dest_table.create, drop_tables or resume)] = (table_id, group)
+                    elif not metadata_only and 'snapshot' in table:
+                        pending[executor.submit(dest_table.restore_snapshot, table['snapshot'], snapshot_method,
+                                                drop_tables or resume)] = (table_id, None)
+                    elif metadata_only or 'job' not in table:
+                        pending[executor.submit(dest_table.create, drop_tables or resume)] = (table_id, None)
                     else:
-                        futures.append(executor.submit(dest_table.load, table['job'], drop_tables))
+                        pending[executor.submit(dest_table.load, table['job'], drop_tables or resume)] = \
+                            (table_id, None)
                 else:
                     logger.info("Skipping %s %s, it does not match pattern %s", dest_table.table.table_type,
-                                dest_table.table.table_id, table_expr)
+                                table_id, table_expr)
             except re.error as ex:
                 logger.error("Table regular expression parsing error: %s at position %s of \"%s\"", ex.msg, ex.pos,
                              ex.pattern)
                 raise BackupException
 
-    for future in as_completed(futures):
-        future.result()
+        errors = []
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                table_id, group = pending.pop(future)
+                try:
+                    future.result()
+                except Exception as ex:
+                    errors.append(ex)
+                    if group is not None:
+                        group['failed'] = True
+                    continue
+                if group is not None:
+                    if group['remaining'] is None:
+                        group['remaining'] = len(group['partitions'])
+                        for partition in group['partitions']:
+                            pending[executor.submit(group['table'].load_data, partition['job'],
+                                                    partition['partition'])] = (table_id, group)
+                    else:
+                        group['remaining'] -= 1
+                    if group['remaining'] or group.get('failed'):
+                        continue
+                    logger.info("Loaded %s partitions of %s", len(group['partitions']), table_id)
+                if checkpoint is not None:
+                    checkpoint.add(table_id, {
+                        "finished": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                        "metadataOnly": metadata_only
+                    })
+    if errors:
+        raise errors[0]
+
+
+def __table_metadata(client: bigquery.Client, dataset: bigquery.Dataset) -> dict:
+    """Table resources for the whole dataset from INFORMATION_SCHEMA, tables missing from the result use get_table"""
+    try:
+        resources, fallback = infoschema.dataset_tables(client, dataset)
+    except GoogleCloudError as ex:
+        logger.warning("Could not read INFORMATION_SCHEMA of %s, reading tables one by one: %s", dataset.dataset_id,
+                       ex.message)
+        return {}
+    logger.info("Read metadata of %s tables from INFORMATION_SCHEMA, %s tables need get_table", len(resources),
+                len(fallback))
+    return resources
 
 
 def __extract_dataset(client: bigquery.Client, dataset: bigquery.Dataset, backup_uri, table_expr: str, compression,
-                      destination_format, print_header, merge_csv, metadata_only, threads):
+                      destination_format, print_header, merge_csv, metadata_only, threads, bulk_metadata=True,
+                      on_table=None, previous: dict = None, partition_threshold=None, snapshot: dict = None,
+                      executor=None):
     tables = []
-    futures = []
-    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="ExtractJob") as executor:
+    resources = __table_metadata(client, dataset) if bulk_metadata else {}
+
+    def extract(table: Table, resumed: dict = None):
+        """Returns the table record, or (table, partition ids) for a table to be extracted partition by partition"""
+        if resumed is not None:
+            # Reuse the extract of an earlier run if the table hasn't been modified since
+            if not table.table.full_table_id:
+                table.get()
+            if table.table.to_api_repr().get('lastModifiedTime') == resumed['table'].get('lastModifiedTime'):
+                logger.info("Skipping %s, unchanged since it was backed up by an earlier run", table.table.table_id)
+                return resumed
+        if metadata_only:
+            table, job = table.extract_metadata()
+        elif snapshot is not None:
+            table, table_snapshot = table.snapshot(snapshot['dataset'], snapshot['suffix'], snapshot['expirationDays'])
+            if table_snapshot is None:
+                return {"table": table.to_api_repr()}
+            return {"table": table.to_api_repr(), "snapshot": table_snapshot}
+        else:
+            # Merged CSV output needs the whole table in one job
+            partitions = [] if merge_csv else table.partitions(partition_threshold)
+            if partitions:
+                return table, partitions
+            table, job = table.extract(os.path.dirname(backup_uri), compression, destination_format, print_header,
+                                       merge_csv)
+        if job is None:
+            return {"table": table.to_api_repr()}
+        if job.error_result is not None:
+            logger.error("Failed to extract %s:%s.%s: %s", job.source.project, job.source.dataset_id,
+                         job.source.table_id, job.error_result)
+        else:
+            logger.debug("Extracted %s:%s.%s", job.source.project, job.source.dataset_id, job.source.table_id)
+        return {"table": table.to_api_repr(), "job": job.to_api_repr()}
+
+    def extract_partition(table: Table, partition: str) -> dict:
+        _, job = table.extract(os.path.dirname(backup_uri), compression, destination_format, print_header, merge_csv,
+                               partition)
+        if job.error_result is not None:
+            logger.error("Failed to extract %s:%s.%s: %s", job.source.project, job.source.dataset_id,
+                         job.source.table_id, job.error_result)
+        return {"partition": partition, "job": job.to_api_repr()}
+
+    # A shared executor (backup_datasets) is left running for the other datasets
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="ExtractJob") if executor is None \
+            else nullcontext(executor) as executor:
+        # Future -> the record its partition belongs to (None for whole tables)
+        pending = {}
         # Submit extract jobs in parallel
-        for item in client.list_tables(dataset):
+        for item in client.list_tables(dataset, page_size=1000):
             table_ref = item.reference
             if re.match('^' + table_expr + "$", table_ref.table_id, re.IGNORECASE):
-                table = Table(client, table_ref)
-                if metadata_only:
-                    futures.append(executor.submit(table.extract_metadata))
+                if table_ref.table_id in resources:
+                    table = Table(client, bigquery.Table.from_api_repr(resources[table_ref.table_id]))
                 else:
-                    futures.append(
-                        executor.submit(table.extract, os.path.dirname(backup_uri), compression, destination_format,
-                                        print_header, merge_csv))
+                    table = Table(client, table_ref)
+                resumed = previous.get(table_ref.table_id) if previous else None
+                pending[executor.submit(extract, table, resumed if __job_succeeded(resumed) else None)] = None
             else:
                 logger.info("Skipping %s, it does not match pattern %s", table_ref.table_id, table_expr)
 
-        for future in as_completed(futures):
-            table, job = future.result()
-            if job is not None:
-                if job.error_result is not None:
-                    logger.error("Failed to extract %:%s.%s: %s", job.source.project, job.source.dataset_id,
-                                 job.source.table_id, job.error_result)
-                else:
-                    logger.debug("Extracted %s:%s.%s", job.source.project, job.source.dataset_id, job.source.table_id)
-                tables.append({"table": table.to_api_repr(), "job": job.to_api_repr()})
-            else:
-                tables.append({"table": table.to_api_repr()})
+        # Keep collecting after a failure, so every completed extract reaches the checkpoint
+        errors = []
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                group = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as ex:
+                    errors.append(ex)
+                    continue
+                if isinstance(result, tuple):
+                    # Each partition is its own job in the same pool, the record is complete with the last one
+                    table, partitions = result
+                    logger.info("Extracting %s partitions of %s", len(partitions), table.table.table_id)
+                    group = {"record": {"table": table.table.to_api_repr(), "partitions": []},
+                             "remaining": len(partitions)}
+                    for partition in partitions:
+                        pending[executor.submit(extract_partition, table, partition)] = group
+                    continue
+                if group is not None:
+                    group['record']['partitions'].append(result)
+                    group['remaining'] -= 1
+                    if group['remaining']:
+                        continue
+                    result = group['record']
+                    result['partitions'].sort(key=lambda p: p['partition'])
+                if on_table is not None:
+                    on_table(result)
+                tables.append(result)
+    if errors:
+        raise errors[0]
     return tables
 
 
-def __gzip_str(string_: str) -> bytes:
-    out = io.BytesIO()
-    with gzip.GzipFile(fileobj=out, mode='w') as fo:
-        fo.write(string_.encode())
-    return out.getvalue()
+def __extract_jobs(record: dict) -> list:
+    """The extract jobs of a table record, one per partition for tables extracted partition by partition"""
+    if 'job' in record:
+        return [record['job']]
+    return [partition['job'] for partition in record.get('partitions', [])]
+
+
+def __job_succeeded(record: dict) -> bool:
+    """True for a table record whose extract jobs all completed without errors (or that has a snapshot)"""
+    if record is None:
+        return False
+    if 'snapshot' in record:
+        return True
+    jobs = __extract_jobs(record)
+    return len(jobs) > 0 and all(job.get('status', {}).get('state') == "DONE" and
+                                 job.get('status', {}).get('errorResult') is None for job in jobs)
+
 
 def header_file(credentials, quota_project, dataset_id: str, backup_uri):
     client = bigquery.Client()
@@ -593,7 +1022,7 @@ def header_file(credentials, quota_project, dataset_id: str, backup_uri):
     tables = client.list_tables(dataset_id)  
 
     for table in tables:
-        tableOb = client.get_table("{}.{}.{}".format(table.project, table.dataset_id, table.table_id))
+        tableOb = CACHE.get_table(client, table.reference)
         result = ["{}".format(schema.name) for schema in tableOb.schema]
        
         fileName = '{}.{}.{}_header.csv'.format(quota_project, table.dataset_id, table.table_id)
@@ -630,6 +1059,8 @@ def main():
         os.environ['GCLOUD_PROJECT'] = args.project_id
     
     json_options = json.loads(config)    
+    if json_options.get("metadataCacheTtl") is not None:
+        CACHE.ttl = float(json_options["metadataCacheTtl"])
     
     if json_options["logLevel"] != "NONE":
         logging.basicConfig(format='%(asctime)s %(threadName)-13s %(levelname)-8s %(message)s', level=json_options["logLevel"])
@@ -642,16 +1073,71 @@ def main():
         )
 
     try:
-        datasetExpr = "{}:{}".format(json_options["quotaProject"],json_options["datasetName"])
+        datasetExpr = "{}:{}".format(json_options["quotaProject"], json_options.get("datasetName"))
+        # A list of datasets or a dataset regex selects several datasets, run with one worker pool
+        datasets = json_options.get("datasets") or json_options.get("datasetRegex")
 
-        if args.command == "backup" and args.config is not None:
+        if args.command == "backup" and args.config is not None and datasets:
             if not json_options["backupUri"].endswith('/'):
-                json_options["backupUri"] += "/", 
+                json_options["backupUri"] += "/"
+            result = backup_datasets(credentials=_credentials, quota_project=json_options["quotaProject"],
+                                     datasets=datasets, backup_uri=json_options["backupUri"],
+                                     threads=json_options["threads"],
+                                     dataset_threads=json_options.get("datasetThreads") or 4,
+                                     compression=json_options["compression"],
+                                     destination_format=json_options["destinationFormat"],
+                                     print_header=json_options["printHeader"],
+                                     metadata_only=json_options["metadataOnly"], merge_csv=json_options["mergeCsv"],
+                                     bulk_metadata=json_options.get("bulkMetadata") is not False,
+                                     archive_format=json_options.get("archiveFormat") or 1,
+                                     resume=bool(json_options.get("resume")),
+                                     checkpoint_interval=json_options.get("checkpointInterval") or 30.0,
+                                     partition_threshold=PARTITION_THRESHOLD
+                                     if json_options.get("partitionThreshold") is None
+                                     else json_options["partitionThreshold"],
+                                     mode=json_options.get("mode"),
+                                     snapshot_dataset=json_options.get("snapshotDataset"),
+                                     snapshot_expiration_days=json_options.get("snapshotExpirationDays") or
+                                     SNAPSHOT_EXPIRATION_DAYS)
+            if json_options["json"]:
+                print(result)
+            sys.exit(0)
+
+        elif args.command == "backup" and args.config is not None:
+            if not json_options["backupUri"].endswith('/'):
+                json_options["backupUri"] += "/"
             result = backup(credentials=_credentials, quota_project=json_options["quotaProject"],
                                 dataset_expr=datasetExpr, backup_uri=json_options["backupUri"], threads=json_options["threads"],
                                 compression=json_options["compression"], destination_format=json_options["destinationFormat"],
                                 print_header=json_options["printHeader"], metadata_only=json_options["metadataOnly"],
-                                merge_csv=json_options["mergeCsv"])
+                                merge_csv=json_options["mergeCsv"],
+                                bulk_metadata=json_options.get("bulkMetadata") is not False,
+                                archive_format=json_options.get("archiveFormat") or 1,
+                                resume=bool(json_options.get("resume")),
+                                checkpoint_interval=json_options.get("checkpointInterval") or 30.0,
+                                partition_threshold=PARTITION_THRESHOLD if json_options.get("partitionThreshold") is None
+                                else json_options["partitionThreshold"],
+                                mode=json_options.get("mode"), snapshot_dataset=json_options.get("snapshotDataset"),
+                                snapshot_expiration_days=json_options.get("snapshotExpirationDays") or
+                                SNAPSHOT_EXPIRATION_DAYS)
+            if json_options["json"]:
+                print(result)
+            sys.exit(0)
+
+        elif args.command == "restore" and args.config is not None and datasets:
+            # backupRestoreJsonUri is the summary written by a multi-dataset backup
+            result = restore_datasets(credentials=_credentials, quota_project=json_options["quotaProject"],
+                                      summary_uri=json_options["backupRestoreJsonUri"], datasets=datasets,
+                                      threads=json_options["threads"],
+                                      dataset_threads=json_options.get("datasetThreads") or 4,
+                                      keep_expiration=json_options.get("keepExpiration"),
+                                      metadata_only=json_options["metadataOnly"],
+                                      drop_dataset=json_options["dropDataset"], drop_tables=json_options["dropTables"],
+                                      default_table_expiration=json_options.get("defaultTableExpiration"),
+                                      default_partition_expiration=json_options.get("defaultPartitionExpiration"),
+                                      resume=bool(json_options.get("resume")),
+                                      checkpoint_interval=json_options.get("checkpointInterval") or 30.0,
+                                      snapshot_method=json_options.get("restoreMethod"))
             if json_options["json"]:
                 print(result)
             sys.exit(0)
@@ -662,7 +1148,10 @@ def main():
                                 keep_expiration=json_options["keepExpiration"], metadata_only=json_options["metadataOnly"],
                                 drop_dataset=json_options["dropDataset"], drop_tables=json_options["dropTables"],
                                 default_table_expiration=json_options["defaultTableExpiration"],
-                                default_partition_expiration=json_options["defaultPartitionExpiration"])
+                                default_partition_expiration=json_options["defaultPartitionExpiration"],
+                                resume=bool(json_options.get("resume")),
+                                checkpoint_interval=json_options.get("checkpointInterval") or 30.0,
+                                snapshot_method=json_options.get("restoreMethod"))
             if json_options["json"]:
                 print(result)
             sys.exit(0)
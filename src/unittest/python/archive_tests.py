@@ -0,0 +1,131 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import unittest
+from unittest import mock
+
+from google.cloud.exceptions import NotFound
+
+from utils import archive
+
+
+class FakeBlob():
+    """In-memory stand-in for the GCS blob calls used by utils.archive"""
+    objects = {}
+
+    def __init__(self, uri):
+        self.uri = uri
+
+    @classmethod
+    def from_string(cls, uri, client=None):
+        return cls(uri)
+
+    def open(self, mode):
+        blob = self
+
+        class Writer(io.BytesIO):
+            def close(self):
+                blob.objects[blob.uri] = self.getvalue()
+                super().close()
+        return Writer()
+
+    def upload_from_string(self, data):
+        self.objects[self.uri] = data.encode() if isinstance(data, str) else data
+
+    def _data(self):
+        if self.uri not in self.objects:
+            raise NotFound(self.uri)
+        return self.objects[self.uri]
+
+    def download_as_bytes(self, start=None, end=None, checksum="md5"):
+        data = self._data()
+        return data if start is None else data[start:end + 1]
+
+    def download_as_text(self):
+        return self._data().decode()
+
+    def delete(self):
+        self._data()
+        del self.objects[self.uri]
+
+
+def record(table_id, rows):
+    return {"table": {"tableReference": {"projectId": "p", "datasetId": "d", "tableId": table_id},
+                      "numRows": str(rows)},
+            "job": {"jobReference": {"jobId": "job-" + table_id}}}
+
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeBlob.objects = {}
+        patcher = mock.patch.object(archive, "Blob", FakeBlob)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_uris(self):
+        self.assertEqual(archive.records_uri("gs://b/p.d.json.gz"), "gs://b/p.d.tables.ndjson.gz")
+        self.assertEqual(archive.records_uri("gs://b/p.d.json"), "gs://b/p.d.tables.ndjson")
+        self.assertEqual(archive.checkpoint_uri("gs://b/p.d.json.gz"), "gs://b/p.d.checkpoint.json")
+        self.assertEqual(archive.checkpoint_uri("gs://b/p.d.json", "restore.q.e"), "gs://b/p.d.restore.q.e.json")
+
+    def test_byte_ranges(self):
+        entries = [{"offset": 10, "length": 5}, {"offset": 0, "length": 10}, {"offset": 20, "length": 1}]
+        self.assertEqual(archive.byte_ranges(entries), [(0, 15), (20, 21)])
+
+    def round_trip(self, uri):
+        records = [record("t{}".format(i), i) for i in range(6)]
+        writer = archive.ArchiveWriter(None, uri)
+        for table in records:
+            writer.write(table)
+        writer.close({"dataset": {"datasetReference": {"projectId": "p", "datasetId": "d"}}, "tables": records})
+
+        index = archive.read_json(None, uri)
+        self.assertEqual(index["format"], archive.FORMAT_VERSION)
+        self.assertEqual(index["records"], archive.records_uri(uri))
+        self.assertEqual([entry["tableId"] for entry in index["tables"]], ["t{}".format(i) for i in range(6)])
+        self.assertEqual(archive.read_tables(None, index), records)
+        self.assertEqual(archive.read_tables(None, index, "t[13]|t4"), [records[1], records[3], records[4]])
+        self.assertEqual(archive.read_tables(None, index, "nope"), [])
+
+    def test_round_trip(self):
+        self.round_trip("gs://b/p.d.json")
+
+    def test_round_trip_gzip(self):
+        self.round_trip("gs://b/p.d.json.gz")
+
+    def test_version_1(self):
+        tables = [record("t", 1)]
+        archive.write_json(None, "gs://b/p.d.json.gz", {"tables": tables})
+        self.assertEqual(archive.read_tables(None, archive.read_json(None, "gs://b/p.d.json.gz")), tables)
+
+    def test_checkpoint(self):
+        checkpoint = archive.Checkpoint(None, "gs://b/p.d.checkpoint.json", interval=0)
+        self.assertEqual(checkpoint.load(), {})
+        checkpoint.add("t1", record("t1", 1))
+
+        resumed = archive.Checkpoint(None, checkpoint.uri, interval=3600)
+        self.assertEqual(list(resumed.load()), ["t1"])
+        resumed.add("t2", record("t2", 2))
+        resumed.flush()
+        self.assertEqual(sorted(archive.read_json(None, checkpoint.uri)["tables"]), ["t1", "t2"])
+
+        resumed.delete()
+        resumed.flush()
+        self.assertNotIn(checkpoint.uri, FakeBlob.objects)
+
+
+if __name__ == "__main__":
+    unittest.main()
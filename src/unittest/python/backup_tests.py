@@ -0,0 +1,554 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import threading
+import unittest
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest import mock
+
+from google.api_core import exceptions
+from google.cloud import bigquery
+
+from gcp.metacache import MetadataCache
+from utils import backup
+from utils.backup import BackupException, Table
+
+
+def table_resource(table_id, num_bytes=0, partitioning=None, table_type="TABLE", schema=True, expiration=None,
+                   dataset_id="d") -> dict:
+    resource = {"tableReference": {"projectId": "p", "datasetId": dataset_id, "tableId": table_id},
+                "id": "p:{}.{}".format(dataset_id, table_id), "type": table_type, "numBytes": str(num_bytes),
+                "location": "US"}
+    if schema:
+        resource["schema"] = {"fields": [{"name": "id", "type": "STRING"}]}
+    if partitioning == "time":
+        resource["timePartitioning"] = {"type": "DAY", "field": "day"}
+    elif partitioning == "range":
+        resource["rangePartitioning"] = {"field": "id", "range": {"start": "0", "end": "100", "interval": "10"}}
+    if expiration is not None:
+        resource["expirationTime"] = str(expiration)
+    return resource
+
+
+class FakeJob():
+    def __init__(self, job_id="job", error=None, resource=None):
+        self.job_id = job_id
+        self.error = error
+        self.resource = resource or {}
+        self.error_result = None
+        self.source = None
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self
+
+    def to_api_repr(self):
+        return json.loads(json.dumps(self.resource))
+
+
+class FakeBigQuery():
+    """Records the BigQuery calls made by backup and restore, failing those on the tables in fail"""
+
+    def __init__(self, tables=(), partitions=None, datasets=("d",), fail=()):
+        self.project = "p"
+        self.tables = {(resource["tableReference"]["datasetId"], resource["tableReference"]["tableId"]): resource
+                       for resource in tables}
+        self.partitions = partitions or {}
+        self.datasets = set(datasets)
+        self.fail = set(fail)
+        self.calls = []
+        # Call name -> names of the threads that made it
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def record(self, *call):
+        with self.lock:
+            self.calls.append(call)
+            self.threads.setdefault(call[0], set()).add(threading.current_thread().name)
+
+    def failure(self, table_id):
+        return exceptions.BadRequest("{} failed".format(table_id)) if table_id in self.fail else None
+
+    def _call_api(self, retry, span_name, span_attributes, method, path, query_params=None, headers=None):
+        parts = path.strip("/").split("/")
+        if "tables" in parts:
+            if (parts[3], parts[5]) not in self.tables:
+                raise exceptions.NotFound(path)
+            return json.loads(json.dumps(self.tables[(parts[3], parts[5])]))
+        if parts[3] not in self.datasets:
+            raise exceptions.NotFound(path)
+        return {"datasetReference": {"projectId": parts[1], "datasetId": parts[3]}, "location": "US"}
+
+    def list_datasets(self, project):
+        return [SimpleNamespace(dataset_id=dataset_id) for dataset_id in sorted(self.datasets)]
+
+    def list_tables(self, dataset, page_size=None):
+        return [SimpleNamespace(reference=bigquery.TableReference(dataset.reference, table_id))
+                for dataset_id, table_id in self.tables if dataset_id == dataset.dataset_id]
+
+    def list_partitions(self, table):
+        self.record("list_partitions", table.table_id)
+        return list(self.partitions[table.table_id])
+
+    def create_dataset(self, dataset, exists_ok=False):
+        self.record("create_dataset", dataset.dataset_id)
+        return dataset
+
+    def update_dataset(self, dataset, fields):
+        self.record("update_dataset", dataset.dataset_id)
+        return dataset
+
+    def create_table(self, table, exists_ok=False):
+        self.record("create", table.table_id)
+        if self.failure(table.table_id):
+            raise self.failure(table.table_id)
+        return table
+
+    def extract_table(self, source, destination_uris, location, job_config):
+        self.record("extract", source.table_id, destination_uris)
+        if self.failure(source.table_id):
+            raise self.failure(source.table_id)
+        job = FakeJob("extract_" + source.table_id, resource={
+            "status": {"state": "DONE"},
+            "configuration": {"extract": {"destinationUri": destination_uris, "destinationUris": [destination_uris],
+                                          "destinationFormat": job_config.destination_format,
+                                          "useAvroLogicalTypes": True}}})
+        job.source = source
+        return job
+
+    def load_table_from_uri(self, source_uris, destination, location, job_config):
+        self.record("load", destination.table_id, list(source_uris), job_config.write_disposition)
+        return FakeJob("load_" + destination.table_id, self.failure(destination.table_id))
+
+    def query(self, query, location=None, job_config=None):
+        self.record("query", query)
+        return FakeJob("query")
+
+    def copy_table(self, source, destination, job_config=None, location=None):
+        self.record("copy", source.table_id, destination.table_id, job_config.operation_type,
+                    job_config.write_disposition)
+        return FakeJob("copy")
+
+    def update_table(self, table, fields):
+        self.record("update", table.table_id, fields, table.expires)
+        return table
+
+    def delete_table(self, table, not_found_ok=False):
+        self.record("delete", table.table_id)
+
+
+class FakeStorage():
+    def list_blobs(self, bucket_or_name, prefix):
+        return [SimpleNamespace(size=10)]
+
+
+class FakeCheckpoint():
+    """Checkpoint kept in memory, by uri"""
+    saved = {}
+
+    def __init__(self, client, uri, interval):
+        self.uri = uri
+        self.tables = self.saved.setdefault(uri, {})
+
+    def load(self):
+        return dict(self.tables)
+
+    def add(self, table_id, record):
+        self.tables[table_id] = record
+
+    def flush(self):
+        pass
+
+    def delete(self):
+        pass
+
+
+class BackupTestCase(unittest.TestCase):
+    """Runs backup and restore against fake clients, with archives kept in memory"""
+
+    def setUp(self):
+        self.archives = {}
+        FakeCheckpoint.saved = {}
+        for patcher in (mock.patch.object(backup, "CACHE", MetadataCache()),
+                        mock.patch.object(backup, "Checkpoint", FakeCheckpoint),
+                        mock.patch.object(backup, "write_json", side_effect=self.write_json),
+                        mock.patch.object(backup, "read_json", side_effect=self.read_json),
+                        mock.patch.object(backup, "read_tables",
+                                          side_effect=lambda client, archive, table_expr, threads: archive["tables"])):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write_json(self, client, uri, value):
+        self.archives[uri] = json.dumps(value)
+
+    def read_json(self, client, uri):
+        if uri not in self.archives:
+            raise exceptions.NotFound(uri)
+        return json.loads(self.archives[uri])
+
+    def backup(self, client, **options):
+        return json.loads(backup.backup(None, "p", "p:d", "gs://b/backups/", threads=4, bulk_metadata=False,
+                                        bq_client=client, gcs_client=FakeStorage(), **options))
+
+    def restore(self, client, **options):
+        return json.loads(backup.restore(None, "p", "p:e", "gs://b/backups/p.d.json", 4, bq_client=client,
+                                         gcs_client=FakeStorage(), **options))
+
+    def calls(self, client, name):
+        return [call[1:] for call in client.calls if call[0] == name]
+
+
+class PartitionsTest(unittest.TestCase):
+
+    def test_partitions(self):
+        ids = ["20220102", "20220101", "__NULL__"]
+        cases = [
+            # table resource, threshold, partitions listed
+            (table_resource("t", 100, "time"), None, False),
+            (table_resource("t", 100, "time"), -1, False),
+            (table_resource("t", 100, "time", table_type="VIEW", schema=False), 0, False),
+            (table_resource("t", 100, "time", schema=False), 0, False),
+            (table_resource("t", 100), 0, False),
+            (table_resource("t", 100, "time"), 100, False),
+            (table_resource("t", 0, "time"), 0, False),
+            (table_resource("t", 101, "time"), 100, True),
+            (table_resource("t", 101, "range"), 100, True),
+            (table_resource("t", 1, "time"), 0, True),
+        ]
+        for resource, threshold, listed in cases:
+            with self.subTest(resource=resource, threshold=threshold):
+                client = FakeBigQuery([resource], partitions={"t": ids})
+                partitions = Table(client, bigquery.Table.from_api_repr(resource)).partitions(threshold)
+                self.assertEqual(partitions, sorted(ids) if listed else [])
+                self.assertEqual(client.calls, [("list_partitions", "t")] if listed else [])
+
+    def test_partitions_reads_table(self):
+        # A table known by reference only is read first
+        client = FakeBigQuery([table_resource("t", 200, "time")], partitions={"t": ["20220101"]})
+        with mock.patch.object(backup, "CACHE", MetadataCache()):
+            partitions = Table(client, bigquery.TableReference.from_string("p.d.t")).partitions(100)
+        self.assertEqual(partitions, ["20220101"])
+
+
+class PartitionBackupTest(BackupTestCase):
+
+    def tables(self):
+        return [table_resource("big", 200, "time"), table_resource("small", 50, "time"), table_resource("w", 500),
+                table_resource("v", table_type="VIEW", schema=False)]
+
+    def test_extract_by_partition(self):
+        client = FakeBigQuery(self.tables(), partitions={"big": ["20220102", "__NULL__", "20220101"]})
+        self.backup(client, partition_threshold=100)
+        self.assertEqual(sorted(call[1] for call in self.calls(client, "extract")), [
+            "gs://b/backups/p.d.big.20220101-*.avro", "gs://b/backups/p.d.big.20220102-*.avro",
+            "gs://b/backups/p.d.big.__NULL__-*.avro", "gs://b/backups/p.d.small.avro", "gs://b/backups/p.d.w.avro"])
+        self.assertEqual([call[0] for call in self.calls(client, "extract")].count("big$20220101"), 1)
+        # Only the big partitioned table is listed
+        self.assertEqual(self.calls(client, "list_partitions"), [("big",)])
+
+        records = {record["table"]["tableReference"]["tableId"]: record
+                   for record in json.loads(self.archives["gs://b/backups/p.d.json"])["tables"]}
+        self.assertNotIn("job", records["big"])
+        self.assertEqual([partition["partition"] for partition in records["big"]["partitions"]],
+                         ["20220101", "20220102", "__NULL__"])
+        self.assertEqual(records["big"]["partitions"][0]["job"]["configuration"]["extract"]["destinationUri"],
+                         "gs://b/backups/p.d.big.20220101-*.avro")
+        self.assertIn("job", records["small"])
+        self.assertNotIn("job", records["v"])
+
+    def test_merged_csv_is_not_split(self):
+        client = FakeBigQuery(self.tables(), partitions={"big": ["20220101"]})
+        self.backup(client, partition_threshold=100, merge_csv=True, destination_format="AVRO")
+        self.assertEqual(self.calls(client, "list_partitions"), [])
+
+    def test_restore_regroups_partitions(self):
+        self.backup(FakeBigQuery(self.tables(), partitions={"big": ["20220102", "__NULL__", "20220101"]}),
+                    partition_threshold=100)
+        client = FakeBigQuery(datasets=())
+        self.restore(client)
+
+        # Each partition is loaded through its decorator once the table exists, __NULL__ rows are appended
+        loads = {call[0]: call[1] for call in self.calls(client, "load")}
+        self.assertEqual(loads, {
+            "big$20220101": ["gs://b/backups/p.d.big.20220101-*.avro"],
+            "big$20220102": ["gs://b/backups/p.d.big.20220102-*.avro"],
+            "big": ["gs://b/backups/p.d.big.__NULL__-*.avro"],
+            "small": ["gs://b/backups/p.d.small.avro"],
+            "w": ["gs://b/backups/p.d.w.avro"],
+        })
+        self.assertEqual({call[2] for call in self.calls(client, "load")}, {"WRITE_APPEND"})
+        create = client.calls.index(("create", "big"))
+        self.assertTrue(all(client.calls.index(call) > create for call in client.calls
+                            if call[0] == "load" and call[1].startswith("big")))
+        self.assertEqual(sorted(call[0] for call in self.calls(client, "create")), ["big", "small", "v", "w"])
+        # The table is checkpointed once, after its last partition
+        checkpoint = FakeCheckpoint.saved["gs://b/backups/p.d.restore.p.e.json"]
+        self.assertEqual(sorted(checkpoint), ["big", "small", "v", "w"])
+
+    def test_failed_partition(self):
+        self.backup(FakeBigQuery(self.tables(), partitions={"big": ["20220101", "20220102"]}),
+                    partition_threshold=100)
+        client = FakeBigQuery(datasets=(), fail={"big$20220102"})
+        with self.assertRaises(BackupException):
+            self.restore(client)
+        self.assertEqual(len([call for call in self.calls(client, "load") if call[0].startswith("big")]), 2)
+        # The other tables are restored, the table with a failed partition is not checkpointed
+        checkpoint = FakeCheckpoint.saved["gs://b/backups/p.d.restore.p.e.json"]
+        self.assertEqual(sorted(checkpoint), ["small", "v", "w"])
+
+    def test_failed_create_loads_no_partitions(self):
+        self.backup(FakeBigQuery(self.tables(), partitions={"big": ["20220101", "20220102"]}),
+                    partition_threshold=100)
+        client = FakeBigQuery(datasets=(), fail={"big"})
+        with self.assertRaises(BackupException):
+            self.restore(client)
+        self.assertEqual([call for call in self.calls(client, "load") if call[0].startswith("big")], [])
+
+
+class FixedDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2022, 3, 4, 5, 6, 7, tzinfo=tz)
+
+
+SNAPSHOT = "d__t__20220304050607"
+# Expiration times (ms since the epoch) of the backed up table and of its snapshot
+TABLE_EXPIRATION = 4102444800000
+SNAPSHOT_EXPIRATION = 1646975167000
+EXPIRED = 1600000000000
+
+
+class SnapshotTest(BackupTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(backup, "datetime", FixedDatetime)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def source(self, expiration=None):
+        return FakeBigQuery([table_resource("t", 100, expiration=expiration),
+                             table_resource("v", table_type="VIEW", schema=False)])
+
+    def archive(self):
+        return json.loads(self.archives["gs://b/backups/p.d.json"])
+
+    def test_snapshot(self):
+        client = self.source()
+        result = self.backup(client, mode="snapshot")
+        self.assertEqual(self.calls(client, "create_dataset"), [("d_snapshots",)])
+        # Snapshots can't be replaced in place, one left by an earlier run is dropped first
+        self.assertEqual(self.calls(client, "delete"), [(SNAPSHOT,)])
+        self.assertEqual(self.calls(client, "query"), [(
+            "CREATE SNAPSHOT TABLE `p.d_snapshots.{}` CLONE `p.d.t` OPTIONS(expiration_timestamp=TIMESTAMP_ADD("
+            "CURRENT_TIMESTAMP(), INTERVAL 168 HOUR))".format(SNAPSHOT),)])
+        self.assertEqual(self.calls(client, "extract"), [])
+
+        archive = self.archive()
+        self.assertEqual(archive["mode"], "SNAPSHOT")
+        records = {record["table"]["tableReference"]["tableId"]: record for record in archive["tables"]}
+        self.assertEqual(records["t"]["snapshot"], {
+            "tableReference": {"projectId": "p", "datasetId": "d_snapshots", "tableId": SNAPSHOT},
+            "jobId": "query", "expirationDays": 7})
+        # Views are recreated from their metadata
+        self.assertNotIn("snapshot", records["v"])
+        self.assertNotIn("gcs_bytes", result)
+
+    def test_snapshot_options(self):
+        cases = [
+            # snapshot dataset, expiration days, snapshot table, OPTIONS
+            ("snaps", 1.5, "p.snaps." + SNAPSHOT, " OPTIONS(expiration_timestamp=TIMESTAMP_ADD("
+                                                  "CURRENT_TIMESTAMP(), INTERVAL 36 HOUR))"),
+            ("q.snaps", None, "q.snaps." + SNAPSHOT, ""),
+        ]
+        for snapshot_dataset, days, table, options in cases:
+            with self.subTest(snapshot_dataset=snapshot_dataset, days=days):
+                client = self.source()
+                self.backup(client, mode="SNAPSHOT", snapshot_dataset=snapshot_dataset,
+                            snapshot_expiration_days=days)
+                self.assertEqual(self.calls(client, "query"),
+                                 [("CREATE SNAPSHOT TABLE `{}` CLONE `p.d.t`{}".format(table, options),)])
+                self.assertEqual(self.archive()["tables"][0]["snapshot"]["expirationDays"], days)
+
+    def test_snapshot_metadata_only(self):
+        client = self.source()
+        self.backup(client, mode="SNAPSHOT", metadata_only=True)
+        self.assertEqual(self.calls(client, "create_dataset"), [])
+        self.assertEqual(self.calls(client, "query"), [])
+        self.assertNotIn("mode", self.archive())
+
+    def test_unknown_mode(self):
+        with self.assertRaisesRegex(ValueError, "Unsupported backup mode COPY"):
+            self.backup(self.source(), mode="copy")
+
+    def test_restore(self):
+        cases = [
+            # method, drop tables, restore statement or copy job
+            ("CLONE", False, ("query", "CREATE TABLE `p.e.t` CLONE `p.d_snapshots.{}`".format(SNAPSHOT))),
+            (None, True, ("query", "CREATE OR REPLACE TABLE `p.e.t` CLONE `p.d_snapshots.{}`".format(SNAPSHOT))),
+            ("copy", False, ("copy", SNAPSHOT, "t", "RESTORE", "WRITE_EMPTY")),
+            ("COPY", True, ("copy", SNAPSHOT, "t", "RESTORE", "WRITE_TRUNCATE")),
+        ]
+        self.backup(self.source(), mode="SNAPSHOT")
+        for method, drop, call in cases:
+            with self.subTest(method=method, drop=drop):
+                FakeCheckpoint.saved = {}
+                client = FakeBigQuery([table_resource("t", 100, dataset_id="e")], datasets=())
+                self.restore(client, snapshot_method=method, drop_tables=drop)
+                self.assertIn(call, client.calls)
+                self.assertEqual([call for call in client.calls if call[0] in ("query", "copy")], [call])
+                # The view is created, the snapshot is not loaded from files
+                self.assertEqual(self.calls(client, "create"), [("v",)])
+                self.assertEqual(self.calls(client, "load"), [])
+                self.assertEqual(sorted(FakeCheckpoint.saved["gs://b/backups/p.d.restore.p.e.json"]), ["t", "v"])
+
+    def test_restore_expiration(self):
+        cases = [
+            # archived table expiration, restore keeps expiration, clone expiration, expiration set
+            (None, False, SNAPSHOT_EXPIRATION, (None,)),
+            (TABLE_EXPIRATION, True, SNAPSHOT_EXPIRATION, (TABLE_EXPIRATION,)),
+            (TABLE_EXPIRATION, False, SNAPSHOT_EXPIRATION, (None,)),
+            (TABLE_EXPIRATION, True, TABLE_EXPIRATION, ()),
+            # An expiration that has passed is not kept
+            (EXPIRED, True, SNAPSHOT_EXPIRATION, (None,)),
+            (None, False, None, ()),
+        ]
+        for archived, keep, cloned, expected in cases:
+            with self.subTest(archived=archived, keep=keep, cloned=cloned):
+                self.archives, FakeCheckpoint.saved = {}, {}
+                backup.CACHE.clear()
+                self.backup(self.source(archived), mode="SNAPSHOT")
+                client = FakeBigQuery([table_resource("t", 100, expiration=cloned, dataset_id="e")], datasets=())
+                self.restore(client, keep_expiration=keep)
+                # The restored table takes the expiration of the archived table, not that of the snapshot
+                self.assertEqual([call[2] for call in self.calls(client, "update")],
+                                 [None if expiration is None else
+                                  datetime.fromtimestamp(expiration / 1000, timezone.utc) for expiration in expected])
+                for call in self.calls(client, "update"):
+                    self.assertEqual(call[:2], ("t", ["expires"]))
+
+
+class DatasetsTest(BackupTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = None
+        patcher = mock.patch.object(backup, "__clients", side_effect=lambda credentials, project: (
+            self.client, FakeStorage()))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def source(self, datasets=("d1", "d2", "d3"), fail=()):
+        return FakeBigQuery([table_resource("{}_{}".format(dataset_id, name), 100, dataset_id=dataset_id)
+                             for dataset_id in datasets for name in "abc"], datasets=datasets + ("x",), fail=fail)
+
+    def backup_datasets(self, client, datasets, **options):
+        self.client = client
+        return json.loads(backup.backup_datasets(None, "p", datasets, "gs://b/backups/", bulk_metadata=False,
+                                                 **options))
+
+    def restore_datasets(self, client, **options):
+        self.client = client
+        return json.loads(backup.restore_datasets(None, "p", "gs://b/backups/p.backup-summary.json", **options))
+
+    def summary(self):
+        return json.loads(self.archives["gs://b/backups/p.backup-summary.json"])
+
+    def test_shared_pool(self):
+        client = self.source()
+        result = self.backup_datasets(client, ["d1", "d2", "d3"], threads=2, dataset_threads=2)
+        # Every dataset extracts its tables in the one worker pool
+        self.assertEqual(len(self.calls(client, "extract")), 9)
+        self.assertTrue(all(name.startswith("Worker_") for name in client.threads["extract"]))
+        self.assertLessEqual(len(client.threads["extract"]), 2)
+
+        self.assertEqual(result["summary_uri"], "gs://b/backups/p.backup-summary.json")
+        summary = self.summary()
+        self.assertEqual([dataset["backup_uri"] for dataset in summary["datasets"]],
+                         ["gs://b/backups/p.d1.json", "gs://b/backups/p.d2.json", "gs://b/backups/p.d3.json"])
+        self.assertEqual((summary["table_bytes"], summary["gcs_bytes"], summary["compression_ratio"]), (900, 90, 10))
+        self.assertEqual(len(json.loads(self.archives["gs://b/backups/p.d2.json"])["tables"]), 3)
+
+    def test_dataset_regex(self):
+        self.backup_datasets(self.source(), "D[12]")
+        self.assertEqual([dataset["dataset"]["datasetId"] for dataset in self.summary()["datasets"]], ["d1", "d2"])
+        with self.assertRaises(BackupException):
+            self.backup_datasets(self.source(), "d[")
+
+    def test_failed_datasets(self):
+        client = self.source(fail={"d2_b"})
+        with self.assertRaises(BackupException):
+            self.backup_datasets(client, ["d1", "d2", "gone", "d3"], threads=3)
+        # The summary is written, with the error of each failed dataset in its place
+        datasets = self.summary()["datasets"]
+        self.assertEqual([dataset["dataset"]["datasetId"] for dataset in datasets], ["d1", "d2", "gone", "d3"])
+        self.assertEqual(datasets[1]["error"], "BackupException")
+        self.assertIn("gone", datasets[2]["error"])
+        self.assertNotIn("error", datasets[0])
+        self.assertNotIn("error", datasets[3])
+        self.assertEqual(self.summary()["table_bytes"], 600)
+        # The other tables of the failed dataset are checkpointed, for a resumed backup
+        self.assertEqual(sorted(FakeCheckpoint.saved["gs://b/backups/p.d2.checkpoint.json"]), ["d2_a", "d2_c"])
+        self.assertNotIn("gs://b/backups/p.d2.json", self.archives)
+        self.assertIn("gs://b/backups/p.d3.json", self.archives)
+
+    def restored(self, client):
+        return sorted(call[0] for call in self.calls(client, "load"))
+
+    def test_restore(self):
+        with self.assertRaises(BackupException):
+            self.backup_datasets(self.source(fail={"d2_b"}), ["d1", "d2", "d3"])
+        client = FakeBigQuery(datasets=("d1", "d3"))
+        result = self.restore_datasets(client, threads=2, dataset_threads=2)
+        # Datasets that failed to back up are skipped, the others share the worker pool
+        self.assertEqual([dataset["dataset"] for dataset in result["datasets"]],
+                         [{"projectId": "p", "datasetId": "d1"}, {"projectId": "p", "datasetId": "d3"}])
+        self.assertEqual(self.restored(client), ["d1_a", "d1_b", "d1_c", "d3_a", "d3_b", "d3_c"])
+        self.assertTrue(all(name.startswith("Worker_") for name in client.threads["load"]))
+        self.assertLessEqual(len(client.threads["load"]), 2)
+
+    def test_restore_some(self):
+        self.backup_datasets(self.source(), ["d1", "d2", "d3"])
+        cases = [
+            (["d2"], ["d2_a", "d2_b", "d2_c"]),
+            ("D[13]", ["d1_a", "d1_b", "d1_c", "d3_a", "d3_b", "d3_c"]),
+            ("none", []),
+        ]
+        for datasets, tables in cases:
+            with self.subTest(datasets=datasets):
+                FakeCheckpoint.saved = {}
+                client = FakeBigQuery(datasets=())
+                self.restore_datasets(client, datasets=datasets)
+                self.assertEqual(self.restored(client), tables)
+
+    def test_failed_restore(self):
+        self.backup_datasets(self.source(), ["d1", "d2", "d3"])
+        client = FakeBigQuery(datasets=(), fail={"d1_b"})
+        with self.assertRaises(BackupException):
+            self.restore_datasets(client)
+        # The other datasets are restored, the failed one can be resumed from its checkpoint
+        self.assertEqual(self.restored(client), ["d1_a", "d1_c", "d2_a", "d2_b", "d2_c", "d3_a", "d3_b", "d3_c"])
+        self.assertEqual(sorted(FakeCheckpoint.saved["gs://b/backups/p.d1.restore.p.d1.json"]), ["d1_a", "d1_c"])
+        self.assertEqual(len(FakeCheckpoint.saved["gs://b/backups/p.d3.restore.p.d3.json"]), 3)
+
+    def test_missing_summary(self):
+        with self.assertRaises(BackupException):
+            self.restore_datasets(FakeBigQuery())
+
+
+if __name__ == "__main__":
+    unittest.main()
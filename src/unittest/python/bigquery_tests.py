@@ -0,0 +1,966 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from google.api_core import exceptions
+from google.cloud import bigquery
+
+from gcp import bigquery as wbq
+from gcp.bigquery import (BulkACLConfig, ExtractTableConfig, LoadTableConfig, QueryConfig, QueryFanoutConfig, WaitConfig, access_key,
+                          bulk_ACL, changed_blobs, dedupe_access, export_destination, export_statement, exported_uris, extract_table,
+                          extract_uri, load_incremental, load_table, load_uris, merge_statement, pending_blobs, query, query_fanout,
+                          query_partitions, rate_limited, wait_jobs, write_export_manifest)
+from gcp.metacache import MetadataCache
+from gcp.template import Template
+
+
+class FakeJob():
+    def __init__(self, error=None):
+        self.error = error
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self
+
+
+class FakeLoadClient():
+    """Records the load, copy and delete calls made by load_uris, failing loads of the URIs in fail"""
+
+    def __init__(self, fail=(), destination=None):
+        self.fail = set(fail)
+        self.destination = destination
+        self.configs = []
+        self.loads = []
+        self.copies = []
+        self.deleted = []
+        self.lock = threading.Lock()
+
+    def load_table_from_uri(self, uris, destination, job_config, location):
+        with self.lock:
+            self.loads.append((list(uris), destination.table_id, job_config.write_disposition))
+            self.configs.append(job_config)
+        return FakeJob(RuntimeError("load failed") if self.fail & set(uris) else None)
+
+    def _call_api(self, retry, span_name, span_attributes, method, path, headers):
+        """The destination table for MetadataCache, NotFound unless one was given"""
+        if self.destination is None or path != self.destination.path:
+            raise exceptions.NotFound(path)
+        return self.destination.to_api_repr()
+
+    def get_table(self, table_ref):
+        return bigquery.Table(table_ref)
+
+    def update_table(self, table, fields):
+        return table
+
+    def copy_table(self, source, destination, job_config, location):
+        self.copies.append((source.table_id, destination.table_id, job_config.write_disposition))
+        return FakeJob()
+
+    def delete_table(self, table_ref, not_found_ok=False):
+        self.deleted.append(table_ref.table_id)
+
+
+class LoadUrisTest(unittest.TestCase):
+
+    table_ref = bigquery.TableReference.from_string("p.d.t")
+
+    def setUp(self):
+        patcher = mock.patch.object(wbq, "CACHE", MetadataCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def job_config(self):
+        job_config = bigquery.LoadJobConfig()
+        job_config.write_disposition = "WRITE_TRUNCATE"
+        job_config.create_disposition = "CREATE_IF_NEEDED"
+        return job_config
+
+    def test_single_batch(self):
+        client = FakeLoadClient()
+        jobs = load_uris(client, ["gs://b/1", "gs://b/2"], self.table_ref, self.job_config(), "US", 10, 4)
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(client.loads, [(["gs://b/1", "gs://b/2"], "t", "WRITE_TRUNCATE")])
+        self.assertEqual(client.copies, [])
+
+    def test_batches_are_staged(self):
+        client = FakeLoadClient()
+        uris = ["gs://b/{}".format(i) for i in range(5)]
+        jobs = load_uris(client, uris, self.table_ref, self.job_config(), "US", 2, 4)
+        self.assertEqual(len(jobs), 3)
+        staging = {table_id for _, table_id, _ in client.loads}
+        self.assertEqual(len(staging), 1)
+        staging = staging.pop()
+        self.assertTrue(staging.startswith("_load_t_"))
+        self.assertEqual(sorted(uri for batch, _, _ in client.loads for uri in batch), uris)
+        self.assertEqual(client.copies, [(staging, "t", "WRITE_TRUNCATE")])
+        self.assertEqual(client.deleted, [staging])
+
+    def test_staging_matches_destination(self):
+        destination = bigquery.Table(self.table_ref)
+        destination.time_partitioning = bigquery.TimePartitioning(type_="DAY", field="day")
+        destination.clustering_fields = ["id"]
+        client = FakeLoadClient(destination=destination)
+        load_uris(client, ["gs://b/{}".format(i) for i in range(3)], self.table_ref, self.job_config(), "US", 2, 4)
+        # The first batch creates the staging table with the destination's partitioning and clustering
+        first = client.configs[0]
+        self.assertEqual(first.create_disposition, "CREATE_IF_NEEDED")
+        self.assertEqual((first.time_partitioning.type_, first.time_partitioning.field), ("DAY", "day"))
+        self.assertEqual(first.clustering_fields, ["id"])
+        self.assertEqual(len(client.copies), 1)
+
+    def test_new_destination_keeps_config(self):
+        client = FakeLoadClient()
+        job_config = self.job_config()
+        job_config.range_partitioning = bigquery.RangePartitioning(bigquery.PartitionRange(0, 100, 10), field="n")
+        load_uris(client, ["gs://b/{}".format(i) for i in range(3)], self.table_ref, job_config, "US", 2, 4)
+        self.assertEqual(client.configs[0].range_partitioning.field, "n")
+        self.assertIsNone(client.configs[0].time_partitioning)
+
+    def test_failed_batch_leaves_destination(self):
+        client = FakeLoadClient(fail=["gs://b/3"])
+        with self.assertRaises(RuntimeError):
+            load_uris(client, ["gs://b/{}".format(i) for i in range(5)], self.table_ref, self.job_config(), "US", 2, 4)
+        self.assertNotIn("t", [table_id for _, table_id, _ in client.loads])
+        self.assertEqual(client.copies, [])
+        self.assertEqual(len(client.deleted), 1)
+
+    def test_submit_only(self):
+        with self.assertRaises(ValueError):
+            load_uris(FakeLoadClient(), ["gs://b/1", "gs://b/2"], self.table_ref, self.job_config(), "US", 1, 4,
+                      submit_only=True)
+
+
+class ParquetLoadTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cwd = os.getcwd()
+        os.chdir(directory.name)
+        self.addCleanup(os.chdir, cwd)
+        with open("source.csv", "w") as source_file:
+            source_file.write("1,a\n2,b\n")
+
+    def load(self, client):
+        config = LoadTableConfig(destination={"projectId": "p", "datasetId": "d", "tableId": "t"},
+                                 sourceFile="source.csv", convertToParquet=True,
+                                 schemaFields=[{"name": "id", "type": "INTEGER"}, {"name": "name", "type": "STRING"}])
+        with mock.patch.object(wbq.bigquery, "Client", return_value=client):
+            load_table(config)
+
+    def test_failed_upload_removes_parquet(self):
+        client = mock.Mock()
+        client.load_table_from_file.side_effect = RuntimeError("upload failed")
+        with self.assertRaisesRegex(RuntimeError, "upload failed"):
+            self.load(client)
+        self.assertEqual(client.load_table_from_file.call_args[1]["job_config"].source_format, "PARQUET")
+        self.assertEqual(os.listdir("."), ["source.csv"])
+
+    def test_failed_load_removes_parquet(self):
+        client = mock.Mock()
+        client.load_table_from_file.return_value.result.side_effect = RuntimeError("load failed")
+        with self.assertRaisesRegex(RuntimeError, "load failed"):
+            self.load(client)
+        self.assertEqual(os.listdir("."), ["source.csv"])
+
+
+def blob(name, generation=1, crc32c="c"):
+    return SimpleNamespace(name=name, generation=generation, crc32c=crc32c, size=10,
+                           bucket=SimpleNamespace(name="b"))
+
+
+def loaded(*blobs):
+    return {"objects": {b.name: {"generation": str(b.generation), "crc32c": b.crc32c} for b in blobs}}
+
+
+class ManifestTest(unittest.TestCase):
+
+    def test_pending_blobs(self):
+        manifest = loaded(blob("a"), blob("b"), blob("c"))
+        listing = [blob("a"), blob("b", generation=2), blob("c", crc32c="x"), blob("d")]
+        self.assertEqual([b.name for b in pending_blobs(manifest, listing)], ["b", "c", "d"])
+        self.assertEqual([b.name for b in changed_blobs(manifest, listing)], ["b", "c"])
+        self.assertEqual([b.name for b in pending_blobs({"objects": {}}, listing)], ["a", "b", "c", "d"])
+
+    def run_load(self, manifest, listing, fail=False):
+        """Runs load_incremental, returning the manifests written and the URIs/disposition of the load"""
+        written = self.written = []
+        loads = []
+
+        def write_manifest(client, uri, value, generation):
+            written.append((json_copy(value), generation))
+            return generation + 1
+
+        def load(client, uris, table_ref, job_config, location, batch_size, threads):
+            loads.append((uris, job_config.write_disposition))
+            if fail:
+                raise RuntimeError("load failed")
+            return ["job"]
+
+        config = LoadTableConfig(destination={"projectId": "p", "datasetId": "d", "tableId": "t"},
+                                 sourceBucket="b", sourcePrefix="x/", manifestUri="gs://b/manifest.json")
+        job_config = bigquery.LoadJobConfig(write_disposition="WRITE_EMPTY")
+        with mock.patch.object(wbq.storage, "Client"), \
+                mock.patch.object(wbq, "read_manifest", return_value=(manifest, 7)), \
+                mock.patch.object(wbq, "write_manifest", side_effect=write_manifest), \
+                mock.patch.object(wbq, "get_bucketblobs", return_value=listing), \
+                mock.patch.object(wbq, "load_uris", side_effect=load):
+            self.result = load_incremental(None, config, bigquery.TableReference.from_string("p.d.t"), job_config)
+        return written, loads
+
+    def test_first_load(self):
+        written, loads = self.run_load({"objects": {}}, [blob("a"), blob("b")])
+        self.assertEqual(loads, [(["gs://b/a", "gs://b/b"], "WRITE_EMPTY")])
+        # Claimed before the load, then replaced with the claim's generation as precondition
+        self.assertEqual(written[0][0]["loading"]["objects"], ["a", "b"])
+        self.assertEqual(written[0][1], 7)
+        self.assertNotIn("loading", written[1][0])
+        self.assertEqual(sorted(written[1][0]["objects"]), ["a", "b"])
+        self.assertEqual(written[1][1], 8)
+
+    def test_new_objects_are_appended(self):
+        written, loads = self.run_load(loaded(blob("a")), [blob("a"), blob("b")])
+        self.assertEqual(loads, [(["gs://b/b"], "WRITE_APPEND")])
+        self.assertEqual(sorted(written[-1][0]["objects"]), ["a", "b"])
+
+    def test_changed_object_reloads_everything(self):
+        written, loads = self.run_load(loaded(blob("a"), blob("b"), blob("gone")),
+                                       [blob("a", generation=2), blob("b"), blob("c")])
+        self.assertEqual(loads, [(["gs://b/a", "gs://b/b", "gs://b/c"], "WRITE_TRUNCATE")])
+        self.assertEqual(written[-1][0]["objects"]["a"]["generation"], "2")
+        self.assertEqual(sorted(written[-1][0]["objects"]), ["a", "b", "c"])
+
+    def test_nothing_to_load(self):
+        written, loads = self.run_load(loaded(blob("a")), [blob("a")])
+        self.assertEqual((written, loads), ([], []))
+        self.assertIsNone(self.result)
+        self.run_load(loaded(blob("a")), [blob("a"), blob("b")])
+        self.assertEqual(self.result, ["job"])
+
+    def test_failed_load_releases_claim(self):
+        with self.assertRaises(RuntimeError):
+            self.run_load(loaded(blob("a")), [blob("a"), blob("b")], fail=True)
+        self.assertEqual(self.written[-1], (loaded(blob("a")), 8))
+
+    def test_unfinished_load_stops(self):
+        manifest = loaded(blob("a"))
+        manifest["loading"] = {"objects": ["b"], "started": "2022-01-01T00:00:00+00:00"}
+        with self.assertRaisesRegex(Exception, "did not complete"):
+            self.run_load(manifest, [blob("a"), blob("b")])
+
+
+class NothingToLoadTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cwd = os.getcwd()
+        os.chdir(directory.name)
+        self.addCleanup(os.chdir, cwd)
+
+    def load(self, **options):
+        config = LoadTableConfig(destination={"projectId": "p", "datasetId": "d", "tableId": "t"},
+                                 sourceBucket="b", sourcePrefix="x/", sourceDelimiter="/", **options)
+        client = mock.Mock()
+        with mock.patch.object(wbq.bigquery, "Client", return_value=client), \
+                mock.patch.object(wbq.storage, "Client"), \
+                mock.patch.object(wbq, "CACHE") as cache, \
+                mock.patch.object(wbq, "read_manifest", return_value=(loaded(blob("a")), 7)), \
+                mock.patch.object(wbq, "get_bucketblobs", return_value=[blob("a")]), \
+                mock.patch.object(wbq, "get_bucketfiles", return_value=[]):
+            load_table(LoadTableConfig.from_dict(config.to_dict()))
+        # The destination may never have been created, so it is not looked up
+        cache.get_table.assert_not_called()
+        client.load_table_from_uri.assert_not_called()
+
+    def read(self, name):
+        with open(name) as result_file:
+            return json.load(result_file)
+
+    def test_manifest(self):
+        self.load(manifestUri="gs://b/manifest.json")
+        self.assertEqual(self.read("job.json"), {})
+        self.assertEqual(self.read("table.json"), {"tableReference": {"projectId": "p", "datasetId": "d",
+                                                                      "tableId": "t"}})
+
+    def test_empty_listing(self):
+        self.load()
+        self.assertEqual(self.read("job.json"), {})
+        self.assertEqual(self.read("table.json")["tableReference"]["tableId"], "t")
+
+    def test_submit_only(self):
+        self.load(submitOnly=True)
+        self.assertEqual(self.read("handle.json"), {"jobs": []})
+        self.assertFalse(os.path.exists("job.json"))
+
+
+class QueryPartitionsTest(unittest.TestCase):
+
+    destination = {"tableReference": {"projectId": "p", "datasetId": "d", "tableId": "t"}}
+
+    def run_partitions(self, destination, existing=None):
+        """Runs query_partitions until its first query, returning the client"""
+        client = mock.Mock()
+        client.create_table.side_effect = lambda table, exists_ok: table
+        client.query.side_effect = RuntimeError("query")
+        cache = mock.Mock()
+        cache.get_table.side_effect = exceptions.NotFound("t") if existing is None else None
+        cache.get_table.return_value = existing
+        config = QueryConfig(query="SELECT 1", replacements=None, dependencies=None, destination=destination)
+        with mock.patch.object(wbq, "CACHE", cache), self.assertRaisesRegex(RuntimeError, "query"):
+            query_partitions(client, config, bigquery.QueryJobConfig(), Template(config.query), {}, ["20240131"])
+        return client
+
+    def test_created_partitioned(self):
+        client = self.run_partitions({**self.destination, "timePartitioning": {"type": "DAY"}})
+        self.assertEqual(client.create_table.call_args[0][0].time_partitioning.type_, "DAY")
+        self.assertEqual(client.query.call_args[0][1].destination.table_id, "t$20240131")
+
+    def test_existing_partitioned(self):
+        existing = bigquery.Table("p.d.t")
+        existing.range_partitioning = bigquery.RangePartitioning(
+            bigquery.PartitionRange(0, 100, 10), field="n")
+        client = self.run_partitions(self.destination, existing)
+        client.create_table.assert_not_called()
+
+    def test_needs_partitioning(self):
+        client = mock.Mock()
+        config = QueryConfig(query="SELECT 1", replacements=None, dependencies=None, destination=self.destination)
+        for existing in (exceptions.NotFound("t"), bigquery.Table("p.d.t")):
+            cache = mock.Mock()
+            cache.get_table.side_effect = existing if isinstance(existing, Exception) else None
+            cache.get_table.return_value = existing
+            with mock.patch.object(wbq, "CACHE", cache), self.assertRaisesRegex(ValueError, "not partitioned"):
+                query_partitions(client, config, bigquery.QueryJobConfig(), Template(config.query), {}, ["20240131"])
+        client.create_table.assert_not_called()
+        client.query.assert_not_called()
+
+
+class QueryMergeTest(unittest.TestCase):
+
+    def test_merge_statement(self):
+        statement = merge_statement(bigquery.TableReference.from_string("p.d.t"),
+                                    bigquery.TableReference.from_string("p.d._merge_t"),
+                                    ["id", "Day", "value"], ["ID", "day"])
+        self.assertEqual(statement, "MERGE `p.d.t` T\nUSING `p.d._merge_t` S\n"
+                                    "ON T.`ID` IS NOT DISTINCT FROM S.`ID` AND T.`day` IS NOT DISTINCT FROM S.`day`\n"
+                                    "WHEN MATCHED THEN\n  UPDATE SET `value` = S.`value`\n"
+                                    "WHEN NOT MATCHED THEN\n  INSERT (`id`, `Day`, `value`) VALUES (S.`id`, S.`Day`, S.`value`)")
+
+    def test_invalid_options(self):
+        destination = {"tableReference": {"projectId": "p", "datasetId": "d", "tableId": "t"}}
+        for options in ({"drop": True}, {"partitions": ["20240131"]}, {"exportUri": "gs://b/x"},
+                        {"mergeKeys": None}, {"destination": None}):
+            config = QueryConfig(query="SELECT 1", replacements=None, dependencies=None, destination=destination,
+                                 writeMode="MERGE", mergeKeys=["id"])
+            for name, value in options.items():
+                setattr(config, name, value)
+            with mock.patch.object(wbq.bigquery, "Client") as client, self.assertRaises(ValueError):
+                query(config)
+            client.assert_not_called()
+
+
+def table_resource(table_id, num_bytes=None) -> dict:
+    resource = {"tableReference": {"projectId": "p", "datasetId": "d", "tableId": table_id}}
+    if num_bytes is not None:
+        resource["numBytes"] = str(num_bytes)
+    return resource
+
+
+class FakeExtractClient():
+    """Records extract jobs, serving table sizes (by table id) and job resources"""
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.extracts = []
+        self.table_requests = []
+        self.lock = threading.Lock()
+
+    def extract_table(self, table, destination_uri, job_config, location):
+        with self.lock:
+            self.extracts.append((table.table_id, destination_uri))
+        job = SimpleNamespace(project="p", job_id="extract_" + table.table_id, location=location, job_type="extract")
+        job.result = lambda: job
+        return job
+
+    def _call_api(self, retry, span_name, span_attributes, method, path, query_params=None, headers=None):
+        if "/jobs/" in path:
+            return {"jobReference": {"projectId": "p", "jobId": path.rsplit("/", 1)[1]},
+                    "statistics": {"extract": {"destinationUriFileCounts": ["1"]}}}
+        table_id = path.rsplit("/", 1)[1]
+        with self.lock:
+            self.table_requests.append(table_id)
+        return table_resource(table_id, self.sizes[table_id])
+
+
+class ExtractTest(unittest.TestCase):
+
+    def config(self, **options):
+        return ExtractTableConfig(**{"destinationUri": "gs://b/out", "fileFormat": "CSV", "location": "US", **options})
+
+    def test_extract_uri(self):
+        small = bigquery.Table.from_api_repr(table_resource("t", 10))
+        large = bigquery.Table.from_api_repr(table_resource("t", 2000000000))
+        self.assertEqual(extract_uri(self.config(), small), "gs://b/out/p.d.t.csv")
+        self.assertEqual(extract_uri(self.config(), large), "gs://b/out/p.d.t-*.csv")
+        self.assertEqual(extract_uri(self.config(autoShard=False), large), "gs://b/out/p.d.t.csv")
+        self.assertEqual(extract_uri(self.config(fileFormat="parquet"), large), "gs://b/out/p.d.t-*.parquet")
+        # An explicit file name is used as given
+        self.assertEqual(extract_uri(self.config(), large, "export.csv"), "gs://b/out/export.csv")
+        self.assertEqual(extract_uri(self.config(), large, "export-*.csv"), "gs://b/out/export-*.csv")
+
+    def run_extract(self, client, config):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cwd = os.getcwd()
+        os.chdir(directory.name)
+        self.addCleanup(os.chdir, cwd)
+        with mock.patch.object(wbq.bigquery, "Client", return_value=client), \
+                mock.patch.object(wbq, "CACHE", MetadataCache()):
+            extract_table(config)
+        with open("manifest.json") as manifest_file:
+            return json.load(manifest_file)
+
+    def test_several_tables(self):
+        client = FakeExtractClient({"a": 10, "b": 2000000000, "c": None})
+        manifest = self.run_extract(client, self.config(
+            sourceTables=[table_resource("a"), table_resource("b"), table_resource("c")], threads=2))
+        self.assertEqual(sorted(client.extracts), [("a", "gs://b/out/p.d.a.csv"), ("b", "gs://b/out/p.d.b-*.csv"),
+                                                   ("c", "gs://b/out/p.d.c.csv")])
+        # In the order of sourceTables
+        self.assertEqual([(entry["table"]["tableId"], entry["jobId"]) for entry in manifest],
+                         [("a", "extract_a"), ("b", "extract_b"), ("c", "extract_c")])
+        self.assertEqual(manifest[1]["destinationUriFileCounts"], ["1"])
+
+    def test_file_name_is_not_looked_up(self):
+        client = FakeExtractClient({"a": 2000000000})
+        manifest = self.run_extract(client, self.config(sourceTable=table_resource("a"), fileName="a.csv"))
+        self.assertEqual(client.extracts, [("a", "gs://b/out/a.csv")])
+        self.assertEqual(client.table_requests, [])
+        self.assertEqual(manifest[0]["destinationUri"], "gs://b/out/a.csv")
+
+    def test_no_shard_is_not_looked_up(self):
+        client = FakeExtractClient({"a": 2000000000})
+        self.run_extract(client, self.config(sourceTables=[table_resource("a")], autoShard=False))
+        self.assertEqual((client.extracts, client.table_requests), ([("a", "gs://b/out/p.d.a.csv")], []))
+
+
+def export_config(**options) -> QueryConfig:
+    return QueryConfig(query="SELECT 1;\n", replacements=None, dependencies=None, exportUri="gs://b/out/", **options)
+
+
+class ExportTest(unittest.TestCase):
+
+    def test_export_destination(self):
+        self.assertEqual(export_destination(export_config()), "gs://b/out/*.csv")
+        self.assertEqual(export_destination(export_config(exportFormat="json", exportCompression="gzip")),
+                         "gs://b/out/*.json.gz")
+        self.assertEqual(export_destination(export_config(exportFormat="PARQUET", exportCompression="GZIP")),
+                         "gs://b/out/*.parquet")
+        config = export_config()
+        config.exportUri = "gs://b/out/part-*.csv"
+        self.assertEqual(export_destination(config), "gs://b/out/part-*.csv")
+
+    def test_export_statement(self):
+        self.assertEqual(export_statement(export_config(delimiter="'", header=False), "gs://b/out/*.csv", "SELECT 1;\n"),
+                         "EXPORT DATA OPTIONS(uri='gs://b/out/*.csv', format='CSV', overwrite=true, header=false, "
+                         "field_delimiter='\\'') AS\nSELECT 1")
+        self.assertEqual(export_statement(export_config(exportFormat="avro", exportCompression="snappy"),
+                                          "gs://b/out/*.avro", "SELECT 1"),
+                         "EXPORT DATA OPTIONS(uri='gs://b/out/*.avro', format='AVRO', overwrite=true, "
+                         "compression='SNAPPY') AS\nSELECT 1")
+
+    def test_unknown_export_method(self):
+        for method in ("EXTRACT_DATA", "export"):
+            client = mock.Mock()
+            with mock.patch.object(wbq.bigquery, "Client", return_value=client), \
+                    self.assertRaisesRegex(ValueError, "Unsupported exportMethod"):
+                query(export_config(exportMethod=method))
+            client.query.assert_not_called()
+
+    def test_export_method_case(self):
+        client = mock.Mock()
+        client.query.return_value.result.side_effect = RuntimeError("stop")
+        with mock.patch.object(wbq.bigquery, "Client", return_value=client), self.assertRaisesRegex(RuntimeError, "stop"):
+            query(export_config(exportMethod="export_data"))
+        self.assertTrue(client.query.call_args[0][0].startswith("EXPORT DATA OPTIONS(uri='gs://b/out/*.csv'"))
+
+    def test_exported_uris(self):
+        query_job = {"statistics": {"query": {"exportDataStatistics": {"fileCount": "2", "rowCount": "9"}}}}
+        self.assertEqual(exported_uris("gs://b/out/*.csv", query_job, []),
+                         ["gs://b/out/000000000000.csv", "gs://b/out/000000000001.csv"])
+        extract_job = {"statistics": {"extract": {"destinationUriFileCounts": ["1"]}}}
+        self.assertEqual(exported_uris("gs://b/out/*.csv", {}, [extract_job]), ["gs://b/out/000000000000.csv"])
+        self.assertEqual(exported_uris("gs://b/out/file.csv", {}, [extract_job]), ["gs://b/out/file.csv"])
+        self.assertEqual(exported_uris("gs://b/out/*.csv", {}, []), [])
+
+    def test_manifest_lists_written_files(self):
+        listing = [SimpleNamespace(bucket=SimpleNamespace(name="b"), name="out/{}.csv".format(name), size=size)
+                   for name, size in (("000000000000", 10), ("000000000001", 20), ("000000000002", 30),
+                                      ("old", 40))]
+        job_result = {"jobReference": {"jobId": "j"},
+                      "statistics": {"query": {"exportDataStatistics": {"fileCount": "2"}}}}
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cwd = os.getcwd()
+        os.chdir(directory.name)
+        self.addCleanup(os.chdir, cwd)
+        with mock.patch.object(wbq.storage, "Client") as client:
+            client.return_value.list_blobs.return_value = listing
+            write_export_manifest("gs://b/out/*.csv", job_result, [])
+        client.return_value.list_blobs.assert_called_with("b", prefix="out/")
+        with open("export.json") as export_file:
+            manifest = json.load(export_file)
+        # Files left under the prefix by earlier exports are not part of this one
+        self.assertEqual(manifest["files"], [{"uri": "gs://b/out/000000000000.csv", "size": 10},
+                                             {"uri": "gs://b/out/000000000001.csv", "size": 20}])
+        self.assertEqual((manifest["fileCount"], manifest["bytes"], manifest["jobId"]), (2, 30, "j"))
+
+
+class FakeClock():
+    """Stands in for the time module, sleeping by moving the clock forward"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeJobClient():
+    """Serves jobs that are DONE after a number of polls, and their destination table"""
+
+    def __init__(self, polls, errors=None, destination="t"):
+        self.polls = dict(polls)
+        self.errors = errors or {}
+        self.destination = destination
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def get_job(self, job_id, project, location):
+        with self.lock:
+            self.requests.append((job_id, project, location))
+            self.polls[job_id] -= 1
+            state = "DONE" if self.polls[job_id] <= 0 else "RUNNING"
+        return SimpleNamespace(job_id=job_id, project=project, location=location, state=state)
+
+    def _call_api(self, retry, span_name, span_attributes, method, path, query_params=None, headers=None):
+        if "/jobs/" in path:
+            job_id = path.rsplit("/", 1)[1]
+            resource = {"jobReference": {"projectId": "p", "jobId": job_id}, "status": {"state": "DONE"},
+                        "statistics": {"totalSlotMs": "10"},
+                        "configuration": {"load": {"destinationTable": {
+                            "projectId": "p", "datasetId": "d", "tableId": self.destination or job_id}}}}
+            if job_id in self.errors:
+                resource["status"]["errorResult"] = {"message": self.errors[job_id]}
+            return resource
+        return {"tableReference": {"projectId": "p", "datasetId": "d", "tableId": path.rsplit("/", 1)[1]},
+                "numRows": "5"}
+
+
+class WaitJobsTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cwd = os.getcwd()
+        os.chdir(directory.name)
+        self.addCleanup(os.chdir, cwd)
+        self.clock = FakeClock()
+        for patcher in (mock.patch.object(wbq, "time", self.clock), mock.patch.object(wbq, "CACHE", MetadataCache())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def wait(self, client, **options):
+        # One handle.json with two jobs (as written by load_table), one with a single job
+        with open("load.json", "w") as handle_file:
+            json.dump({"jobs": [{"projectId": "p", "jobId": "a", "location": "US", "jobType": "load"},
+                                {"projectId": "p", "jobId": "b", "location": "US", "jobType": "load"}]}, handle_file)
+        with open("query.json", "w") as handle_file:
+            json.dump({"projectId": "p", "jobId": "c", "location": "EU", "jobType": "query"}, handle_file)
+        with mock.patch.object(wbq.bigquery, "Client", return_value=client):
+            wait_jobs(WaitConfig(handleFiles=["load.json", "query.json"], **options))
+
+    def read(self, name):
+        with open(name) as result_file:
+            return json.load(result_file)
+
+    def test_backoff(self):
+        client = FakeJobClient({"a": 1, "b": 3, "c": 5})
+        self.wait(client, initialDelay=1, maxDelay=3)
+        self.assertEqual(self.clock.sleeps, [1, 2, 3, 3])
+        # Jobs that are done are not polled again
+        self.assertEqual([request[0] for request in client.requests].count("a"), 1)
+        self.assertIn(("c", "p", "EU"), client.requests)
+        self.assertEqual([job["jobReference"]["jobId"] for job in self.read("jobs.json")], ["a", "b", "c"])
+        self.assertEqual(self.read("job.json")["statistics"]["totalSlotMs"], "30")
+        self.assertEqual(self.read("table.json")["tableReference"]["tableId"], "t")
+
+    def test_several_destinations(self):
+        self.wait(FakeJobClient({"a": 1, "b": 1, "c": 1}, destination=None))
+        self.assertEqual(self.read("table.json"), {})
+
+    def test_timeout(self):
+        client = FakeJobClient({"a": 1, "b": 1, "c": 100})
+        with self.assertRaisesRegex(TimeoutError, "1 job\\(s\\) still running after 10s: c"):
+            self.wait(client, timeout=10, initialDelay=2, maxDelay=4)
+        self.assertLessEqual(self.clock.now, 10)
+
+    def test_failed_job(self):
+        with self.assertRaisesRegex(Exception, "1 job\\(s\\) failed: b: bad row"):
+            self.wait(FakeJobClient({"a": 1, "b": 2, "c": 1}, errors={"b": "bad row"}))
+        # The results are written before failing
+        self.assertEqual(len(self.read("jobs.json")), 3)
+
+
+class SubmitOnlyTest(unittest.TestCase):
+
+    def run_main(self, *args):
+        calls = []
+        with mock.patch.object(wbq, "basicConfig"), \
+                mock.patch.object(wbq, "query", side_effect=lambda config: calls.append(config)), \
+                mock.patch.object(wbq, "create_table", side_effect=lambda config: calls.append(config)), \
+                mock.patch.object(wbq.Path, "read_text", return_value=json.dumps(
+                    {"query": "SELECT 1", "replacements": None, "dependencies": None,
+                     "table": {"tableReference": {"projectId": "p", "datasetId": "d", "tableId": "t"}}})):
+            wbq.main(list(args) + ["config.json"])
+        return calls
+
+    def test_flag(self):
+        self.assertTrue(self.run_main("--submit_only", "query")[0].submitOnly)
+        self.assertFalse(self.run_main("query")[0].submitOnly)
+
+    def test_other_commands(self):
+        with mock.patch("sys.stderr"), self.assertRaises(SystemExit):
+            self.run_main("--submit_only", "create_table")
+
+
+class FakeQueryClient():
+    """Runs fan-out queries ("SELECT '<variant>'"), failing each variant with the errors queued for it"""
+
+    def __init__(self, errors=None):
+        self.errors = {name: list(queued) for name, queued in (errors or {}).items()}
+        self.queries = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def query(self, query, job_config):
+        name = query.split("'")[1]
+        with self.lock:
+            self.queries.append(name)
+            error = self.errors[name].pop(0) if self.errors.get(name) else None
+        client = self
+
+        class Job():
+            job_id = "job_" + name
+            project = "p"
+            location = "US"
+
+            def result(self):
+                with client.lock:
+                    client.active += 1
+                    client.max_active = max(client.max_active, client.active)
+                # Real time, wbq.time is a fake clock
+                threading.Event().wait(0.01)
+                with client.lock:
+                    client.active -= 1
+                if error is not None:
+                    raise error
+                return self
+
+        return Job()
+
+    def _call_api(self, retry, span_name, span_attributes, method, path, query_params=None, headers=None):
+        return {"jobReference": {"projectId": "p", "jobId": path.rsplit("/", 1)[1]},
+                "status": {"state": "DONE"},
+                "statistics": {"startTime": "1000", "endTime": "1500", "totalSlotMs": "20",
+                               "query": {"totalBytesProcessed": "100", "totalBytesBilled": "200"}}}
+
+
+def rate_limit_error():
+    return exceptions.Forbidden("quota", errors=[{"reason": "rateLimitExceeded"}])
+
+
+class QueryFanoutTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cwd = os.getcwd()
+        os.chdir(directory.name)
+        self.addCleanup(os.chdir, cwd)
+        self.clock = FakeClock()
+        for patcher in (mock.patch.object(wbq, "time", self.clock),
+                        mock.patch.object(wbq.random, "random", return_value=0.5)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fanout(self, client, names, **options):
+        options = {"query": {"query": "SELECT '{name}'", "replacements": None, "dependencies": None}, **options}
+        config = QueryFanoutConfig(replacementSets=[{"name": name} for name in names], **options)
+        with mock.patch.object(wbq.bigquery, "Client", return_value=client):
+            query_fanout(config)
+
+    def read(self, name):
+        with open(name) as result_file:
+            return json.load(result_file)
+
+    def test_rate_limited(self):
+        cases = [
+            (exceptions.TooManyRequests("slow down"), True),
+            (exceptions.ServiceUnavailable("unavailable"), True),
+            (rate_limit_error(), True),
+            (exceptions.InternalServerError("backend", errors=[{"reason": "backendError"}]), True),
+            (exceptions.BadRequest("syntax", errors=[{"reason": "invalidQuery"}]), False),
+            (exceptions.BadRequest("syntax"), False),
+            (RuntimeError("boom"), False),
+        ]
+        for error, expected in cases:
+            with self.subTest(error=error):
+                self.assertEqual(rate_limited(error), expected)
+
+    def test_concurrency_cap(self):
+        client = FakeQueryClient()
+        names = ["v{}".format(index) for index in range(8)]
+        self.fanout(client, names, threads=3)
+        self.assertLessEqual(client.max_active, 3)
+        self.assertGreater(client.max_active, 1)
+        self.assertEqual(sorted(client.queries), names)
+        manifest = self.read("fanout.json")
+        self.assertEqual([variant["name"] for variant in manifest["variants"]], names)
+        self.assertEqual((manifest["totalBytesProcessed"], manifest["totalBytesBilled"], manifest["totalSlotMs"]),
+                         (800, 1600, 160))
+        self.assertEqual(manifest["failures"], [])
+        self.assertEqual(self.read("job.json")["statistics"]["totalSlotMs"], "160")
+
+    def test_single_thread(self):
+        client = FakeQueryClient()
+        self.fanout(client, ["a", "b", "c"], threads=0)
+        self.assertEqual(client.max_active, 1)
+
+    def test_rate_limit_retries(self):
+        client = FakeQueryClient({"b": [rate_limit_error(), exceptions.TooManyRequests("slow down")]})
+        self.fanout(client, ["a", "b"], threads=1)
+        # Exponential backoff (jitter fixed at 1x)
+        self.assertEqual(self.clock.sleeps, [2, 4])
+        self.assertEqual(client.queries.count("b"), 3)
+        attempts = {variant["name"]: variant["attempts"] for variant in self.read("fanout.json")["variants"]}
+        self.assertEqual(attempts, {"a": 1, "b": 3})
+
+    def test_retries_exhausted(self):
+        client = FakeQueryClient({"b": [rate_limit_error() for _ in range(3)]})
+        with self.assertRaisesRegex(Exception, "1 of 2 queries failed: b"):
+            self.fanout(client, ["a", "b"], maxRetries=2)
+        self.assertEqual(client.queries.count("b"), 3)
+        self.assertEqual(self.read("fanout.json")["failures"][0]["name"], "b")
+
+    def test_failure_propagates(self):
+        client = FakeQueryClient({"b": [exceptions.BadRequest("syntax error")], "d": [RuntimeError("boom")]})
+        with self.assertRaisesRegex(Exception, "2 of 4 queries failed: b, d"):
+            self.fanout(client, ["a", "b", "c", "d"])
+        # Other queries are not retried, the rest still run and are reported
+        self.assertEqual(self.clock.sleeps, [])
+        manifest = self.read("fanout.json")
+        self.assertEqual([variant["name"] for variant in manifest["variants"]], ["a", "c"])
+        self.assertEqual([failure["name"] for failure in manifest["failures"]], ["b", "d"])
+        self.assertIn("syntax error", manifest["failures"][0]["error"])
+        self.assertEqual(self.read("job.json")["statistics"]["totalSlotMs"], "40")
+
+    def test_unsupported_options(self):
+        with self.assertRaisesRegex(ValueError, "plain queries"):
+            self.fanout(FakeQueryClient(), ["a"], query={"query": "SELECT 1", "replacements": None,
+                                                          "dependencies": None, "writeMode": "MERGE"})
+
+
+READER = {"role": "READER", "userByEmail": "reader@example.com"}
+WRITER = {"role": "WRITER", "groupByEmail": "writers@example.com"}
+OWNER = {"role": "OWNER", "specialGroup": "projectOwners"}
+
+
+class FakeACLClient():
+    """Serves datasets with an etag, rejecting updates made from a stale copy like the If-Match header does"""
+
+    def __init__(self, access, races=None):
+        self.project = "p"
+        self.datasets = {dataset_id: {"datasetReference": {"projectId": "p", "datasetId": dataset_id}, "etag": "1",
+                                      "access": json_copy(entries)} for dataset_id, entries in access.items()}
+        # Entries another writer adds to a dataset just before each of our updates
+        self.races = {dataset_id: list(entries) for dataset_id, entries in (races or {}).items()}
+        self.updates = []
+        self.lock = threading.Lock()
+
+    def _call_api(self, retry, span_name, span_attributes, method, path, query_params=None, headers=None):
+        dataset_id = path.rsplit("/", 1)[1]
+        if dataset_id not in self.datasets:
+            raise exceptions.NotFound(path)
+        return json_copy(self.datasets[dataset_id])
+
+    def update_dataset(self, dataset, fields):
+        with self.lock:
+            resource = self.datasets[dataset.dataset_id]
+            if self.races.get(dataset.dataset_id):
+                resource["access"].append(self.races[dataset.dataset_id].pop(0))
+                resource["etag"] = str(int(resource["etag"]) + 1)
+            if dataset.etag != resource["etag"]:
+                raise exceptions.PreconditionFailed("etag mismatch")
+            self.updates.append(dataset.dataset_id)
+            resource["access"] = [entry.to_api_repr() for entry in dataset.access_entries]
+            resource["etag"] = str(int(resource["etag"]) + 1)
+            return bigquery.Dataset.from_api_repr(json_copy(resource))
+
+
+class AccessEntryTest(unittest.TestCase):
+
+    def test_access_key(self):
+        cases = [
+            # entry, equivalent entry, same key
+            ({"role": "READER", "userByEmail": "a@example.com"},
+             {"role": "roles/bigquery.dataViewer", "userByEmail": "a@example.com"}, True),
+            ({"role": "OWNER", "groupByEmail": "g@example.com"},
+             {"role": "roles/bigquery.dataOwner", "groupByEmail": "G@Example.com"}, True),
+            ({"userByEmail": "a@example.com", "role": "WRITER"},
+             {"role": "roles/bigquery.dataEditor", "userByEmail": "A@EXAMPLE.COM"}, True),
+            ({"role": "READER", "userByEmail": "a@example.com"}, {"role": "WRITER", "userByEmail": "a@example.com"},
+             False),
+            ({"role": "READER", "userByEmail": "a@example.com"}, {"role": "READER", "groupByEmail": "a@example.com"},
+             False),
+            ({"role": "roles/bigquery.admin", "userByEmail": "a@example.com"},
+             {"role": "OWNER", "userByEmail": "a@example.com"}, False),
+            ({"view": {"projectId": "p", "datasetId": "d", "tableId": "v"}},
+             {"view": {"tableId": "v", "datasetId": "d", "projectId": "p"}}, True),
+        ]
+        for entry, other, same in cases:
+            with self.subTest(entry=entry, other=other):
+                self.assertEqual(access_key(entry) == access_key(other), same)
+
+    def test_access_key_does_not_modify(self):
+        entry = {"role": "roles/bigquery.dataViewer", "userByEmail": "A@example.com"}
+        access_key(entry)
+        self.assertEqual(entry, {"role": "roles/bigquery.dataViewer", "userByEmail": "A@example.com"})
+
+    def test_dedupe_access(self):
+        # WDL structs carry every field, unset ones as null or ""
+        wdl_reader = {"role": "roles/bigquery.dataViewer", "userByEmail": "Reader@example.com", "groupByEmail": None,
+                      "domain": "", "specialGroup": None, "view": None}
+        self.assertEqual(dedupe_access([wdl_reader, READER, WRITER, dict(WRITER), OWNER]),
+                         [{"role": "roles/bigquery.dataViewer", "userByEmail": "Reader@example.com"}, WRITER, OWNER])
+        self.assertEqual(dedupe_access([]), [])
+
+
+class BulkACLTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cwd = os.getcwd()
+        os.chdir(directory.name)
+        self.addCleanup(os.chdir, cwd)
+        self.clock = FakeClock()
+        for patcher in (mock.patch.object(wbq, "time", self.clock), mock.patch.object(wbq, "CACHE", MetadataCache())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def apply(self, client, datasets, acls, **options):
+        with mock.patch.object(wbq.bigquery, "Client", return_value=client):
+            bulk_ACL(BulkACLConfig(datasets=datasets, acls=acls, **options))
+
+    def report(self):
+        with open("acl.json") as report_file:
+            return json.load(report_file)
+
+    def access(self, client, dataset_id):
+        return sorted(access_key(entry) for entry in client.datasets[dataset_id]["access"])
+
+    def keys(self, *entries):
+        return sorted(access_key(entry) for entry in entries)
+
+    def test_replace(self):
+        client = FakeACLClient({"a": [OWNER, READER], "b": [OWNER, WRITER]})
+        self.apply(client, ["a", "b"], [OWNER, WRITER, dict(WRITER, role="roles/bigquery.dataEditor")])
+        # Entries that are not in the ACL are removed
+        self.assertEqual(self.access(client, "a"), self.keys(OWNER, WRITER))
+        self.assertEqual(self.access(client, "b"), self.keys(OWNER, WRITER))
+        report = self.report()
+        self.assertEqual(len(report["entries"]), 2)
+        self.assertEqual({result["dataset"]: (result["action"], result["added"], result["removed"])
+                          for result in report["datasets"]}, {"a": ("updated", 1, 1), "b": ("unchanged", 0, 0)})
+        self.assertEqual((report["updated"], report["unchanged"]), (1, 1))
+        # Datasets that already match are not updated
+        self.assertEqual(client.updates, ["a"])
+
+    def test_append(self):
+        client = FakeACLClient({"a": [OWNER, READER], "b": [OWNER, dict(READER, role="roles/bigquery.dataViewer")]})
+        self.apply(client, ["a", "b"], [READER, WRITER], append=True)
+        self.assertEqual(self.access(client, "a"), self.keys(OWNER, READER, WRITER))
+        self.assertEqual(self.access(client, "b"), self.keys(OWNER, READER, WRITER))
+        self.assertEqual([(result["added"], result["removed"]) for result in self.report()["datasets"]],
+                         [(1, 0), (1, 0)])
+
+    def test_append_unchanged(self):
+        client = FakeACLClient({"a": [OWNER, READER]})
+        self.apply(client, ["a"], [dict(READER, userByEmail="READER@example.com")], append=True)
+        self.assertEqual(client.updates, [])
+        self.assertEqual(self.report()["unchanged"], 1)
+
+    def test_duplicate_datasets(self):
+        client = FakeACLClient({"a": [OWNER]})
+        self.apply(client, ["a", "a"], [OWNER, READER])
+        self.assertEqual(client.updates, ["a"])
+        self.assertEqual(len(self.report()["datasets"]), 1)
+
+    def test_concurrent_change_is_merged(self):
+        client = FakeACLClient({"a": [OWNER]}, races={"a": [WRITER]})
+        self.apply(client, ["a"], [READER], append=True)
+        # The entry added by the other writer is re-read and kept
+        self.assertEqual(self.access(client, "a"), self.keys(OWNER, READER, WRITER))
+        self.assertEqual(self.report()["datasets"][0]["attempts"], 2)
+        self.assertEqual(len(self.clock.sleeps), 1)
+
+    def test_concurrent_change_retries_exhausted(self):
+        client = FakeACLClient({"a": [OWNER], "b": [OWNER]}, races={"a": [WRITER, dict(WRITER, groupByEmail="x@example.com")]})
+        with self.assertRaisesRegex(Exception, "Failed to update the ACL of 1 dataset\\(s\\): a"):
+            self.apply(client, ["a", "b"], [OWNER, READER], maxRetries=1)
+        report = self.report()
+        self.assertEqual([failure["dataset"] for failure in report["failures"]], ["a"])
+        self.assertEqual([result["dataset"] for result in report["datasets"]], ["b"])
+
+    def test_missing_dataset(self):
+        client = FakeACLClient({"a": [OWNER]})
+        with self.assertRaisesRegex(Exception, "1 dataset\\(s\\): missing"):
+            self.apply(client, ["missing", "a"], [OWNER, READER])
+        self.assertEqual(client.updates, ["a"])
+        self.assertEqual(self.report()["updated"], 1)
+
+
+def json_copy(value):
+    return json.loads(json.dumps(value))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from gcp.columnar import csv_to_parquet, parquet_compatible
+
+SCHEMA = [
+    {"name": "zip", "type": "STRING"},
+    {"name": "n", "type": "INTEGER"},
+    {"name": "amount", "type": "NUMERIC"},
+    {"name": "day", "type": "DATE"},
+    {"name": "at", "type": "TIMESTAMP"},
+]
+
+
+class ColumnarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def convert(self, text: str, schema_fields=SCHEMA, skip_leading_rows=0) -> pa.Table:
+        source = os.path.join(self.directory.name, "source.csv")
+        destination = os.path.join(self.directory.name, "source.parquet")
+        with open(source, "w") as source_file:
+            source_file.write(text)
+        stats = csv_to_parquet(source, destination, schema_fields, skip_leading_rows=skip_leading_rows)
+        table = pq.read_table(destination)
+        self.assertEqual(stats["rows"], table.num_rows)
+        return table
+
+    def test_types(self):
+        table = self.convert("zip,n,amount,day,at\n"
+                             "01234,1,1.25,2020-01-31,2020-01-01 00:00:00\n"
+                             ",,,,\n", skip_leading_rows=1)
+        self.assertEqual(table.column("zip").to_pylist(), ["01234", None])
+        self.assertEqual(table.column("n").to_pylist(), [1, None])
+        self.assertEqual(table.column("amount").to_pylist(), [Decimal("1.25"), None])
+        self.assertEqual(table.column("day").to_pylist(), [date(2020, 1, 31), None])
+        self.assertEqual(table.schema.field("at").type, pa.timestamp("us", tz="UTC"))
+
+    def test_timestamps(self):
+        rows = ["2020-01-01 00:00:00", "2020-01-01 00:00:00 UTC", "2020-01-01T00:00:00Z", "2020-01-01",
+                "2020-01-01 02:00:00+02:00", "2019-12-31 18:30:00-0530", "2020-01-01 00:00:00.000000"]
+        table = self.convert("".join("1,1,1,2020-01-01,{}\n".format(row) for row in rows))
+        self.assertEqual(table.column("at").to_pylist(), [datetime(2020, 1, 1, tzinfo=timezone.utc)] * len(rows))
+
+    def test_unparseable_timestamp(self):
+        with self.assertRaises(pa.ArrowInvalid):
+            self.convert("1,1,1,2020-01-01,2020-01-01 00:00:00 America/Los_Angeles\n")
+
+    def test_requires_schema(self):
+        self.assertFalse(parquet_compatible(None))
+        self.assertFalse(parquet_compatible([]))
+        self.assertTrue(parquet_compatible(SCHEMA))
+        self.assertFalse(parquet_compatible([{"name": "b", "type": "BYTES"}]))
+        self.assertFalse(parquet_compatible([{"name": "r", "type": "STRING", "mode": "REPEATED"}]))
+        with self.assertRaises(ValueError):
+            self.convert("1\n", schema_fields=None)
+
+
+if __name__ == "__main__":
+    unittest.main()
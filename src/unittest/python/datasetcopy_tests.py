@@ -0,0 +1,102 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from google.cloud import bigquery
+
+from gcp.datasetcopy import parse_dataset_expr, retarget_query, table_diff, view_order
+
+SOURCE = bigquery.DatasetReference("proj", "src")
+TARGET = bigquery.DatasetReference("proj", "dst")
+
+
+def table(rows=10, size=100, modified=1000, schema=(("id", "INTEGER"),)) -> bigquery.Table:
+    table = bigquery.Table.from_api_repr({
+        "tableReference": {"projectId": "proj", "datasetId": "src", "tableId": "t"},
+        "numRows": str(rows), "numBytes": str(size), "lastModifiedTime": str(modified),
+        "schema": {"fields": [{"name": name, "type": type} for name, type in schema]}})
+    return table
+
+
+class ViewOrderTest(unittest.TestCase):
+
+    def test_levels(self):
+        views = {
+            "a": "SELECT * FROM src.t",
+            "b": "SELECT * FROM `proj.src.a` JOIN src.c USING (id)",
+            "c": "SELECT * FROM proj.src.a",
+            "d": "SELECT id FROM src . b",
+        }
+        self.assertEqual(view_order(views, SOURCE), [["a"], ["c"], ["b"], ["d"]])
+
+    def test_column_references_ignored(self):
+        # t.customers and a struct path orders.a are columns, not views
+        views = {
+            "customers": "SELECT t.customers, orders.a.b FROM src.raw t JOIN src.people AS orders USING (id)",
+            "orders": "SELECT c.id FROM src.raw c WHERE c.orders > 0 AND EXTRACT(DAY FROM t.customers) = 1",
+        }
+        self.assertEqual(view_order(views, SOURCE), [["customers", "orders"]])
+
+    def test_strings_and_comments_ignored(self):
+        views = {
+            "a": "SELECT 'FROM src.b' AS s FROM src.t -- JOIN src.b",
+            "b": "SELECT * FROM src.t /* FROM src.a */",
+        }
+        self.assertEqual(view_order(views, SOURCE), [["a", "b"]])
+
+    def test_other_datasets_ignored(self):
+        views = {"a": "SELECT * FROM other.b", "b": "SELECT * FROM `other-proj.src.a`"}
+        self.assertEqual(view_order(views, SOURCE), [["a", "b"]])
+
+    def test_circular(self):
+        with self.assertRaisesRegex(ValueError, "Circular view references: a, b"):
+            view_order({"a": "SELECT * FROM src.b", "b": "SELECT * FROM src.a", "c": "SELECT 1"}, SOURCE)
+
+
+class RetargetQueryTest(unittest.TestCase):
+
+    def test_table_references(self):
+        sql = "SELECT * FROM src.t JOIN `src.u` USING (id) JOIN proj.src.v USING (id) LEFT JOIN `proj:src.w` ON TRUE"
+        self.assertEqual(retarget_query(sql, SOURCE, TARGET),
+                         "SELECT * FROM dst.t JOIN `dst.u` USING (id) JOIN proj.dst.v USING (id) "
+                         "LEFT JOIN `proj:dst.w` ON TRUE")
+
+    def test_literals_and_fields_untouched(self):
+        sql = "SELECT src.name, 'src.t', \"proj.src.x\" FROM src.t AS src -- src.t"
+        self.assertEqual(retarget_query(sql, SOURCE, TARGET),
+                         "SELECT src.name, 'src.t', \"proj.src.x\" FROM dst.t AS src -- src.t")
+
+    def test_other_project(self):
+        target = bigquery.DatasetReference("other", "dst")
+        self.assertEqual(retarget_query("SELECT * FROM `proj.src.t` JOIN src.u", SOURCE, target),
+                         "SELECT * FROM `other.dst.t` JOIN src.u")
+
+
+class TableDiffTest(unittest.TestCase):
+
+    def test_diff(self):
+        self.assertEqual(table_diff(table(), None), ["missing"])
+        self.assertEqual(table_diff(table(), table(modified=2000)), [])
+        self.assertEqual(table_diff(table(modified=3000), table(modified=2000)), ["modified"])
+        self.assertEqual(table_diff(table(rows=11, size=110), table()), ["numRows", "numBytes"])
+        self.assertEqual(table_diff(table(schema=(("id", "STRING"),)), table()), ["schema"])
+
+    def test_parse_dataset_expr(self):
+        self.assertEqual(parse_dataset_expr("proj:src.t_.*"), ("proj", "src", "t_.*"))
+        self.assertEqual(parse_dataset_expr("proj:src"), ("proj", "src", ".*"))
+
+
+if __name__ == "__main__":
+    unittest.main()
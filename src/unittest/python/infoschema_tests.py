@@ -0,0 +1,120 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from google.cloud import bigquery
+
+from gcp.infoschema import TypeParser, partitioning, table_resource
+
+DATASET = bigquery.Dataset("p.d")
+DATASET.location = "US"
+
+
+def table(ddl="CREATE TABLE `p.d.t`\n(\n  id INT64\n);", table_type="BASE TABLE") -> dict:
+    return {"table_name": "t", "table_type": table_type, "ddl": ddl, "view_definition": None,
+            "use_standard_sql": None, "row_count": 3, "size_bytes": 30, "creation_time": 1700000000000,
+            "last_modified_time": 1700000000001}
+
+
+def column(name, data_type, position=1, field_path=None, **values) -> dict:
+    row = {"table_name": "t", "column_name": name, "ordinal_position": position, "is_nullable": "YES",
+           "data_type": data_type, "column_default": "NULL", "clustering_ordinal_position": None,
+           "field_path": field_path or name, "description": None, "collation_name": "NULL", "rounding_mode": None,
+           "policy_tags": 0}
+    row.update(values)
+    return row
+
+
+class PartitioningTest(unittest.TestCase):
+
+    def test_time(self):
+        self.assertEqual(partitioning("CREATE TABLE t (d DATE)\nPARTITION BY d\nOPTIONS()"),
+                         {"timePartitioning": {"type": "DAY", "field": "d"}})
+        self.assertEqual(partitioning("PARTITION BY TIMESTAMP_TRUNC(ts, HOUR)\nCLUSTER BY id"),
+                         {"timePartitioning": {"type": "HOUR", "field": "ts"}})
+        self.assertEqual(partitioning("PARTITION BY DATE(`ts`)"), {"timePartitioning": {"type": "DAY", "field": "ts"}})
+        self.assertEqual(partitioning("PARTITION BY _PARTITIONDATE"), {"timePartitioning": {"type": "DAY"}})
+        self.assertEqual(partitioning("PARTITION BY DATE_TRUNC(_PARTITIONTIME, MONTH)"),
+                         {"timePartitioning": {"type": "MONTH"}})
+
+    def test_range(self):
+        self.assertEqual(partitioning("PARTITION BY RANGE_BUCKET(n, GENERATE_ARRAY(-10, 100, 5))"),
+                         {"rangePartitioning": {"field": "n", "range": {"start": "-10", "end": "100",
+                                                                        "interval": "5"}}})
+
+    def test_none_and_unsupported(self):
+        self.assertEqual(partitioning("CREATE TABLE t (id INT64);"), {})
+        self.assertEqual(partitioning(None), {})
+        with self.assertRaises(ValueError):
+            partitioning("PARTITION BY TIMESTAMP_TRUNC(DATETIME(ts), DAY)")
+
+
+class TableResourceTest(unittest.TestCase):
+
+    def test_table(self):
+        columns = [column("id", "INT64", is_nullable="NO", clustering_ordinal_position=1, description="key"),
+                   column("rec", "ARRAY<STRUCT<a STRING(10) NOT NULL, b NUMERIC(10, 2)>>", 2),
+                   column("rec", "", 2, field_path="rec.a"),
+                   column("rec", "", 2, field_path="rec.b", description="b")]
+        options = [("description", '"A \\"table\\""'), ("labels", '[STRUCT("env", "prod")]'),
+                   ("partition_expiration_days", "1.5")]
+        resource = table_resource(DATASET, table(ddl="CREATE TABLE t (id INT64)\nPARTITION BY _PARTITIONDATE"),
+                                  options, columns)
+        self.assertEqual(resource["tableReference"], {"projectId": "p", "datasetId": "d", "tableId": "t"})
+        self.assertEqual((resource["type"], resource["numRows"], resource["lastModifiedTime"]),
+                         ("TABLE", "3", "1700000000001"))
+        self.assertEqual(resource["schema"]["fields"], [
+            {"name": "id", "type": "INTEGER", "mode": "REQUIRED", "description": "key"},
+            {"name": "rec", "type": "RECORD", "mode": "REPEATED", "fields": [
+                {"name": "a", "type": "STRING", "mode": "REQUIRED", "maxLength": "10"},
+                {"name": "b", "type": "NUMERIC", "mode": "NULLABLE", "precision": "10", "scale": "2",
+                 "description": "b"}]}])
+        self.assertEqual(resource["clustering"], {"fields": ["id"]})
+        self.assertEqual(resource["timePartitioning"], {"type": "DAY", "expirationMs": str(int(1.5 * 86400000))})
+        self.assertEqual(resource["description"], 'A "table"')
+        self.assertEqual(resource["labels"], {"env": "prod"})
+        # The rebuilt resource is readable by the client library
+        self.assertEqual(bigquery.Table.from_api_repr(resource).schema[1].fields[0].max_length, 10)
+
+    def test_view(self):
+        row = table(table_type="VIEW")
+        row.update(view_definition="SELECT 1 AS id", use_standard_sql="YES")
+        resource = table_resource(DATASET, row, [], [column("id", "INT64")])
+        self.assertEqual(resource["view"], {"query": "SELECT 1 AS id", "useLegacySql": False})
+        self.assertEqual(resource["numRows"], "0")
+
+    def test_falls_back(self):
+        columns = [column("id", "INT64")]
+        for row, options, fallback_columns in (
+                (table(table_type="MATERIALIZED VIEW"), [], columns),
+                (table(ddl="CREATE TABLE t (id INT64, PRIMARY KEY (id) NOT ENFORCED);"), [], columns),
+                (table(ddl="CREATE TABLE t (id INT64,\n  FOREIGN KEY (id) REFERENCES d.u(id) NOT ENFORCED);"), [],
+                 columns),
+                (table(), [("max_staleness", "INTERVAL 1 HOUR")], columns),
+                (table(), [], [column("id", "INT64", policy_tags=1)]),
+                (table(), [], [column("r", "RANGE<DATE>")]),
+                (dict(table(), last_modified_time=None), [], columns)):
+            with self.assertRaises(ValueError):
+                table_resource(DATASET, row, options, fallback_columns)
+
+    def test_type_parser(self):
+        self.assertEqual(TypeParser("BIGNUMERIC(40)").parse("n"),
+                         {"name": "n", "mode": "NULLABLE", "type": "BIGNUMERIC", "precision": "40"})
+        with self.assertRaises(ValueError):
+            TypeParser("STRUCT<a INT64").parse("s")
+
+
+if __name__ == "__main__":
+    unittest.main()
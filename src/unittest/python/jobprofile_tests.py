@@ -0,0 +1,128 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from gcp.jobprofile import _bytes, format_profile, profile_job
+
+
+def stage(name, slot_ms, shuffle=0, spilled=0, compute=(10, 10), wait=(5, 5), start=1000, end=2000):
+    """An ExplainQueryStage as returned by the REST API (int64 values as strings)"""
+    return {"id": name, "name": name, "status": "COMPLETE", "startMs": str(start), "endMs": str(end),
+            "slotMs": str(slot_ms), "computeMsAvg": str(compute[0]), "computeMsMax": str(compute[1]),
+            "waitMsAvg": str(wait[0]), "waitMsMax": str(wait[1]), "waitRatioAvg": 0.25, "readRatioAvg": 0.5,
+            "computeRatioAvg": 1, "writeRatioAvg": 0.125, "recordsRead": "100", "recordsWritten": "10",
+            "shuffleOutputBytes": str(shuffle), "shuffleOutputBytesSpilled": str(spilled), "parallelInputs": "4"}
+
+
+def query_job(stages, total_slot_ms=None, billed="10485760", processed="20971520"):
+    statistics = {"startTime": "1000", "endTime": "3000",
+                  "query": {"queryPlan": stages, "totalBytesBilled": billed, "totalBytesProcessed": processed,
+                            "cacheHit": False}}
+    if total_slot_ms is not None:
+        statistics["totalSlotMs"] = str(total_slot_ms)
+    return {"jobReference": {"jobId": "job_1"}, "status": {"state": "DONE"}, "statistics": statistics}
+
+
+class ProfileJobTest(unittest.TestCase):
+
+    def test_stage_aggregation(self):
+        cases = [
+            # stages, totalSlotMs, expected total slot-ms, shuffled, spilled, slowest (top 2)
+            ([stage("S00", 100, shuffle=1000), stage("S01", 300, shuffle=500, spilled=200), stage("S02", 200)],
+             None, 600, 1500, 200, ["S01", "S02"]),
+            ([stage("S00", 100), stage("S01", 300)], 800, 800, 0, 0, ["S01", "S00"]),
+            ([], 50, 50, 0, 0, []),
+            ([], None, 0, 0, 0, []),
+        ]
+        for stages, total, slot_ms, shuffled, spilled, slowest in cases:
+            with self.subTest(stages=len(stages), total=total):
+                report = profile_job(query_job(stages, total), top=2)
+                self.assertEqual(report["totalSlotMs"], slot_ms)
+                self.assertEqual(report["shuffleOutputBytes"], shuffled)
+                self.assertEqual(report["shuffleOutputBytesSpilled"], spilled)
+                self.assertEqual(report["slowestStages"], slowest)
+                self.assertEqual([s["name"] for s in report["stages"] if s["slowest"]], sorted(slowest))
+                self.assertEqual(report["averageSlots"], round(slot_ms / 2000, 2))
+
+    def test_slot_share(self):
+        report = profile_job(query_job([stage("S00", 100), stage("S01", 300)], 800))
+        self.assertEqual([s["slotShare"] for s in report["stages"]], [0.125, 0.375])
+        self.assertIsNone(profile_job(query_job([stage("S00", 0)]))["stages"][0]["slotShare"])
+
+    def test_skew(self):
+        cases = [
+            # compute (avg, max), wait (avg, max), computeSkew, waitSkew, skewed
+            ((10, 10), (5, 5), 1.0, 1.0, False),
+            ((10, 49), (5, 5), 4.9, 1.0, False),
+            ((10, 50), (5, 5), 5.0, 1.0, True),
+            ((10, 10), (2, 40), 1.0, 20.0, True),
+            ((0, 10), (0, 0), None, None, False),
+        ]
+        for compute, wait, compute_skew, wait_skew, skewed in cases:
+            with self.subTest(compute=compute, wait=wait):
+                report = profile_job(query_job([stage("S00", 100, compute=compute, wait=wait)]))
+                profiled = report["stages"][0]
+                self.assertEqual((profiled["computeSkew"], profiled["waitSkew"], profiled["skewed"]),
+                                 (compute_skew, wait_skew, skewed))
+                self.assertEqual(report["skewedStages"], ["S00"] if skewed else [])
+
+    def test_job_types(self):
+        load = {"jobReference": {"jobId": "load_1"}, "status": {"state": "DONE"},
+                "statistics": {"totalSlotMs": "70", "load": {"outputRows": "5"}}}
+        report = profile_job(load)
+        self.assertEqual((report["jobType"], report["totalSlotMs"], report["elapsedMs"], report["totalBytesBilled"]),
+                         ("load", 70, None, 0))
+        self.assertIsNone(profile_job({})["jobType"])
+
+    def test_stage_durations(self):
+        profiled = profile_job(query_job([stage("S00", 100, start=1500, end=4000)]))["stages"][0]
+        self.assertEqual((profiled["durationMs"], profiled["recordsRead"], profiled["waitRatio"]), (2500, 100, 0.25))
+
+
+class FormatProfileTest(unittest.TestCase):
+
+    def test_bytes(self):
+        cases = [(0, "0B"), (1023, "1023B"), (1024, "1.0KB"), (1536, "1.5KB"), (10485760, "10.0MB"),
+                 (3 * 1024 ** 3, "3.0GB"), (5 * 1024 ** 5, "5120.0TB")]
+        for num, text in cases:
+            with self.subTest(num=num):
+                self.assertEqual(_bytes(num), text)
+
+    def test_summary(self):
+        report = profile_job(query_job([stage("S00", 100, shuffle=2048, spilled=1024)], 400))
+        self.assertEqual(format_profile(report).splitlines()[0],
+                         "Job job_1 (query, DONE): 2000 ms elapsed, 400 slot-ms, 0.2 avg slots, 20.0MB processed, "
+                         "10.0MB billed, 2.0KB shuffled, 1.0KB spilled")
+
+    def test_billed_without_stages(self):
+        text = format_profile(profile_job(query_job([], 10, billed=None, processed="512")))
+        self.assertEqual(text, "Job job_1 (query, DONE): 2000 ms elapsed, 10 slot-ms, 0.01 avg slots, 512B processed, "
+                               "0B billed, 0B shuffled, 0B spilled")
+
+    def test_stage_table(self):
+        lines = format_profile(profile_job(query_job(
+            [stage("S00: Input", 100), stage("S01: Aggregate", 300, compute=(10, 60), spilled=4096)]), top=1))
+        lines = lines.splitlines()
+        self.assertTrue(lines[1].split()[:2] == ["stage", "slot-ms"])
+        self.assertEqual(len(lines), 6)
+        rows = {line[3:31].strip(): line for line in lines[3:5]}
+        self.assertTrue(rows["S01: Aggregate"].startswith("*! S01: Aggregate"))
+        self.assertTrue(rows["S01: Aggregate"].rstrip().endswith("4.0KB   6.00"))
+        self.assertTrue(rows["S00: Input"].startswith("   S00: Input"))
+        self.assertEqual(lines[-1], "* slowest stages by slot-ms, ! compute or wait skew >= 5.0x")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from google.api_core import exceptions
+from google.cloud import bigquery
+
+from gcp import metacache
+from gcp.metacache import MetadataCache
+
+
+class FakeClient():
+    """Serves table and dataset resources by path, answering 304 when If-None-Match has the current etag"""
+
+    project = "p"
+
+    def __init__(self):
+        self.resources = {}
+        self.requests = []
+
+    def set(self, path, etag, **values):
+        self.resources[path] = dict(values, etag=etag)
+
+    def _call_api(self, retry, span_name, span_attributes, method, path, headers):
+        self.requests.append((path, (headers or {}).get("If-None-Match")))
+        if path not in self.resources:
+            raise exceptions.NotFound(path)
+        resource = self.resources[path]
+        if headers and headers.get("If-None-Match") == resource["etag"]:
+            raise exceptions.NotModified(path)
+        return dict(resource)
+
+
+TABLE = "/projects/p/datasets/d/tables/t"
+DATASET = "/projects/p/datasets/d"
+
+
+def table(description):
+    return {"tableReference": {"projectId": "p", "datasetId": "d", "tableId": "t"}, "description": description}
+
+
+class MetadataCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = SimpleNamespace(now=100.0)
+        patcher = mock.patch.object(metacache, "time", SimpleNamespace(monotonic=lambda: self.clock.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = MetadataCache(ttl=60)
+        self.client = FakeClient()
+        self.client.set(TABLE, "e1", **table("first"))
+        self.client.set(DATASET, "d1", datasetReference={"projectId": "p", "datasetId": "d"})
+
+    def test_hit_within_ttl(self):
+        first = self.cache.get_table(self.client, "p.d.t")
+        first.description = "changed locally"
+        self.clock.now += 59
+        second = self.cache.get_table(self.client, bigquery.TableReference.from_string("p.d.t"))
+        # Served from the cache, as a copy
+        self.assertEqual(second.description, "first")
+        self.assertEqual(self.client.requests, [(TABLE, None)])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_revalidated_after_ttl(self):
+        self.cache.get_table(self.client, "p.d.t")
+        self.clock.now += 61
+        self.assertEqual(self.cache.get_table(self.client, "p.d.t").description, "first")
+        self.assertEqual(self.client.requests, [(TABLE, None), (TABLE, "e1")])
+        self.assertEqual(self.cache.revalidated, 1)
+        # Revalidating restarts the ttl
+        self.clock.now += 30
+        self.cache.get_table(self.client, "p.d.t")
+        self.assertEqual(len(self.client.requests), 2)
+
+    def test_changed_resource(self):
+        self.cache.get_table(self.client, "p.d.t")
+        self.client.set(TABLE, "e2", **table("second"))
+        self.assertEqual(self.cache.get_table(self.client, "p.d.t", max_age=0).description, "second")
+        self.assertEqual(self.client.requests[-1], (TABLE, "e1"))
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_invalidate(self):
+        self.cache.get_table(self.client, "p.d.t")
+        self.cache.get_dataset(self.client, "p.d")
+        self.cache.invalidate(bigquery.TableReference.from_string("p.d.t"))
+        self.cache.get_table(self.client, "p.d.t")
+        # Fetched again without an etag
+        self.assertEqual(self.client.requests[-1], (TABLE, None))
+        # Invalidating a dataset drops its tables too
+        self.cache.invalidate(bigquery.DatasetReference("p", "d"))
+        self.assertEqual(self.cache.stats()["entries"], 0)
+        self.assertEqual(self.cache.invalidations, 2)
+
+    def test_put(self):
+        created = bigquery.Table.from_api_repr(table("created"))
+        self.cache.put(created)
+        self.assertEqual(self.cache.get_table(self.client, "p.d.t").description, "created")
+        self.assertEqual(self.client.requests, [])
+
+    def test_not_found(self):
+        with self.assertRaises(exceptions.NotFound):
+            self.cache.get_table(self.client, "p.d.missing")
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    def test_stats(self):
+        self.cache.get_dataset(self.client, "p.d")
+        self.cache.get_dataset(self.client, "p.d")
+        self.assertEqual(self.cache.stats(), {"hits": 1, "misses": 1, "revalidated": 0, "invalidations": 0,
+                                              "entries": 1, "ttl": 60})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from gcp.schema import catalogue_table, diff_fields, normalize_field
+
+
+class SchemaTest(unittest.TestCase):
+
+    existing = [
+        {"name": "id", "type": "INTEGER", "mode": "REQUIRED"},
+        {"name": "name", "type": "STRING"},
+        {"name": "rec", "type": "RECORD", "fields": [{"name": "a", "type": "STRING"}]},
+    ]
+
+    def test_normalize_aliases(self):
+        self.assertEqual(normalize_field({"name": "ID", "type": "int64"}),
+                         {"name": "id", "type": "INTEGER", "mode": "NULLABLE"})
+
+    def test_unchanged(self):
+        requested = [{"name": "id", "type": "INT64", "mode": "REQUIRED"}, {"name": "name", "type": "STRING"},
+                     {"name": "rec", "type": "STRUCT", "fields": [{"name": "a", "type": "STRING"}]}]
+        merged, changes, incompatible = diff_fields(requested, self.existing)
+        self.assertEqual(merged, self.existing)
+        self.assertEqual(changes, [])
+        self.assertEqual(incompatible, [])
+
+    def test_compatible_changes(self):
+        requested = [{"name": "name", "type": "STRING", "description": "Name"},
+                     {"name": "id", "type": "INTEGER", "mode": "NULLABLE"},
+                     {"name": "rec", "type": "RECORD", "fields": [{"name": "a", "type": "STRING"},
+                                                                  {"name": "b", "type": "DATE"}]},
+                     {"name": "added", "type": "STRING"}]
+        merged, changes, incompatible = diff_fields(requested, self.existing)
+        # Existing column order is kept, new columns are appended
+        self.assertEqual([field["name"] for field in merged], ["id", "name", "rec", "added"])
+        self.assertEqual(merged[0]["mode"], "NULLABLE")
+        self.assertEqual(merged[1]["description"], "Name")
+        self.assertEqual([field["name"] for field in merged[2]["fields"]], ["a", "b"])
+        self.assertEqual(changes, ["id: mode REQUIRED -> NULLABLE", "name: description", "rec.b: added", "added: added"])
+        self.assertEqual(incompatible, [])
+
+    def test_incompatible_changes(self):
+        requested = [{"name": "id", "type": "STRING", "mode": "REQUIRED"},
+                     {"name": "rec", "type": "RECORD", "fields": []},
+                     {"name": "required", "type": "STRING", "mode": "REQUIRED"}]
+        _, _, incompatible = diff_fields(requested, self.existing)
+        self.assertEqual(incompatible, ["id: type INTEGER -> STRING", "name: removed", "rec.a: removed",
+                                        "required: added REQUIRED column"])
+
+    def test_catalogue_table(self):
+        table = catalogue_table("p", "d", "t", {"fields": [{"name": "id"}], "description": "T", "sql": "SELECT 1"})
+        self.assertEqual(table, {"tableReference": {"projectId": "p", "datasetId": "d", "tableId": "t"},
+                                 "schema": {"fields": [{"name": "id"}]}, "description": "T"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from google.cloud.bigquery_storage import types
+
+from gcp.bigquery import ReadTableConfig, read_table
+
+SCHEMA = pa.schema([("id", pa.int64()), ("name", pa.string())])
+
+
+def page(start: int, rows: int) -> SimpleNamespace:
+    batch = pa.RecordBatch.from_arrays([pa.array(range(start, start + rows), pa.int64()),
+                                        pa.array(["n{}".format(i) for i in range(start, start + rows)])],
+                                       schema=SCHEMA)
+    return SimpleNamespace(to_arrow=lambda: batch)
+
+
+class FakeReadClient():
+    """
+    Stand-in for BigQueryReadClient, serving each stream's pages (a list of row counts) from memory
+    """
+
+    def __init__(self, streams):
+        self.streams = streams
+        self.requests = []
+
+    def create_read_session(self, parent, read_session, max_stream_count):
+        self.requests.append((parent, read_session, max_stream_count))
+        return types.ReadSession(
+            name="projects/p/locations/us/sessions/s",
+            arrow_schema=types.ArrowSchema(serialized_schema=SCHEMA.serialize().to_pybytes()),
+            streams=[types.ReadStream(name="s/streams/{}".format(i)) for i in range(len(self.streams))])
+
+    def read_rows(self, name):
+        pages, start = [], 0
+        stream = int(name.rsplit("/", 1)[1])
+        for rows in self.streams[stream]:
+            pages.append(page(stream * 1000 + start, rows))
+            start += rows
+        return SimpleNamespace(rows=lambda session: SimpleNamespace(pages=pages))
+
+
+class ReadTableTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cwd = os.getcwd()
+        os.chdir(directory.name)
+        self.addCleanup(os.chdir, cwd)
+        patcher = mock.patch.dict(os.environ, {"GCP_PROJECT": "billing"})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def read(self, pages, **options) -> dict:
+        config = ReadTableConfig(table={"projectId": "p", "datasetId": "d", "tableId": "t"}, **options)
+        self.client = FakeReadClient(pages)
+        read_table(config, read_client=self.client)
+        with open("read_table.json") as result_file:
+            return json.load(result_file)
+
+    def test_streams(self):
+        result = self.read([[3, 2], [4], []], columns=["id", "name"], rowFilter="id > 0", streams=3)
+        parent, session, max_streams = self.client.requests[0]
+        self.assertEqual(parent, "projects/billing")
+        self.assertEqual(session.table, "projects/p/datasets/d/tables/t")
+        self.assertEqual(list(session.read_options.selected_fields), ["id", "name"])
+        self.assertEqual(session.read_options.row_restriction, "id > 0")
+        self.assertEqual(max_streams, 3)
+
+        self.assertEqual(result["streams"], 3)
+        self.assertEqual(result["rows"], 9)
+        self.assertEqual([(f["path"], f["rows"]) for f in result["files"]],
+                         [("rows-00000.parquet", 5), ("rows-00001.parquet", 4), ("rows-00002.parquet", 0)])
+        self.assertEqual(pq.read_table("rows-00000.parquet").column("id").to_pylist(), [0, 1, 2, 3, 4])
+        self.assertEqual(pq.read_table("rows-00001.parquet").column("name").to_pylist(),
+                         ["n1000", "n1001", "n1002", "n1003"])
+        self.assertEqual(pq.read_table("rows-00002.parquet").num_rows, 0)
+
+    def test_merge(self):
+        result = self.read([[2], [3, 1]], merge=True, format="CSV", outputPrefix="out")
+        self.assertEqual([(f["path"], f["rows"]) for f in result["files"]], [("out.csv", 6)])
+        ids = pa_csv.read_csv("out.csv").column("id").to_pylist()
+        self.assertEqual(sorted(ids), [0, 1, 1000, 1001, 1002, 1003])
+
+    def test_empty_table(self):
+        result = self.read([], format="ARROW")
+        self.assertEqual(result["streams"], 0)
+        self.assertEqual([(f["path"], f["rows"]) for f in result["files"]], [("rows.arrow", 0)])
+        with pa.ipc.open_file("rows.arrow") as reader:
+            self.assertEqual(reader.schema, SCHEMA)
+            self.assertEqual(reader.read_all().num_rows, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from gcp.template import Template, TemplateException, render
+
+
+class TemplateTest(unittest.TestCase):
+
+    def test_render(self):
+        self.assertEqual(render("SELECT * FROM {dataset}.{table}", {"dataset": "d", "table": "t"}),
+                         "SELECT * FROM d.t")
+
+    def test_repeated_placeholder(self):
+        self.assertEqual(render("{a}-{a}-{b}", {"a": 1, "b": "x"}), "1-1-x")
+
+    def test_values_are_not_rendered_again(self):
+        self.assertEqual(render("{a}", {"a": "{b}", "b": "x"}), "{b}")
+
+    def test_unresolved_left_in_place(self):
+        template = Template("SELECT {missing} FROM {table}")
+        self.assertEqual(template.render({"table": "t"}), "SELECT {missing} FROM t")
+        self.assertEqual(template.unresolved, {"missing"})
+
+    def test_sql_braces_not_reported(self):
+        sql = "SELECT REGEXP_CONTAINS(x, r'[0-9]{2,4}'), JSON '{\"a\": 1}'"
+        template = Template(sql)
+        self.assertEqual(template.render({}), sql)
+        self.assertEqual(template.unresolved, set())
+
+    def test_strict(self):
+        with self.assertRaises(TemplateException):
+            render("{a} {b}", {"a": 1}, strict=True)
+        self.assertEqual(render("{a}", {"a": 1}, strict=True), "1")
+
+    def test_no_values(self):
+        self.assertEqual(render("{a}", None), "{a}")
+
+    def test_placeholders(self):
+        self.assertEqual(Template("{a} {b.c} {a} x").placeholders, {"a", "b.c"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+# Copyright 2022 The Board of Trustees of The Leland Stanford Junior University.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pyarrow.csv as pa_csv
+
+from gcp import validation
+from gcp.validation import ValidationReport, _line_number, validate_csv, validate_json
+
+SCHEMA = [
+    {"name": "id", "type": "INTEGER", "mode": "REQUIRED"},
+    {"name": "amount", "type": "NUMERIC"},
+    {"name": "day", "type": "DATE"},
+]
+
+CSV = ("id,amount,day\n"
+       "1,1.5,2020-01-31\n"
+       "2,abc,2020-01-31\n"
+       "3,2\n"
+       ",3,2020-02-01\n"
+       "5,4,2020-02-01,extra\n"
+       "6,5,not a date\n")
+
+
+def old_parse_options(*args, invalid_row_handler=None, **kwargs):
+    """ParseOptions of pyarrow before 7.0, which has no invalid_row_handler"""
+    if invalid_row_handler is not None:
+        raise TypeError("__init__() got an unexpected keyword argument 'invalid_row_handler'")
+    return pa_csv.ParseOptions(*args, **kwargs)
+
+
+class ValidationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, text: str, name: str = "source.csv") -> str:
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w") as source_file:
+            source_file.write(text)
+        return path
+
+    def bad_rows(self, result: dict) -> list:
+        return [(bad_row["row"], bad_row["errors"]) for bad_row in result["badRows"]]
+
+    def test_csv(self):
+        result = validate_csv(self.write(CSV), SCHEMA, skip_leading_rows=1)
+        self.assertEqual((result["rows"], result["badRowCount"], result["valid"], result["complete"]),
+                         (6, 5, False, True))
+        self.assertEqual(self.bad_rows(result), [
+            (3, ["amount: invalid NUMERIC value 'abc'"]),
+            (4, ["expected 3 columns, found 2"]),
+            (5, ["id: missing REQUIRED value"]),
+            (6, ["expected 3 columns, found 4"]),
+            (7, ["day: invalid DATE value 'not a date'"])])
+        self.assertEqual(result["badRows"][1]["text"], "3,2")
+
+    def test_csv_without_invalid_row_handler(self):
+        with mock.patch.object(validation.pa_csv, "ParseOptions", side_effect=old_parse_options):
+            result = validate_csv(self.write(CSV + "\n7,\"1\n\",2020-01-01\n8,x,\n"), SCHEMA, skip_leading_rows=1)
+        # Every bad row is still reported, by the line the row starts on (row 7 spans lines 9 and 10)
+        self.assertEqual(result["complete"], True)
+        self.assertEqual(result["rows"], 8)
+        self.assertEqual([row for row, _ in self.bad_rows(result)], [3, 4, 5, 6, 7, 11])
+        self.assertEqual(self.bad_rows(result)[-1], (11, ["amount: invalid NUMERIC value 'x'"]))
+        self.assertEqual(result["badRows"][3]["text"], "5,4,2020-02-01,extra")
+
+    def test_valid_csv(self):
+        result = validate_csv(self.write("1;2.5;2020-01-01\n2;;\n"), SCHEMA, field_delimiter=";")
+        self.assertEqual((result["rows"], result["valid"], result["badRows"]), (2, True, []))
+
+    def test_max_bad_rows(self):
+        text = "".join("x,1,2020-01-01\n" for _ in range(20))
+        result = validate_csv(self.write(text), SCHEMA, max_bad_rows=3)
+        self.assertEqual(result["badRowCount"], 20)
+        self.assertEqual([row for row, _ in self.bad_rows(result)], [1, 2, 3])
+
+    def test_report_keeps_lowest_rows(self):
+        report = ValidationReport(self.write(""), 3)
+        for row in (9, 4, None, 7, 1, 8, 2):
+            report.add(row, ["bad"])
+        self.assertEqual([bad_row["row"] for bad_row in report.to_dict()["badRows"]], [1, 2, 4])
+        self.assertEqual(report.bad_row_count, 7)
+        report = ValidationReport(self.write(""), 0)
+        report.add(1, ["bad"])
+        self.assertEqual(report.to_dict()["badRows"], [])
+
+    def test_line_number(self):
+        self.assertEqual(_line_number(0, 0, []), 1)
+        self.assertEqual(_line_number(0, 2, []), 3)
+        # Invalid (skipped) rows before a data row push it down
+        self.assertEqual(_line_number(1, 1, [3]), 4)
+        self.assertEqual(_line_number(1, 0, [1, 2, 3]), 5)
+        self.assertEqual(_line_number(2, 0, [5]), 3)
+
+    def test_json(self):
+        source = self.write('{"id": 1, "amount": 1.5, "day": "2020-01-31"}\n'
+                            '{"id": "x", "amount": 2, "day": "2020-01-31", "other": true}\n'
+                            '{"amount": 3}\n', "source.json")
+        result = validate_json(source, SCHEMA)
+        self.assertEqual(result["rows"], 3)
+        self.assertEqual(self.bad_rows(result), [(2, ["id: invalid INTEGER value 'x'"]),
+                                                 (3, ["id: missing REQUIRED value"])])
+        self.assertEqual(result["warnings"], ["Fields not in schema (rejected unless ignoreUnknownValues): other"])
+
+    def test_json_malformed_line(self):
+        source = self.write('{"id": 1, "day": "2020-01-31"}\n{"id": 2,\n{"id": 3, "day": "31/01/2020x"}\n',
+                            "source.json")
+        result = validate_json(source, SCHEMA)
+        self.assertEqual([row for row, _ in self.bad_rows(result)], [2, 3])
+        self.assertTrue(result["badRows"][0]["errors"][0].startswith("invalid JSON"))
+        self.assertEqual(result["badRows"][1]["errors"], ["day: invalid DATE value '31/01/2020x'"])
+
+
+if __name__ == "__main__":
+    unittest.main()